@@ -0,0 +1,78 @@
+import os
+import atexit
+import logging
+import logging.config
+import logging.handlers
+import queue
+import threading
+
+# Listeners draining the log queues, so they can be stopped (flushed) at exit
+# and restarted in a forked child, where their threads do not survive.
+_lock = threading.Lock()
+_listeners = []
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """Hand records to a background thread for formatting and I/O.
+
+    The stock QueueHandler formats each record on the logging thread. This
+    one only renders the message text, so later changes to the arguments
+    cannot alter it; timestamps, layout and tracebacks are formatted by
+    the listener's handlers off the request path.
+    """
+
+    def prepare(self, record):
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+def _start(handlers) -> DeferredQueueHandler:
+    log_queue = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    handler = DeferredQueueHandler(log_queue)
+    listener.start()
+    _listeners.append((listener, handler))
+    return handler
+
+def stop_listeners() -> None:
+    """Flush queued records and stop the listener threads"""
+    with _lock:
+        for listener, _ in _listeners:
+            listener.stop()
+        _listeners.clear()
+
+def _restart_in_child() -> None:
+    # The listener threads did not survive the fork, and a queue's lock may
+    # have been held by one of them, so give each pipeline a fresh queue
+    global _lock
+    _lock = threading.Lock()
+    for listener, handler in _listeners:
+        handler.queue = listener.queue = queue.SimpleQueue()
+        listener.start()
+
+def configure_logging(config) -> None:
+    """LOGGING_CONFIG hook: apply ``config``, then move handler I/O off-thread.
+
+    Each logger's handlers are replaced by a single queue handler, and one
+    listener thread per distinct set of handlers does the formatting and
+    writing. A log call on the request path costs a queue put.
+    """
+    stop_listeners()
+    logging.config.dictConfig(config)
+
+    names = [''] + list(config.get('loggers', {}))
+    with _lock:
+        queues = {}
+        for name in names:
+            logger = logging.getLogger(name)
+            handlers = tuple(handler for handler in logger.handlers
+                             if not isinstance(handler, logging.handlers.QueueHandler))
+            if not handlers:
+                continue
+            if handlers not in queues:
+                queues[handlers] = _start(handlers)
+            logger.handlers = [queues[handlers]]
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_restart_in_child)
+atexit.register(stop_listeners)
@@ -23,6 +23,10 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / "db.sqlite3",
+        'OPTIONS': {
+            # Request threads and the outbox worker write concurrently
+            'timeout': 20,
+        },
     }
 }
 
@@ -37,6 +41,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # First, so its timings cover the rest of the stack
+    'cards.middleware.ServerTimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'whitenoise.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
@@ -66,6 +72,7 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'app.wsgi.application'
+ASGI_APPLICATION = 'app.asgi.application'
 
 LANGUAGE_CODE = 'en-us'
 
@@ -84,23 +91,208 @@ STATICFILES_DIRS = [os.path.join(BASE_DIR, 'static')]
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
-FILE_UPLOAD_MAX_MEMORY_SIZE = 10485760  # 10MB
+# Larger uploads are spooled to a temporary file and memory-mapped when read
+FILE_UPLOAD_MAX_MEMORY_SIZE = int(os.getenv('FILE_UPLOAD_MAX_MEMORY_SIZE') or 2621440)  # 2.5MB
 DATA_UPLOAD_MAX_MEMORY_SIZE = 10485760  # 10MB
 
+# Resumable image uploads (uploads/<sha256>/). The browser shrinks images to
+# VISION_IMAGE_MAX_EDGE before sending them in UPLOAD_CHUNK_SIZE pieces;
+# finished uploads are reused until unused for UPLOAD_RETENTION seconds.
+# UPLOAD_DIR must be storage every instance serving the app can reach (a
+# shared volume); without it the images are sent in the analyze request.
+UPLOAD_DIR = os.getenv('UPLOAD_DIR') or None
+UPLOAD_CHUNK_SIZE = int(os.getenv('UPLOAD_CHUNK_SIZE') or 1048576)  # 1MB
+UPLOAD_MAX_SIZE = int(os.getenv('UPLOAD_MAX_SIZE') or 20971520)  # 20MB
+UPLOAD_RETENTION = int(os.getenv('UPLOAD_RETENTION') or 3600)  # seconds
+
 # Google API settings
 GOOGLE_APPLICATION_CREDENTIALS = os.path.join(BASE_DIR, os.getenv('GOOGLE_APPLICATION_CREDENTIALS'))
 GOOGLE_SHEET_ID = os.getenv('GOOGLE_SHEET_ID')  # Add this line to match .env
 GOOGLE_API_KEY = os.getenv('GOOGLE_API_KEY')
+# Override the Sheets API host, e.g. to point at a local stub server
+GOOGLE_SHEETS_API_ENDPOINT = os.getenv('GOOGLE_SHEETS_API_ENDPOINT')
+GOOGLE_SHEETS_TIMEOUT = int(os.getenv('GOOGLE_SHEETS_TIMEOUT') or 30)
+# Sheets outbox: cards are saved locally and pushed to the sheet in batches.
+# By default each upload drains the outbox before it responds, which works
+# anywhere, including serverless deploys (vercel.json) with no cron and a
+# throwaway database. Set SHEETS_OUTBOX_CRON=True when `manage.py
+# drain_outbox --loop` or `manage.py drain_outbox` from cron drains it
+# instead. SHEETS_OUTBOX_WORKER=True drains it from a background thread in
+# every process after each upload; only enable it for long-lived servers,
+# since serverless functions freeze or kill the thread between invocations,
+# stranding the batches it leased.
+SHEETS_OUTBOX_CRON = os.getenv('SHEETS_OUTBOX_CRON', 'False') == 'True'
+SHEETS_OUTBOX_WORKER = os.getenv('SHEETS_OUTBOX_WORKER', 'False') == 'True'
+SHEETS_OUTBOX_POLL_INTERVAL = float(os.getenv('SHEETS_OUTBOX_POLL_INTERVAL') or 10)  # seconds
+SHEETS_OUTBOX_MAX_ATTEMPTS = int(os.getenv('SHEETS_OUTBOX_MAX_ATTEMPTS') or 8)
+SHEETS_OUTBOX_BASE_BACKOFF = float(os.getenv('SHEETS_OUTBOX_BASE_BACKOFF') or 2)  # seconds
+SHEETS_OUTBOX_MAX_BACKOFF = float(os.getenv('SHEETS_OUTBOX_MAX_BACKOFF') or 300)  # seconds
+SHEETS_OUTBOX_LEASE = float(os.getenv('SHEETS_OUTBOX_LEASE') or 120)  # seconds
+SHEETS_BATCH_MAX_ROWS = int(os.getenv('SHEETS_BATCH_MAX_ROWS') or 100)
+SHEETS_BATCH_MAX_WAIT = float(os.getenv('SHEETS_BATCH_MAX_WAIT') or 0.5)  # seconds
+# Rows read per request when sync_sheet pulls edits made in the sheet, and
+# rows read per run; the next run continues after them (0: the whole sheet)
+SHEETS_PULL_PAGE_ROWS = int(os.getenv('SHEETS_PULL_PAGE_ROWS') or 1000)
+SHEETS_PULL_MAX_ROWS = int(os.getenv('SHEETS_PULL_MAX_ROWS') or 5000)
 
 # OpenAI settings
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
+OPENAI_BASE_URL = os.getenv('OPENAI_BASE_URL')
+OPENAI_TIMEOUT = float(os.getenv('OPENAI_TIMEOUT') or 60)
+OPENAI_MAX_CONNECTIONS = int(os.getenv('OPENAI_MAX_CONNECTIONS') or 20)
+# Pool of the AsyncOpenAI client shared by all requests of an ASGI process
+OPENAI_ASYNC_MAX_CONNECTIONS = int(os.getenv('OPENAI_ASYNC_MAX_CONNECTIONS') or 200)
+OPENAI_VISION_MODEL = os.getenv('OPENAI_VISION_MODEL') or 'gpt-4.1-mini'
+# Constrain replies to the card JSON schema; turn off for models without
+# structured output support
+OPENAI_STRUCTURED_OUTPUT = os.getenv('OPENAI_STRUCTURED_OUTPUT', 'True') == 'True'
+
+# Client-side limits per upstream API (cards/utils/resilience.py). Rates are
+# requests per second; the limiter slows below them on 429s and, for OpenAI,
+# follows the x-ratelimit-* headers. Calls that would queue longer than
+# max_wait fail fast, as do calls while a circuit is open.
+UPSTREAM_LIMITS = {
+    'openai': {
+        'rate': float(os.getenv('OPENAI_RATE_LIMIT') or 10),
+        'burst': int(os.getenv('OPENAI_RATE_BURST') or 20),
+        'max_attempts': int(os.getenv('OPENAI_MAX_ATTEMPTS') or 4),
+        'base_backoff': float(os.getenv('OPENAI_BASE_BACKOFF') or 0.5),  # seconds
+        'max_backoff': float(os.getenv('OPENAI_MAX_BACKOFF') or 20),  # seconds
+        'max_wait': float(os.getenv('OPENAI_MAX_QUEUE_WAIT') or 30),  # seconds
+        'circuit_threshold': int(os.getenv('OPENAI_CIRCUIT_THRESHOLD') or 5),
+        'circuit_reset': float(os.getenv('OPENAI_CIRCUIT_RESET') or 30),  # seconds
+    },
+    'sheets': {
+        # The Sheets API allows 60 requests per minute per user by default
+        'rate': float(os.getenv('SHEETS_RATE_LIMIT') or 1),
+        'burst': int(os.getenv('SHEETS_RATE_BURST') or 10),
+        'max_attempts': int(os.getenv('SHEETS_MAX_ATTEMPTS') or 5),
+        'base_backoff': float(os.getenv('SHEETS_BASE_BACKOFF') or 1),  # seconds
+        'max_backoff': float(os.getenv('SHEETS_MAX_BACKOFF') or 32),  # seconds
+        'max_wait': float(os.getenv('SHEETS_MAX_QUEUE_WAIT') or 60),  # seconds
+        'circuit_threshold': int(os.getenv('SHEETS_CIRCUIT_THRESHOLD') or 5),
+        'circuit_reset': float(os.getenv('SHEETS_CIRCUIT_RESET') or 60),  # seconds
+    },
+}
+
+# Image preprocessing before upload to the vision API
+VISION_PREPROCESS_ENABLED = os.getenv('VISION_PREPROCESS_ENABLED', 'True') == 'True'
+VISION_IMAGE_MAX_EDGE = int(os.getenv('VISION_IMAGE_MAX_EDGE') or 1536)  # pixels, 0 = keep size
+VISION_IMAGE_FORMAT = os.getenv('VISION_IMAGE_FORMAT') or 'JPEG'  # JPEG or WEBP
+VISION_IMAGE_QUALITY = int(os.getenv('VISION_IMAGE_QUALITY') or 85)
+VISION_IMAGE_GRAYSCALE = os.getenv('VISION_IMAGE_GRAYSCALE', 'False') == 'True'
+VISION_IMAGE_DETAIL = os.getenv('VISION_IMAGE_DETAIL') or 'auto'  # low, high or auto
+# Images decoded at once per process; bounds memory spent on decoded pixels
+VISION_PREPROCESS_CONCURRENCY = int(os.getenv('VISION_PREPROCESS_CONCURRENCY') or 2)
+
+# Model tiers for the vision API, cheapest first (cards/utils/model_routing.py):
+# comma-separated "model [detail [max_tokens]]" entries, e.g.
+# "gpt-4.1-nano low 300, gpt-4.1-mini high 500". A reply scoring below
+# VISION_ESCALATION_MIN_SCORE (0 to 1: required fields present, emails,
+# phones and websites well formed) is retried on the next tier. The default
+# is one tier, OPENAI_VISION_MODEL at VISION_IMAGE_DETAIL.
+VISION_MAX_TOKENS = int(os.getenv('VISION_MAX_TOKENS') or 500)
+VISION_MODEL_TIERS = [
+    {
+        'model': model,
+        'detail': detail or VISION_IMAGE_DETAIL,
+        'max_tokens': int(max_tokens or VISION_MAX_TOKENS),
+    }
+    for model, detail, max_tokens in (
+        (spec.split() + ['', ''])[:3]
+        for spec in (os.getenv('VISION_MODEL_TIERS') or OPENAI_VISION_MODEL).split(',')
+        if spec.strip()
+    )
+]
+VISION_ESCALATION_MIN_SCORE = float(os.getenv('VISION_ESCALATION_MIN_SCORE') or 0.8)
+
+# Split photos of several cards into one extraction request per card. Off by
+# default: it only helps uploads that show several cards at once.
+CARD_DETECTION_ENABLED = os.getenv('CARD_DETECTION_ENABLED', 'False') == 'True'
+CARD_DETECTION_MAX_EDGE = int(os.getenv('CARD_DETECTION_MAX_EDGE') or 3072)  # pixels decoded for cropping
+CARD_DETECTION_MAX_CARDS = int(os.getenv('CARD_DETECTION_MAX_CARDS') or 12)
+
+# Optional local OCR tier (cards/utils/local_ocr.py): read clean printed cards
+# with Tesseract and only send a card to the vision model when a required
+# field is missing or was read with less than LOCAL_OCR_MIN_CONFIDENCE (0-1).
+# Needs pytesseract and the tesseract binary.
+LOCAL_OCR_ENABLED = os.getenv('LOCAL_OCR_ENABLED', 'False') == 'True'
+LOCAL_OCR_MIN_CONFIDENCE = float(os.getenv('LOCAL_OCR_MIN_CONFIDENCE') or 0.8)
+LOCAL_OCR_LANG = os.getenv('LOCAL_OCR_LANG') or 'eng'  # Tesseract language codes, e.g. eng+deu
+LOCAL_OCR_MAX_EDGE = int(os.getenv('LOCAL_OCR_MAX_EDGE') or 2000)  # pixels
+LOCAL_OCR_TIMEOUT = float(os.getenv('LOCAL_OCR_TIMEOUT') or 10)  # seconds
+
+# Card analysis settings
+# Maximum number of images from one upload analyzed concurrently
+ANALYZE_MAX_WORKERS = int(os.getenv('ANALYZE_MAX_WORKERS') or 4)
+# Background analysis jobs (analyze/jobs/). A job lives in the memory of the
+# process that started it, so enable them only on a single long-running
+# server; serverless deploys (vercel.json) use the synchronous analyze/.
+ANALYZE_JOBS_ENABLED = os.getenv('ANALYZE_JOBS_ENABLED', 'False') == 'True'
+# Images processed at once across all jobs in a process, how long finished
+# jobs stay readable and how often an idle stream sends a keep-alive line
+JOB_MAX_WORKERS = int(os.getenv('JOB_MAX_WORKERS') or 8)
+JOB_RETENTION = int(os.getenv('JOB_RETENTION') or 3600)  # seconds
+JOB_KEEPALIVE = float(os.getenv('JOB_KEEPALIVE') or 15)  # seconds
+# Deduplication (cards/utils/single_flight.py): uploads of the same image, or
+# requests with the same Idempotency-Key, share one analysis. Results are
+# replayed for SINGLE_FLIGHT_RETENTION seconds; a worker that dies mid-run
+# gives up its claim after SINGLE_FLIGHT_LEASE seconds.
+SINGLE_FLIGHT_RETENTION = int(os.getenv('SINGLE_FLIGHT_RETENTION') or 600)  # seconds
+SINGLE_FLIGHT_LEASE = int(os.getenv('SINGLE_FLIGHT_LEASE') or 300)  # seconds
+
+# Contact search API (contacts/)
+CONTACTS_PAGE_SIZE = int(os.getenv('CONTACTS_PAGE_SIZE') or 50)
+CONTACTS_MAX_PAGE_SIZE = int(os.getenv('CONTACTS_MAX_PAGE_SIZE') or 200)
+# contacts/, metrics and the analyze/ stats routes expose stored contacts and
+# internals: they answer staff sessions (admin/) and requests sending
+# "Authorization: Bearer <INTERNAL_API_TOKEN>". Unset, only staff get in.
+INTERNAL_API_TOKEN = os.getenv('INTERNAL_API_TOKEN', '')
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# Caches
+# The 'vision' cache stores OpenAI responses keyed by image content, prompt and
+# model. The default is a per-process in-memory LRU; set VISION_CACHE_BACKEND
+# to django.core.cache.backends.filebased.FileBasedCache (LOCATION = directory)
+# or django.core.cache.backends.db.DatabaseCache (LOCATION = table, create it
+# with `manage.py createcachetable`) to share results on disk.
+VISION_CACHE_BACKEND = os.getenv('VISION_CACHE_BACKEND') or 'django.core.cache.backends.locmem.LocMemCache'
+VISION_CACHE_LOCATION = os.getenv('VISION_CACHE_LOCATION') or 'vision-results'
+VISION_CACHE_TTL = int(os.getenv('VISION_CACHE_TTL') or 7 * 24 * 3600)  # seconds
+VISION_CACHE_MAX_ENTRIES = int(os.getenv('VISION_CACHE_MAX_ENTRIES') or 1000)
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'vision': {
+        'BACKEND': VISION_CACHE_BACKEND,
+        'LOCATION': VISION_CACHE_LOCATION,
+        'TIMEOUT': VISION_CACHE_TTL,
+        'OPTIONS': {
+            'MAX_ENTRIES': VISION_CACHE_MAX_ENTRIES,
+        },
+    },
+}
+
 if os.getenv('VERCEL_ENV'):
     STATICFILES_STORAGE = 'whitenoise.storage.CompressedManifestStaticFilesStorage'
 
 # Logging Configuration
+# Handlers run on a background thread (app/logconfig.py), so a log call on the
+# request path only enqueues the record. The app logs at DEBUG in development
+# and INFO elsewhere unless LOG_LEVEL says otherwise.
+LOGGING_CONFIG = 'app.logconfig.configure_logging'
+LOG_LEVEL = (os.getenv('LOG_LEVEL') or ('DEBUG' if DEBUG else 'INFO')).upper()
+# Rotating log file; empty disables it (the default on Vercel's read-only disk)
+LOG_FILE = os.getenv('LOG_FILE', '' if os.getenv('VERCEL_ENV') else 'app.log')
+LOG_FILE_MAX_BYTES = int(os.getenv('LOG_FILE_MAX_BYTES') or 10 * 1024 * 1024)
+LOG_FILE_BACKUPS = int(os.getenv('LOG_FILE_BACKUPS') or 5)
+# Fraction of raw model replies written to the log in full, for debugging
+# extraction without logging every payload
+LOG_PAYLOAD_SAMPLE_RATE = float(os.getenv('LOG_PAYLOAD_SAMPLE_RATE') or 0)
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -116,27 +308,35 @@ LOGGING = {
     },
     'handlers': {
         'console': {
-            'level': 'DEBUG',
+            'level': LOG_LEVEL,
             'class': 'logging.StreamHandler',
             'formatter': 'verbose',
         },
-        'file': {
-            'level': 'INFO',
-            'class': 'logging.FileHandler',
-            'filename': 'app.log',  # Path to log file
-            'formatter': 'verbose',
-        },
     },
     'loggers': {
         'django': {
-            'handlers': ['console', 'file'],
+            'handlers': ['console'],
             'level': 'INFO',
             'propagate': True,
         },
         'cards': {  # Logger for your app
-            'handlers': ['console', 'file'],
-            'level': 'DEBUG',  # Set to DEBUG for more verbose logging
+            'handlers': ['console'],
+            'level': LOG_LEVEL,
             'propagate': False,
         },
     },
-}
\ No newline at end of file
+}
+
+if LOG_FILE:
+    LOGGING['handlers']['file'] = {
+        'level': 'INFO',
+        'class': 'logging.handlers.RotatingFileHandler',
+        'filename': LOG_FILE,  # Path to log file
+        'maxBytes': LOG_FILE_MAX_BYTES,
+        'backupCount': LOG_FILE_BACKUPS,
+        'formatter': 'verbose',
+        # Opened on the first write, so importing settings creates no file
+        'delay': True,
+    }
+    for logger_config in LOGGING['loggers'].values():
+        logger_config['handlers'].append('file')
@@ -0,0 +1,138 @@
+"""
+Concurrent uploads through the sync view under WSGI against the async view
+under ASGI, with OpenAI and Google replaced by a local stub server.
+
+WSGI capacity is modelled as ``--wsgi-workers`` request threads (gunicorn
+sync workers or threads); requests beyond that queue, as they would in
+front of a real server. The ASGI app runs every request on one event loop.
+Both apps are driven in-process through httpx transports, so the numbers
+exclude socket and server overhead and isolate the request path.
+
+Run from ``src/``::
+
+    python -m benchmarks.bench_asgi --clients 200 --latency 0.5
+"""
+import argparse
+import asyncio
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .common import make_photo, setup_django, summarize, use_temp_database
+from .stubs import start_stub_server
+
+
+def make_uploads(photo, count, tag):
+    """Distinct uploads of one photo, so the vision cache never hits"""
+    # JPEG decoders ignore bytes after the end-of-image marker
+    return [photo + b'%s-%d' % (tag, index) for index in range(count)]
+
+
+def limit_workers(app, workers):
+    """Let at most ``workers`` requests into a WSGI app at a time"""
+    slots = threading.BoundedSemaphore(workers)
+
+    def limited(environ, start_response):
+        with slots:
+            return list(app(environ, start_response))
+    return limited
+
+
+def run_wsgi(uploads, workers):
+    import httpx
+    from django.core.wsgi import get_wsgi_application
+
+    client = httpx.Client(
+        transport=httpx.WSGITransport(app=limit_workers(get_wsgi_application(), workers)),
+        base_url='http://localhost',
+        timeout=None
+    )
+
+    def upload(photo):
+        started = time.perf_counter()
+        response = client.post('/analyze/', files={'images': ('card.jpg', photo, 'image/jpeg')})
+        response.raise_for_status()
+        return time.perf_counter() - started
+
+    started = time.perf_counter()
+    # One thread per client; the semaphore plays the part of the server
+    with ThreadPoolExecutor(max_workers=len(uploads)) as executor:
+        samples = list(executor.map(upload, uploads))
+    return samples, time.perf_counter() - started
+
+
+def run_asgi(uploads):
+    import httpx
+    from django.core.asgi import get_asgi_application
+
+    app = get_asgi_application()
+
+    async def main():
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app),
+                                     base_url='http://localhost', timeout=None) as client:
+            async def upload(photo):
+                started = time.perf_counter()
+                response = await client.post(
+                    '/analyze/async/', files={'images': ('card.jpg', photo, 'image/jpeg')}
+                )
+                response.raise_for_status()
+                return time.perf_counter() - started
+
+            started = time.perf_counter()
+            samples = await asyncio.gather(*(upload(photo) for photo in uploads))
+            return samples, time.perf_counter() - started
+
+    return asyncio.run(main())
+
+
+def report(samples, elapsed):
+    return {
+        'elapsed_s': round(elapsed, 3),
+        'throughput_rps': round(len(samples) / elapsed, 2),
+        'latency': summarize(samples),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--clients', type=int, default=200, help="Concurrent uploads")
+    parser.add_argument('--latency', type=float, default=0.5, help="Stub upstream latency in seconds")
+    parser.add_argument('--wsgi-workers', type=int, default=8)
+    parser.add_argument('--preprocess', action='store_true',
+                        help="Include image preprocessing (CPU-bound; dominates on small machines)")
+    args = parser.parse_args()
+
+    server = start_stub_server(latency=args.latency)
+    setup_django(
+        server.url,
+        # Keep the background sheet sync out of the measurement
+        SHEETS_OUTBOX_WORKER='False',
+        SHEETS_OUTBOX_CRON='True',
+        CARD_DETECTION_ENABLED='False',
+        VISION_PREPROCESS_ENABLED=str(args.preprocess),
+        OPENAI_MAX_CONNECTIONS=args.wsgi_workers,
+        OPENAI_ASYNC_MAX_CONNECTIONS=args.clients,
+    )
+    use_temp_database()
+
+    photo = make_photo(640, 400)
+    wsgi = report(*run_wsgi(make_uploads(photo, args.clients, b'wsgi'), args.wsgi_workers))
+    calls_after_wsgi = server.state.calls['chat.completions']
+    asgi = report(*run_asgi(make_uploads(photo, args.clients, b'asgi')))
+
+    print(json.dumps({
+        'clients': args.clients,
+        'upstream_latency_s': args.latency,
+        'wsgi_workers': args.wsgi_workers,
+        'wsgi': wsgi,
+        'asgi': asgi,
+        'vision_calls': {
+            'wsgi': calls_after_wsgi,
+            'asgi': server.state.calls['chat.completions'] - calls_after_wsgi,
+        },
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""
+Per-card client overhead: a fresh OpenAI client and Sheets service for every
+card (the old behaviour) against the shared per-process registry.
+
+Run from ``src/``::
+
+    python -m benchmarks.bench_clients --cards 50
+"""
+import argparse
+import io
+import json
+import time
+
+from .common import setup_django, summarize
+from .stubs import start_stub_server
+
+
+def fresh_clients_card(image):
+    """One card the way the helpers used to do it"""
+    from django.conf import settings
+    from google.oauth2 import service_account
+    from googleapiclient.discovery import build
+    from openai import OpenAI
+
+    client = OpenAI(api_key=settings.OPENAI_API_KEY, base_url=settings.OPENAI_BASE_URL)
+    client.chat.completions.create(
+        model='gpt-4.1-mini',
+        messages=[{'role': 'user', 'content': 'stub'}],
+        max_tokens=500
+    )
+    credentials = service_account.Credentials.from_service_account_file(
+        settings.GOOGLE_APPLICATION_CREDENTIALS,
+        scopes=['https://www.googleapis.com/auth/spreadsheets']
+    )
+    service = build('sheets', 'v4', credentials=credentials,
+                    client_options={'api_endpoint': settings.GOOGLE_SHEETS_API_ENDPOINT})
+    service.spreadsheets().values().append(
+        spreadsheetId=settings.GOOGLE_SHEET_ID, range='A1',
+        valueInputOption='RAW', insertDataOption='INSERT_ROWS',
+        body={'values': [['Jane Doe']]}
+    ).execute()
+
+
+def shared_clients_card(image):
+    """One card through the current helpers and client registry"""
+    from cards.utils.openai_helper import analyze_image, extract_card_details
+    from cards.utils.sheets_helper import append_rows
+
+    image.seek(0)
+    append_rows(extract_card_details(analyze_image(image)))
+
+
+def run(fn, cards):
+    samples = []
+    for _ in range(cards):
+        image = io.BytesIO(b'\xff\xd8\xff' + b'\0' * 2048)
+        image.name = 'card.jpg'
+        started = time.perf_counter()
+        fn(image)
+        samples.append(time.perf_counter() - started)
+    return summarize(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--cards', type=int, default=30)
+    args = parser.parse_args()
+
+    server = start_stub_server()
+    setup_django(server.url)
+
+    report = {
+        'before_fresh_clients': run(fresh_clients_card, args.cards),
+        'after_shared_clients': run(shared_clients_card, args.cards),
+        'upstream_calls': dict(server.state.calls),
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
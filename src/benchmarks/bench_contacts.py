@@ -0,0 +1,137 @@
+"""
+Contact lookups at scale: the indexed local store against reading the whole
+Google Sheet (the stub server) and filtering it in Python.
+
+Loads ``--contacts`` synthetic contacts through ``enqueue_cards``, re-scans a
+sample to check deduplication, then times each search filter of the
+contacts API and prints the query plan SQLite chose for it.
+
+Run from ``src/``::
+
+    python -m benchmarks.bench_contacts --contacts 100000
+"""
+import argparse
+import json
+import random
+import time
+
+from .common import setup_django, summarize, use_temp_database
+from .stubs import start_stub_server
+
+FIRST_NAMES = ['Jane', 'John', 'Priya', 'Wei', 'Amara', 'Lukas', 'Sofia', 'Omar', 'Mei', 'Carlos',
+               'Aisha', 'Ivan', 'Hana', 'Noah', 'Zara', 'Ravi', 'Elena', 'Kenji', 'Fatima', 'Leo']
+LAST_NAMES = ['Doe', 'Smith', 'Sharma', 'Chen', 'Okafor', 'Muller', 'Rossi', 'Haddad', 'Tanaka',
+              'Garcia', 'Khan', 'Petrov', 'Kim', 'Brown', 'Ali', 'Patel', 'Novak', 'Sato', 'Diaz']
+COMPANIES = ['Acme', 'Globex', 'Initech', 'Umbrella', 'Stark', 'Wayne', 'Hooli', 'Vandelay',
+             'Soylent', 'Tyrell', 'Cyberdyne', 'Aperture', 'Wonka', 'Gringotts', 'Oscorp']
+
+
+def make_contacts(count, seed=0):
+    rng = random.Random(seed)
+    contacts = []
+    for index in range(count):
+        first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+        company = f"{rng.choice(COMPANIES)} {rng.choice(['Corp', 'Labs', 'Group', 'Ltd'])} {index % 997}"
+        contacts.append({
+            'name': f"{first} {last}",
+            'business_name': company,
+            'job_title': rng.choice(['CEO', 'CTO', 'Head of Sales', 'Engineer', 'Designer']),
+            'contact_number': f"+1 555 {index:07d}",
+            'email': f"{first}.{last}.{index}@{company.split()[0]}.example".lower(),
+            'website': f"https://{company.split()[0].lower()}.example",
+            'address': f"{index} Main Street",
+        })
+    return contacts
+
+
+def time_calls(fn, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - started)
+    return summarize(samples)
+
+
+def query_plan(queryset):
+    from django.db import connection
+
+    sql, params = queryset.query.sql_with_params()
+    with connection.cursor() as cursor:
+        cursor.execute(f'EXPLAIN QUERY PLAN {sql}', params)
+        return [row[-1] for row in cursor.fetchall()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--contacts', type=int, default=100000)
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    server = start_stub_server()
+    setup_django(server.url, SHEETS_OUTBOX_WORKER='False', INTERNAL_API_TOKEN='bench')
+    use_temp_database()
+
+    from django.test import Client
+    from cards.models import VisitingCard
+    from cards.utils.outbox import enqueue_cards
+    from cards.utils.sheets_helper import SHEET_COLUMNS, get_sheet_data
+
+    contacts = make_contacts(args.contacts)
+    started = time.perf_counter()
+    for start in range(0, len(contacts), 1000):
+        enqueue_cards([dict(card) for card in contacts[start:start + 1000]], wake=False)
+    load_seconds = time.perf_counter() - started
+
+    # Re-scan 1% of the contacts, with the phone formatted differently
+    rescans = [dict(card, contact_number=card['contact_number'].replace(' ', '-'))
+               for card in random.Random(1).sample(contacts, len(contacts) // 100)]
+    enqueue_cards(rescans, wake=False)
+    rows_after_rescan = VisitingCard.objects.count()
+
+    sample = contacts[len(contacts) // 2]
+    middle = VisitingCard.objects.order_by('-pk').values_list('pk', flat=True)[len(contacts) // 2]
+    searches = {
+        'email': {'email': sample['email'].upper()},
+        'phone': {'phone': sample['contact_number'].replace(' ', '')},
+        'name_prefix': {'q': sample['name'][:6], 'page_size': 50},
+        'business_prefix': {'q': sample['business_name'].lower()},
+        'first_page': {'page_size': 50},
+        'deep_page': {'page_size': 50, 'cursor': middle},
+    }
+    client = Client(HTTP_HOST='localhost', HTTP_AUTHORIZATION='Bearer bench')
+    local = {}
+    for label, params in searches.items():
+        assert client.get('/contacts/', params).json()['results'], label
+        local[label] = time_calls(lambda: client.get('/contacts/', params), args.repeat)
+
+    plans = {
+        'email': query_plan(VisitingCard.objects.filter(email=sample['email'])),
+        'phone': query_plan(VisitingCard.objects.filter(normalized_phone='15550000001')),
+        'name_prefix': query_plan(VisitingCard.objects.filter(name_key__gte='jane', name_key__lt='jane\U0010ffff')),
+    }
+
+    # The old lookup path: read every row from the sheet, then filter
+    server.state.rows = [SHEET_COLUMNS] + [
+        [card['name'], card['business_name'], card['job_title'], card['contact_number'],
+         card['email'], card['website'], card['address'], '2026-01-01 00:00:00', str(index)]
+        for index, card in enumerate(contacts)
+    ]
+    sheet_scan = time_calls(
+        lambda: [row for row in get_sheet_data() if row['Email'] == sample['email']],
+        max(3, args.repeat // 50)
+    )
+
+    print(json.dumps({
+        'contacts': args.contacts,
+        'load_seconds': round(load_seconds, 2),
+        'rescanned': len(rescans),
+        'rows_after_rescan': rows_after_rescan,
+        'local_api': local,
+        'query_plans': plans,
+        'sheet_scan_by_email': sheet_scan,
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
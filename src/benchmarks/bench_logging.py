@@ -0,0 +1,137 @@
+"""
+Request overhead of logging: the same upload handled with logging off,
+with the old synchronous handlers at DEBUG, and with the queued handlers.
+
+Each request posts one photo to ``/analyze/`` through the Django test
+client. The vision cache is warmed first and card detection is off, so
+there is no network wait and logging is a visible share of the time. Log
+output goes to temporary files; ``--write-delay`` adds a pause to every
+write to model a slow disk or a blocked stdout pipe. Modes take turns over
+``--rounds`` rounds so drift affects them alike.
+
+Run from ``src/``::
+
+    python -m benchmarks.bench_logging --requests 300 --write-delay 0.5
+"""
+import argparse
+import json
+import logging
+import logging.config
+import os
+import tempfile
+import time
+
+from .common import make_photo, setup_django, summarize, use_temp_database
+from .stubs import start_stub_server
+
+
+class SlowFile:
+    """File wrapper whose writes take at least ``delay`` seconds"""
+
+    def __init__(self, path, delay):
+        self.file = open(path, 'w')
+        self.delay = delay
+
+    def write(self, text):
+        if self.delay:
+            time.sleep(self.delay)
+        return self.file.write(text)
+
+    def flush(self):
+        self.file.flush()
+
+
+def sync_config(log_dir, delay):
+    """The previous setup: DEBUG to the console and a plain file, written inline"""
+    return {
+        'version': 1,
+        'disable_existing_loggers': False,
+        'formatters': {'verbose': {'format': '{levelname} {asctime} {module} {message}', 'style': '{'}},
+        'handlers': {
+            'console': {'level': 'DEBUG', 'class': 'logging.StreamHandler', 'formatter': 'verbose',
+                        'stream': SlowFile(os.path.join(log_dir, 'console-sync.log'), delay)},
+            'file': {'level': 'INFO', 'class': 'logging.FileHandler', 'formatter': 'verbose',
+                     'filename': os.path.join(log_dir, 'sync.log')},
+        },
+        'loggers': {
+            'django': {'handlers': ['console', 'file'], 'level': 'INFO'},
+            'cards': {'handlers': ['console', 'file'], 'level': 'DEBUG', 'propagate': False},
+        },
+    }
+
+
+def queued_config(log_dir, level, delay):
+    """The current LOGGING, with its streams pointed at temporary files"""
+    from django.conf import settings
+
+    config = json.loads(json.dumps(settings.LOGGING))
+    config['handlers']['console']['level'] = level
+    config['handlers']['console']['stream'] = SlowFile(os.path.join(log_dir, f'console-{level}.log'), delay)
+    config['handlers']['file'] = dict(
+        config['handlers'].get('file', {}),
+        level='INFO', filename=os.path.join(log_dir, f'{level}.log'),
+        maxBytes=10 * 1024 * 1024, backupCount=1, formatter='verbose',
+    )
+    config['handlers']['file']['class'] = 'logging.handlers.RotatingFileHandler'
+    config['loggers']['cards']['level'] = level
+    for logger_config in config['loggers'].values():
+        logger_config['handlers'] = ['console', 'file']
+    return config
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--requests', type=int, default=300, help="Requests per mode and round")
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--write-delay', type=float, default=0.0, help="Milliseconds added to each console write")
+    args = parser.parse_args()
+
+    server = start_stub_server()
+    setup_django(server.url, SHEETS_OUTBOX_WORKER='False', SHEETS_OUTBOX_CRON='True', CARD_DETECTION_ENABLED='False')
+    use_temp_database()
+
+    from django.core.files.uploadedfile import SimpleUploadedFile
+    from django.test import Client
+    from app.logconfig import configure_logging, stop_listeners
+
+    client = Client(HTTP_HOST='localhost')
+    photo = make_photo(640, 400)
+
+    def post():
+        upload = SimpleUploadedFile('card.jpg', photo, content_type='image/jpeg')
+        response = client.post('/analyze/', {'images': [upload]})
+        assert response.status_code == 200, response.content
+
+    log_dir = tempfile.mkdtemp(prefix='bench-logs-')
+    delay = args.write_delay / 1000
+    modes = {
+        'off': lambda: logging.disable(logging.CRITICAL),
+        'sync_debug': lambda: logging.config.dictConfig(sync_config(log_dir, delay)),
+        'queued_info': lambda: configure_logging(queued_config(log_dir, 'INFO', delay)),
+        'queued_debug': lambda: configure_logging(queued_config(log_dir, 'DEBUG', delay)),
+    }
+
+    # Warm the vision cache and the imports
+    for _ in range(5):
+        post()
+
+    samples = {mode: [] for mode in modes}
+    for _ in range(args.rounds):
+        for mode, configure in modes.items():
+            logging.disable(logging.NOTSET)
+            stop_listeners()
+            configure()
+            for _ in range(args.requests):
+                started = time.perf_counter()
+                post()
+                samples[mode].append(time.perf_counter() - started)
+    stop_listeners()
+
+    results = {mode: summarize(mode_samples) for mode, mode_samples in samples.items()}
+
+    results['log_files'] = {name: os.path.getsize(os.path.join(log_dir, name)) for name in sorted(os.listdir(log_dir))}
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,108 @@
+"""
+Peak Python heap per image while building the vision request payload.
+
+Compares the old read/b64encode/decode/f-string path with the buffered
+path in ``analyze_image`` for in-memory and disk-spooled uploads.
+tracemalloc only sees Python allocations; Pillow's decoded pixel buffers
+live in C memory, so the ``preprocessed`` rows understate their true peak
+(which is bounded by VISION_IMAGE_MAX_EDGE and VISION_PREPROCESS_CONCURRENCY).
+
+Run from ``src/``::
+
+    python -m benchmarks.bench_memory [--megapixels 12]
+"""
+import argparse
+import base64
+import gc
+import io
+import json
+import tracemalloc
+
+from .common import SRC_DIR, make_photo
+
+
+def legacy_payload(image_file):
+    encoded = base64.b64encode(image_file.read()).decode('utf-8')
+    image_file.seek(0)
+    return f'data:image/jpeg;base64,{encoded}'
+
+
+def buffered_payload(image_file):
+    from cards.utils.image_preprocess import detect_mime, image_buffer
+    from cards.utils.openai_helper import encode_data_url
+
+    with image_buffer(image_file) as data:
+        return encode_data_url(data, detect_mime(image_file))
+
+
+def preprocessed_payload(image_file):
+    from cards.utils.image_preprocess import preprocess_image
+    from cards.utils.openai_helper import encode_data_url
+
+    payload, mime_type = preprocess_image(image_file)
+    return encode_data_url(payload, mime_type)
+
+
+def make_upload(kind, photo):
+    from django.core.files.uploadedfile import InMemoryUploadedFile, TemporaryUploadedFile
+
+    if kind == 'in_memory':
+        # Written rather than wrapped, like Django's upload handler does, so
+        # the BytesIO owns its buffer instead of sharing ``photo``
+        buffer = io.BytesIO()
+        buffer.write(photo)
+        buffer.seek(0)
+        return InMemoryUploadedFile(buffer, 'images', 'card.jpg', 'image/jpeg', len(photo), None)
+    upload = TemporaryUploadedFile('card.jpg', 'image/jpeg', len(photo), None)
+    upload.write(photo)
+    upload.seek(0)
+    return upload
+
+
+def peak_mb(build, upload):
+    gc.collect()
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    baseline = tracemalloc.get_traced_memory()[0]
+    url = build(upload)
+    peak = tracemalloc.get_traced_memory()[1] - baseline
+    tracemalloc.stop()
+    return round(peak / 2 ** 20, 2), len(url)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--megapixels', type=float, default=12)
+    args = parser.parse_args()
+
+    import sys
+    sys.path.insert(0, str(SRC_DIR))
+    from django.conf import settings
+    settings.configure(
+        VISION_IMAGE_MAX_EDGE=1536, VISION_IMAGE_FORMAT='JPEG', VISION_IMAGE_QUALITY=85,
+        VISION_IMAGE_GRAYSCALE=False, VISION_PREPROCESS_CONCURRENCY=2,
+    )
+
+    height = int((args.megapixels * 1e6 * 3 / 4) ** 0.5)
+    photo = make_photo(height * 4 // 3, height)
+
+    rows = []
+    for kind in ('in_memory', 'temporary_file'):
+        for label, build in (('legacy', legacy_payload),
+                             ('buffered', buffered_payload),
+                             ('preprocessed', preprocessed_payload)):
+            upload = make_upload(kind, photo)
+            peak, url_length = peak_mb(build, upload)
+            upload.close()
+            rows.append({
+                'upload': kind,
+                'path': label,
+                'peak_heap_mb': peak,
+                'payload_mb': round(url_length / 2 ** 20, 2),
+            })
+
+    print(json.dumps({'input_mb': round(len(photo) / 2 ** 20, 2), 'results': rows}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,284 @@
+"""
+Offline throughput of the analyze pipeline with OpenAI and Sheets stubbed.
+
+Uploads a corpus of card images to ``/analyze/`` (or ``/analyze/async/``
+with ``--asgi``) at each combination of ``--concurrency`` (requests in
+flight) and ``--batch-sizes`` (images per request), then drains the
+outbox into the stub sheet. For every run it reports cards/sec,
+per-request latency percentiles, peak memory, errors and the number of
+calls each upstream route received, as JSON.
+
+The stub answers completions from a recording: by default distinct
+synthetic contacts, one per call, or ``--replay`` a file captured with
+``--record``. To capture real replies, pass ``--upstream
+https://api.openai.com/v1`` with OPENAI_API_KEY set; completions are then
+forwarded and recorded.
+
+Images are made unique per request so the vision cache and single-flight
+never answer for the stubs. The full pipeline runs as configured
+(preprocessing, optional card detection); ``--set NAME=VALUE`` overrides
+settings.
+
+With ``--baseline`` a previous output is compared run by run, and the
+script exits with status 1 if cards/sec dropped or p95 latency grew by
+more than ``--tolerance``.
+
+Run from ``src/``::
+
+    python -m benchmarks.bench_pipeline --concurrency 1,4,16 --batch-sizes 1,4 --output pipeline.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import resource
+import sys
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+
+from .common import setup_django, summarize, use_temp_database
+from .corpus import build_corpus, contact_recording, load_corpus
+from .stubs import load_recording, start_stub_server
+
+
+def parse_sizes(value):
+    return [int(size) for size in value.split(',') if size.strip()]
+
+
+def make_requests(corpus, count, batch_size, tag):
+    """``count`` requests of ``batch_size`` images each, cycling through the corpus"""
+    requests = []
+    for index in range(count):
+        files = []
+        for offset in range(batch_size):
+            item = corpus[(index * batch_size + offset) % len(corpus)]
+            # Decoders ignore bytes after the end of the image, and the suffix
+            # makes every upload a distinct image to the caches
+            data = item['data'] + b'%s-%d-%d' % (tag, index, offset)
+            files.append(('images', (item['name'], data, item['mime'])))
+        requests.append(files)
+    return requests
+
+
+def count_errors(response):
+    """Failed requests count once; otherwise each image that reported an error"""
+    if response.status_code != 200:
+        return 1
+    return sum(1 for entry in response.json().get('results', []) if 'error' in entry)
+
+
+def count_cards(response):
+    if response.status_code != 200:
+        return 0
+    return sum(1 for entry in response.json().get('results', []) if 'error' not in entry)
+
+
+def run_wsgi(requests, concurrency):
+    import httpx
+    from django.core.wsgi import get_wsgi_application
+
+    client = httpx.Client(transport=httpx.WSGITransport(app=get_wsgi_application()),
+                          base_url='http://localhost', timeout=None)
+
+    def send(files):
+        started = time.perf_counter()
+        response = client.post('/analyze/', files=files)
+        return time.perf_counter() - started, response
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return list(executor.map(send, requests))
+
+
+def run_asgi(requests, concurrency):
+    import httpx
+    from django.core.asgi import get_asgi_application
+
+    app = get_asgi_application()
+
+    async def main():
+        slots = asyncio.Semaphore(concurrency)
+        async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app),
+                                     base_url='http://localhost', timeout=None) as client:
+            async def send(files):
+                async with slots:
+                    started = time.perf_counter()
+                    response = await client.post('/analyze/async/', files=files)
+                    return time.perf_counter() - started, response
+
+            return await asyncio.gather(*(send(files) for files in requests))
+
+    return asyncio.run(main())
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def measure(server, corpus, concurrency, batch_size, count, asgi, trace_memory):
+    from cards.utils.outbox import drain_outbox
+
+    requests = make_requests(corpus, count, batch_size, b'c%d-b%d' % (concurrency, batch_size))
+    calls_before = dict(server.state.calls)
+    if trace_memory:
+        tracemalloc.reset_peak()
+
+    started = time.perf_counter()
+    outcomes = (run_asgi if asgi else run_wsgi)(requests, concurrency)
+    elapsed = time.perf_counter() - started
+
+    sync_started = time.perf_counter()
+    synced = drain_outbox()
+    sync_elapsed = time.perf_counter() - sync_started
+
+    responses = [response for _, response in outcomes]
+    cards = sum(count_cards(response) for response in responses)
+    calls = {
+        route: total - calls_before.get(route, 0)
+        for route, total in sorted(server.state.calls.items())
+        if total != calls_before.get(route, 0)
+    }
+    result = {
+        'concurrency': concurrency,
+        'batch_size': batch_size,
+        'requests': len(requests),
+        'images': len(requests) * batch_size,
+        'cards': cards,
+        'errors': sum(count_errors(response) for response in responses),
+        'elapsed_s': round(elapsed, 3),
+        'cards_per_s': round(cards / elapsed, 2),
+        'images_per_s': round(len(requests) * batch_size / elapsed, 2),
+        'latency': summarize([seconds for seconds, _ in outcomes]),
+        'sheet_sync': {'cards': synced, 'elapsed_s': round(sync_elapsed, 3)},
+        'upstream_calls': calls,
+        # Process-wide high-water mark, so it never goes down between runs
+        'peak_rss_mb': peak_rss_mb(),
+    }
+    if trace_memory:
+        result['peak_traced_mb'] = round(tracemalloc.get_traced_memory()[1] / (1024 * 1024), 1)
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """Runs whose throughput or p95 latency regressed against a baseline output"""
+    previous = {(run['concurrency'], run['batch_size']): run for run in baseline['runs']}
+    regressions = []
+    for run in results:
+        before = previous.get((run['concurrency'], run['batch_size']))
+        if not before:
+            continue
+        checks = (
+            ('cards_per_s', before['cards_per_s'], run['cards_per_s'],
+             run['cards_per_s'] < before['cards_per_s'] * (1 - tolerance)),
+            ('p95_ms', before['latency']['p95_ms'], run['latency']['p95_ms'],
+             run['latency']['p95_ms'] > before['latency']['p95_ms'] * (1 + tolerance)),
+        )
+        for metric, old, new, regressed in checks:
+            if regressed:
+                regressions.append({'concurrency': run['concurrency'], 'batch_size': run['batch_size'],
+                                    'metric': metric, 'baseline': old, 'current': new})
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--concurrency', type=parse_sizes, default=[1, 4, 16],
+                        help="Comma-separated requests in flight, e.g. 1,4,16")
+    parser.add_argument('--batch-sizes', type=parse_sizes, default=[1, 4],
+                        help="Comma-separated images per request, e.g. 1,4")
+    parser.add_argument('--requests', type=int, default=32, help="Requests per run")
+    parser.add_argument('--latency', type=float, default=0.3, help="Stub upstream latency in seconds")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Share of upstream calls answered 503")
+    parser.add_argument('--rate-limit', type=int, help="Upstream requests per second per route before 429s")
+    parser.add_argument('--asgi', action='store_true', help="Drive the async view under ASGI")
+    parser.add_argument('--corpus', help="Directory written by benchmarks.corpus (default: generate one)")
+    parser.add_argument('--count', type=int, default=20, help="Images in a generated corpus")
+    parser.add_argument('--edge', type=int, default=3000, help="Longest side of generated photos")
+    parser.add_argument('--replay', help="Recorded replies to serve (default: the corpus's cards)")
+    parser.add_argument('--record', help="Write the replies served during the run to this file")
+    parser.add_argument('--upstream', help="Forward completions to this API base URL and record them")
+    parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE',
+                        help="Override a setting, e.g. --set CARD_DETECTION_ENABLED=True")
+    parser.add_argument('--trace-memory', action='store_true',
+                        help="Also report the Python heap peak per run (tracemalloc; slows the run)")
+    parser.add_argument('--output', help="Also write the JSON results to this file")
+    parser.add_argument('--baseline', help="Previous output to check for regressions")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="Allowed regression as a fraction")
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.corpus) if args.corpus else build_corpus(args.count, edge=args.edge)
+    if args.upstream:
+        replay = None
+    elif args.replay:
+        replay = load_recording(args.replay)
+    else:
+        # Enough for every call to store a new contact (multi-card photos
+        # take one call per card)
+        calls = args.requests * sum(args.batch_sizes) * len(args.concurrency) * 3
+        replay = contact_recording(calls)
+
+    server = start_stub_server(
+        latency=args.latency, error_rate=args.error_rate, rate_limit=args.rate_limit,
+        record=bool(args.record), replay=replay,
+        upstream=args.upstream, upstream_key=os.environ.get('OPENAI_API_KEY'),
+    )
+    largest = max(args.concurrency) * max(args.batch_sizes)
+    overrides = {
+        # Drained after each run instead, so its cost is reported on its own
+        'SHEETS_OUTBOX_WORKER': 'False',
+        'SHEETS_OUTBOX_CRON': 'True',
+        'VISION_CACHE_BACKEND': 'django.core.cache.backends.dummy.DummyCache',
+        'OPENAI_MAX_CONNECTIONS': largest,
+        'OPENAI_ASYNC_MAX_CONNECTIONS': largest,
+    }
+    overrides.update(override.split('=', 1) for override in args.set)
+    setup_django(server.url, **overrides)
+    use_temp_database()
+
+    if args.trace_memory:
+        tracemalloc.start()
+    runs = [
+        measure(server, corpus, concurrency, batch_size, args.requests, args.asgi, args.trace_memory)
+        for batch_size in args.batch_sizes
+        for concurrency in args.concurrency
+    ]
+
+    output = {
+        'config': {
+            'view': 'analyze_card_async' if args.asgi else 'analyze_card',
+            'requests_per_run': args.requests,
+            'corpus_images': len(corpus),
+            'corpus_bytes': sum(len(item['data']) for item in corpus),
+            'upstream_latency_s': args.latency,
+            'error_rate': args.error_rate,
+            'rate_limit': args.rate_limit,
+            'replies': 'upstream' if args.upstream else args.replay or 'synthetic',
+            'settings': {name: str(value) for name, value in overrides.items()},
+        },
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+        },
+        'runs': runs,
+    }
+    if args.record:
+        output['recorded'] = server.state.save_recording(args.record)
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            output['regressions'] = compare(runs, json.load(f), args.tolerance)
+
+    text = json.dumps(output, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text + '\n')
+    print(text)
+    if output.get('regressions'):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
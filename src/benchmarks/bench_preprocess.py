@@ -0,0 +1,82 @@
+"""
+Bytes sent and time spent per image for different preprocessing settings.
+
+Run from ``src/``::
+
+    python -m benchmarks.bench_preprocess [--image photo.jpg] [--repeat 3]
+"""
+import argparse
+import base64
+import io
+import json
+import time
+
+from .common import SRC_DIR, estimate_vision_tokens, make_photo
+
+SETTINGS = [
+    {'label': 'original', 'preprocess': False},
+    {'label': 'jpeg-2048', 'max_edge': 2048, 'image_format': 'JPEG', 'quality': 85},
+    {'label': 'jpeg-1536', 'max_edge': 1536, 'image_format': 'JPEG', 'quality': 85},
+    {'label': 'jpeg-1024', 'max_edge': 1024, 'image_format': 'JPEG', 'quality': 80},
+    {'label': 'webp-1536', 'max_edge': 1536, 'image_format': 'WEBP', 'quality': 80},
+    {'label': 'jpeg-1536-gray', 'max_edge': 1536, 'image_format': 'JPEG', 'quality': 85, 'grayscale': True},
+    {'label': 'jpeg-768', 'max_edge': 768, 'image_format': 'JPEG', 'quality': 80},
+]
+
+
+def measure(image_bytes, options, repeat):
+    from PIL import Image
+    from cards.utils.image_preprocess import preprocess_image
+
+    options = dict(options)
+    label = options.pop('label')
+    preprocess = options.pop('preprocess', True)
+    options.setdefault('grayscale', False)
+
+    preprocess_times, encode_times = [], []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        data = preprocess_image(image_bytes, **options)[0] if preprocess else image_bytes
+        preprocess_times.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        encoded = base64.b64encode(data).decode('utf-8')
+        encode_times.append(time.perf_counter() - started)
+
+    with Image.open(io.BytesIO(data)) as img:
+        width, height = img.size
+    return {
+        'label': label,
+        'size': f'{width}x{height}',
+        'bytes': len(data),
+        'base64_bytes': len(encoded),
+        'preprocess_ms': round(min(preprocess_times) * 1000, 2),
+        'encode_ms': round(min(encode_times) * 1000, 2),
+        'tokens_high_detail': estimate_vision_tokens(width, height, 'high'),
+        'tokens_low_detail': estimate_vision_tokens(width, height, 'low'),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--image', help="Photo to use instead of a synthetic 12 MP one")
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    import sys
+    sys.path.insert(0, str(SRC_DIR))
+    from django.conf import settings
+    settings.configure()
+
+    if args.image:
+        with open(args.image, 'rb') as f:
+            image_bytes = f.read()
+    else:
+        image_bytes = make_photo()
+
+    rows = [measure(image_bytes, options, args.repeat) for options in SETTINGS]
+    print(json.dumps({'input_bytes': len(image_bytes), 'results': rows}, indent=2))
+
+
+if __name__ == '__main__':
+    main()
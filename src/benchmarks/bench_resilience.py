@@ -0,0 +1,104 @@
+"""
+Upstream resilience under injected faults: image analyses with and without
+the shared rate limiter, retries and circuit breaker.
+
+Two scenarios run against the stub server. In ``burst`` the stub allows
+``--stub-rate`` requests per second and answers 429 beyond that. In
+``outage`` every request fails with a 503. For each, a burst of analyses is
+sent from ``--concurrency`` threads with the limiter effectively off (one
+attempt, no breaker) and then with it on, and the script reports how many
+analyses failed and how many requests reached the upstream.
+
+Run from ``src/``::
+
+    python -m benchmarks.bench_resilience --images 200 --concurrency 20
+"""
+import argparse
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .common import make_photo, setup_django
+from .stubs import start_stub_server
+
+UNPROTECTED = {
+    'rate': 10000, 'burst': 10000, 'max_attempts': 1, 'base_backoff': 0, 'max_backoff': 0,
+    'max_wait': 60, 'circuit_threshold': 10 ** 9, 'circuit_reset': 0,
+}
+
+
+def run_burst(analyze, images, concurrency):
+    from django.core.files.uploadedfile import SimpleUploadedFile
+
+    def one(index):
+        upload = SimpleUploadedFile(f'card-{index}.jpg', images[index], content_type='image/jpeg')
+        try:
+            analyze(upload)
+            return None
+        except Exception as e:
+            return type(e).__name__
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        outcomes = list(pool.map(one, range(len(images))))
+    errors = {}
+    for outcome in outcomes:
+        if outcome:
+            errors[outcome] = errors.get(outcome, 0) + 1
+    return {
+        'seconds': round(time.perf_counter() - started, 2),
+        'failed': sum(errors.values()),
+        'errors': errors,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--images', type=int, default=200)
+    parser.add_argument('--concurrency', type=int, default=20)
+    parser.add_argument('--stub-rate', type=int, default=25, help="Requests per second the stub accepts")
+    parser.add_argument('--latency', type=float, default=0.05, help="Stub response time in seconds")
+    args = parser.parse_args()
+
+    server = start_stub_server(latency=args.latency)
+    setup_django(server.url, VISION_PREPROCESS_ENABLED='False',
+                 OPENAI_RATE_LIMIT=50, OPENAI_BASE_BACKOFF=0.1, OPENAI_CIRCUIT_RESET=5)
+
+    from django.conf import settings
+    from cards.utils.openai_helper import analyze_image
+    from cards.utils.resilience import reset_upstreams, upstream_stats
+
+    protected = dict(settings.UPSTREAM_LIMITS['openai'])
+    photo = make_photo(640, 400)
+    scenarios = {
+        'burst': {'rate_limit': args.stub_rate, 'error_rate': 0.0},
+        'outage': {'rate_limit': None, 'error_rate': 1.0},
+    }
+
+    results = {}
+    run = 0
+    for scenario, faults in scenarios.items():
+        for mode, limits in (('unprotected', UNPROTECTED), ('protected', protected)):
+            settings.UPSTREAM_LIMITS['openai'] = limits
+            reset_upstreams()
+            server.state.rate_limit = faults['rate_limit']
+            server.state.error_rate = faults['error_rate']
+            server.state.windows.clear()
+            server.state.calls.clear()
+
+            # Distinct bytes per run, so the vision cache never answers
+            run += 1
+            images = [photo + b'%d-%d' % (run, index) for index in range(args.images)]
+            result = run_burst(analyze_image, images, args.concurrency)
+            result['upstream_requests'] = server.state.calls['chat.completions']
+            result['upstream_errors'] = {
+                route: count for route, count in server.state.calls.items() if route.count('.') > 1
+            }
+            result['limiter'] = upstream_stats().get('openai')
+            results[f'{scenario}/{mode}'] = result
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
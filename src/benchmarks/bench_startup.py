@@ -0,0 +1,130 @@
+"""
+Cold start: time from a fresh interpreter to Django being ready, to the
+first page and to the first card analysis.
+
+Each run starts a new Python process, as a serverless platform does on a
+cold start, and reports:
+
+- ``setup_ms``: ``django.setup()`` plus loading the WSGI app and URLconf
+- ``first_page_ms``: the first ``GET /`` through the WSGI app
+- ``first_analyze_ms``: the first ``POST /analyze/`` of one photo against
+  the stub server, which loads the vision client on first use
+
+It also lists which heavy SDKs were imported by the end of setup. Point
+``--src`` at another checkout (e.g. a ``git worktree`` of an older commit)
+to compare.
+
+Run from ``src/``::
+
+    python -m benchmarks.bench_startup --runs 5
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+from .common import SRC_DIR, make_photo, write_service_account_key
+from .stubs import start_stub_server
+
+HEAVY_MODULES = ['openai', 'httpx', 'googleapiclient', 'google.oauth2', 'numpy', 'PIL']
+
+CHILD = r'''
+import io, json, os, sys, time
+from wsgiref.util import setup_testing_defaults
+
+started = time.perf_counter()
+import django
+django.setup()
+from django.core.wsgi import get_wsgi_application
+from django.urls import get_resolver
+app = get_wsgi_application()
+get_resolver().url_patterns
+setup = time.perf_counter() - started
+loaded = [name for name in json.loads(os.environ['BENCH_HEAVY']) if name in sys.modules]
+
+def call(method, path, body=b'', content_type=''):
+    environ = {'REQUEST_METHOD': method, 'PATH_INFO': path, 'HTTP_HOST': 'localhost',
+               'CONTENT_LENGTH': str(len(body)), 'CONTENT_TYPE': content_type,
+               'wsgi.input': io.BytesIO(body)}
+    setup_testing_defaults(environ)
+    status = []
+    b''.join(app(environ, lambda s, h, e=None: status.append(s)))
+    return status[0]
+
+started = time.perf_counter()
+page_status = call('GET', '/')
+first_page = time.perf_counter() - started
+
+with open(os.environ['BENCH_PHOTO'], 'rb') as f:
+    photo = f.read()
+boundary = 'benchboundary'
+body = (f'--{boundary}\r\nContent-Disposition: form-data; name="images"; filename="card.jpg"\r\n'
+        f'Content-Type: image/jpeg\r\n\r\n').encode() + photo + f'\r\n--{boundary}--\r\n'.encode()
+started = time.perf_counter()
+analyze_status = call('POST', '/analyze/', body, f'multipart/form-data; boundary={boundary}')
+first_analyze = time.perf_counter() - started
+
+print(json.dumps({'setup': setup, 'first_page': first_page, 'first_analyze': first_analyze,
+                  'statuses': [page_status, analyze_status], 'loaded_at_setup': loaded}))
+'''
+
+
+def run_once(src, env):
+    output = subprocess.run(
+        [sys.executable, '-c', CHILD], cwd=src, env=env,
+        capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--src', default=str(SRC_DIR), help="Source tree to start (default: this one)")
+    args = parser.parse_args()
+
+    server = start_stub_server()
+    photo = tempfile.NamedTemporaryFile(suffix='.jpg', delete=False)
+    photo.write(make_photo(640, 400))
+    photo.close()
+    # Settings that only swap in a throwaway database, migrated up front so
+    # the analyze request can store its cards
+    settings_dir = tempfile.mkdtemp(prefix='bench-startup-')
+    with open(os.path.join(settings_dir, 'bench_settings.py'), 'w') as f:
+        f.write("from app.settings import *\n"
+                f"DATABASES['default']['NAME'] = {os.path.join(settings_dir, 'db.sqlite3')!r}\n")
+
+    env = dict(
+        os.environ,
+        PYTHONPATH=os.pathsep.join([settings_dir, args.src]),
+        DJANGO_SETTINGS_MODULE='bench_settings',
+        SECRET_KEY='benchmark',
+        OPENAI_API_KEY='sk-benchmark',
+        OPENAI_BASE_URL=f'{server.url}/v1',
+        GOOGLE_SHEETS_API_ENDPOINT=server.url,
+        GOOGLE_SHEET_ID='bench-sheet',
+        GOOGLE_APPLICATION_CREDENTIALS=write_service_account_key(f'{server.url}/token'),
+        SHEETS_OUTBOX_WORKER='False',
+        SHEETS_OUTBOX_CRON='True',
+        LOG_LEVEL='WARNING',
+        LOG_FILE='',
+        BENCH_PHOTO=photo.name,
+        BENCH_HEAVY=json.dumps(HEAVY_MODULES),
+    )
+    subprocess.run([sys.executable, 'manage.py', 'migrate', '--verbosity', '0'], cwd=args.src, env=env, check=True)
+
+    runs = [run_once(args.src, env) for _ in range(args.runs)]
+    results = {
+        f'{name}_ms': round(statistics.median(run[name] for run in runs) * 1000, 1)
+        for name in ('setup', 'first_page', 'first_analyze')
+    }
+    results['statuses'] = runs[-1]['statuses']
+    results['loaded_at_setup'] = runs[-1]['loaded_at_setup']
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
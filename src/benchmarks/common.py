@@ -0,0 +1,134 @@
+"""
+Shared helpers for the benchmark scripts: Django bootstrap against stub
+servers, throwaway service-account keys and latency summaries.
+"""
+import json
+import os
+import statistics
+import sys
+import tempfile
+from pathlib import Path
+
+SRC_DIR = Path(__file__).resolve().parent.parent
+
+
+def write_service_account_key(token_uri: str) -> str:
+    """Write a throwaway service-account key whose token endpoint is a stub"""
+    import rsa
+
+    _, private_key = rsa.newkeys(1024)
+    key = {
+        'type': 'service_account',
+        'project_id': 'bench',
+        'private_key_id': 'bench',
+        'private_key': private_key.save_pkcs1().decode('ascii'),
+        'client_email': 'bench@bench.iam.gserviceaccount.com',
+        'client_id': '0',
+        'token_uri': token_uri,
+    }
+    handle, path = tempfile.mkstemp(suffix='.json', prefix='bench-sa-')
+    with os.fdopen(handle, 'w') as f:
+        json.dump(key, f)
+    return path
+
+
+def setup_django(stub_url: str, **overrides) -> None:
+    """Configure settings to talk to a stub server and initialise Django"""
+    if str(SRC_DIR) not in sys.path:
+        sys.path.insert(0, str(SRC_DIR))
+
+    env = {
+        'DJANGO_SETTINGS_MODULE': 'app.settings',
+        'SECRET_KEY': 'benchmark',
+        'OPENAI_API_KEY': 'sk-benchmark',
+        'OPENAI_BASE_URL': f'{stub_url}/v1',
+        'GOOGLE_SHEETS_API_ENDPOINT': stub_url,
+        'GOOGLE_SHEET_ID': 'bench-sheet',
+        'GOOGLE_APPLICATION_CREDENTIALS': write_service_account_key(f'{stub_url}/token'),
+    }
+    env.update({key: str(value) for key, value in overrides.items()})
+    os.environ.update(env)
+
+    import django
+    django.setup()
+
+    import logging
+    logging.disable(logging.CRITICAL)
+
+
+def use_temp_database() -> str:
+    """Point Django at a fresh SQLite file and migrate it.
+
+    Call after ``setup_django`` and before anything touches the database.
+    """
+    from django.conf import settings
+    from django.core.management import call_command
+
+    handle, path = tempfile.mkstemp(suffix='.sqlite3', prefix='bench-db-')
+    os.close(handle)
+    settings.DATABASES['default']['NAME'] = path
+    call_command('migrate', verbosity=0)
+    return path
+
+
+def summarize(samples) -> dict:
+    """Summarize a list of durations in seconds as milliseconds"""
+    ordered = sorted(samples)
+    if not ordered:
+        return {}
+
+    def pct(p):
+        index = min(len(ordered) - 1, round(p / 100 * (len(ordered) - 1)))
+        return round(ordered[index] * 1000, 3)
+
+    return {
+        'count': len(ordered),
+        'mean_ms': round(statistics.fmean(ordered) * 1000, 3),
+        'p50_ms': pct(50),
+        'p95_ms': pct(95),
+        'p99_ms': pct(99),
+        'max_ms': round(ordered[-1] * 1000, 3),
+    }
+
+
+def make_photo(width: int = 4000, height: int = 3000, seed: int = 0) -> bytes:
+    """Synthesize a phone-camera-like JPEG of a card on a table.
+
+    Sensor noise keeps it from compressing unrealistically well.
+    """
+    import io
+    import random
+    from PIL import Image, ImageDraw
+
+    rng = random.Random(seed)
+    table = Image.linear_gradient('L').resize((width, height)).convert('RGB')
+    noise = Image.effect_noise((width, height), 24).convert('RGB')
+    img = Image.blend(table, noise, 0.35)
+
+    draw = ImageDraw.Draw(img)
+    left, top = width // 5, height // 4
+    right, bottom = left + width * 3 // 5, top + height // 2
+    draw.rectangle([left, top, right, bottom], fill=(246, 244, 238))
+    line_height = (bottom - top) // 12
+    for line in range(1, 10):
+        y = top + line * line_height
+        length = rng.randint((right - left) // 4, (right - left) * 3 // 4)
+        draw.rectangle([left + 80, y, left + 80 + length, y + line_height // 2], fill=(30, 30, 40))
+
+    output = io.BytesIO()
+    img.save(output, format='JPEG', quality=92)
+    return output.getvalue()
+
+
+def estimate_vision_tokens(width: int, height: int, detail: str = 'high') -> int:
+    """Approximate image input tokens using OpenAI's published tiling rule"""
+    import math
+
+    if detail == 'low':
+        return 85
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    tiles = math.ceil(width / 512) * math.ceil(height / 512)
+    return 85 + 170 * tiles
@@ -0,0 +1,187 @@
+"""
+A corpus of synthetic business-card images with known contents.
+
+Cards are drawn with real text (name, title, company, phone, email, website
+and address) in several shapes the app receives:
+
+* ``scan``: a flat, tightly cropped card, as from a scanner app
+* ``photo``: a card on a noisy table, as from a phone camera
+* ``rotated``: a photo stored sideways with an EXIF orientation tag
+* ``multi``: two or three cards in one photo
+* ``screenshot``: a PNG with a transparent margin
+
+Every image comes with the cards drawn on it, and ``corpus_recording``
+turns those into chat completion replies for the stub server.
+``contact_recording`` makes any number of distinct replies, so a long
+offline run stores new contacts instead of merging repeats of one card.
+
+Write a corpus to disk (images, ``manifest.json`` and ``recording.jsonl``)
+from ``src/``::
+
+    python -m benchmarks.corpus --out /tmp/card-corpus --count 50
+"""
+import argparse
+import io
+import json
+import os
+import random
+
+from .bench_contacts import make_contacts
+from .stubs import completion_body
+
+KINDS = ('scan', 'photo', 'rotated', 'multi', 'screenshot')
+MIME_TYPES = {'JPEG': 'image/jpeg', 'PNG': 'image/png'}
+
+# EXIF tag holding the orientation, and the value for "rotate 90 degrees clockwise to view"
+ORIENTATION_TAG = 0x0112
+ROTATED_90 = 6
+
+
+def draw_card(card, width, height, rng):
+    """Render one card's fields onto a light card-sized image"""
+    from PIL import Image, ImageDraw, ImageFont
+
+    background = tuple(rng.randint(236, 252) for _ in range(3))
+    ink = tuple(rng.randint(10, 60) for _ in range(3))
+    img = Image.new('RGB', (width, height), background)
+    draw = ImageDraw.Draw(img)
+
+    margin = width // 14
+    large = ImageFont.load_default(max(12, height // 10))
+    small = ImageFont.load_default(max(10, height // 18))
+    draw.text((margin, margin), card['name'], font=large, fill=ink)
+    y = margin + height // 7
+    draw.text((margin, y), card['job_title'], font=small, fill=ink)
+    y += height // 11
+    draw.text((margin, y), card['business_name'], font=small, fill=ink)
+    y = height // 2
+    for label, field in (('Tel', 'contact_number'), ('Email', 'email'), ('Web', 'website')):
+        draw.text((margin, y), f"{label}: {card[field]}", font=small, fill=ink)
+        y += height // 10
+    draw.text((margin, y), card['address'], font=small, fill=ink)
+    return img
+
+
+def _table(width, height, rng):
+    """A gradient table top with sensor noise, so photos compress realistically"""
+    from PIL import Image
+
+    table = Image.linear_gradient('L').resize((width, height)).convert('RGB')
+    noise = Image.effect_noise((width, height), rng.randint(16, 32)).convert('RGB')
+    return Image.blend(table, noise, 0.35)
+
+
+def _encode(img, image_format, **options):
+    output = io.BytesIO()
+    img.save(output, format=image_format, **options)
+    return output.getvalue()
+
+
+def make_image(kind, cards, edge=3000, seed=0):
+    """Draw ``cards`` as an image of the given kind; returns ``(bytes, mime type)``.
+
+    ``edge`` is the longest side of photos; scans and screenshots are card sized.
+    """
+    rng = random.Random(seed)
+    if kind in ('scan', 'screenshot'):
+        card = draw_card(cards[0], 1050, 600, rng)
+        if kind == 'scan':
+            return _encode(card, 'JPEG', quality=90), MIME_TYPES['JPEG']
+        canvas = card.convert('RGBA').crop((-40, -40, card.width + 40, card.height + 40))
+        return _encode(canvas, 'PNG'), MIME_TYPES['PNG']
+
+    width, height = edge, edge * 3 // 4
+    img = _table(width, height, rng)
+    slots = len(cards)
+    card_width = min(width * 3 // 5, width // slots - width // 20)
+    card_height = card_width * 4 // 7
+    for index, card in enumerate(cards):
+        left = width // slots * index + (width // slots - card_width) // 2
+        top = (height - card_height) // 2 + rng.randint(-height // 10, height // 10)
+        img.paste(draw_card(card, card_width, card_height, rng), (left, top))
+
+    if kind == 'rotated':
+        # Stored sideways; viewers (and the app) rotate it back from the EXIF tag
+        exif = img.getexif()
+        exif[ORIENTATION_TAG] = ROTATED_90
+        return _encode(img.rotate(90, expand=True), 'JPEG', quality=92, exif=exif), MIME_TYPES['JPEG']
+    return _encode(img, 'JPEG', quality=92), MIME_TYPES['JPEG']
+
+
+def build_corpus(count=20, kinds=KINDS, edge=3000, seed=0):
+    """Generate ``count`` images cycling through ``kinds``.
+
+    Returns a list of dicts with the image ``name``, ``data``, ``mime`` type,
+    ``kind`` and the ``cards`` drawn on it.
+    """
+    contacts = iter(make_contacts(count * 3, seed=seed))
+    corpus = []
+    for index in range(count):
+        kind = kinds[index % len(kinds)]
+        per_image = random.Random(seed + index).randint(2, 3) if kind == 'multi' else 1
+        cards = [next(contacts) for _ in range(per_image)]
+        data, mime = make_image(kind, cards, edge=edge, seed=seed + index)
+        extension = 'png' if mime == MIME_TYPES['PNG'] else 'jpg'
+        corpus.append({'name': f'{index:04d}-{kind}.{extension}', 'data': data, 'mime': mime,
+                       'kind': kind, 'cards': cards})
+    return corpus
+
+
+def _reply(card):
+    return {'route': 'chat.completions', 'status': 200, 'body': completion_body({'cards': [card]})}
+
+
+def corpus_recording(corpus):
+    """Chat completion replies for the cards in a corpus, one card per reply"""
+    return [_reply(card) for item in corpus for card in item['cards']]
+
+
+def contact_recording(count, seed=0):
+    """Replies with ``count`` distinct contacts, so none merge when stored"""
+    return [_reply(card) for card in make_contacts(count, seed=seed)]
+
+
+def write_corpus(corpus, directory):
+    """Write images, ``manifest.json`` and ``recording.jsonl`` to a directory"""
+    os.makedirs(directory, exist_ok=True)
+    for item in corpus:
+        with open(os.path.join(directory, item['name']), 'wb') as f:
+            f.write(item['data'])
+    manifest = [{key: value for key, value in item.items() if key != 'data'} for item in corpus]
+    with open(os.path.join(directory, 'manifest.json'), 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+    with open(os.path.join(directory, 'recording.jsonl'), 'w', encoding='utf-8') as f:
+        for entry in corpus_recording(corpus):
+            f.write(json.dumps(entry) + '\n')
+
+
+def load_corpus(directory):
+    """Read a corpus written by ``write_corpus``"""
+    with open(os.path.join(directory, 'manifest.json'), encoding='utf-8') as f:
+        manifest = json.load(f)
+    for item in manifest:
+        with open(os.path.join(directory, item['name']), 'rb') as f:
+            item['data'] = f.read()
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--out', required=True, help="Directory to write the corpus to")
+    parser.add_argument('--count', type=int, default=50)
+    parser.add_argument('--edge', type=int, default=3000, help="Longest side of photos in pixels")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    corpus = build_corpus(args.count, edge=args.edge, seed=args.seed)
+    write_corpus(corpus, args.out)
+    print(json.dumps({
+        'directory': args.out,
+        'images': len(corpus),
+        'cards': sum(len(item['cards']) for item in corpus),
+        'bytes': sum(len(item['data']) for item in corpus),
+    }, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,490 @@
+"""
+Local stub servers standing in for the OpenAI and Google Sheets APIs.
+
+Besides chat completions this covers the Batch API flow used by
+``manage.py import_cards``: file upload, batch create/retrieve and output
+file download. Batches advance one status per retrieve
+(validating -> in_progress -> completed) so pollers are exercised.
+
+Only the endpoints the app actually calls are implemented, with just enough
+of each response for the SDKs to parse. Every request is counted per route
+so benchmarks can report upstream call volume.
+
+Faults can be injected to exercise retries and circuit breakers: scripted
+statuses per route (``StubState.inject``), a random ``error_rate``, and a
+per-second ``rate_limit`` that answers 429 with Retry-After and reports
+x-ratelimit-* headers on completions like the OpenAI API does.
+
+Responses can be recorded and replayed. With ``record=True`` every reply to
+chat completions and the Sheets values routes is kept in
+``StubState.recorded`` (``save_recording`` writes it as JSON lines); with
+``upstream`` set, completions are forwarded to a real OpenAI-compatible
+endpoint first, so real replies can be captured once and replayed offline.
+``replay`` takes such recordings and serves them per route, in order and
+round-robin, in place of the built-in replies.
+"""
+import json
+import random
+import re
+import threading
+import time
+import uuid
+import urllib.error
+import urllib.request
+from collections import Counter, defaultdict, deque
+from email.parser import BytesParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+
+SAMPLE_CARD = {
+    'name': 'Jane Doe',
+    'business_name': 'Acme Corp',
+    'job_title': 'Head of Sales',
+    'contact_number': '+1 555 0100',
+    'email': 'jane@acme.example',
+    'website': 'https://acme.example',
+    'address': '1 Main Street, Springfield',
+}
+
+A1_RE = re.compile(r'^(?:[^!]+!)?(?P<c1>[A-Z]+)(?P<r1>\d*)(?::(?P<c2>[A-Z]+)(?P<r2>\d*))?$')
+APPEND_RE = re.compile(r'^/v4/spreadsheets/(?P<sheet>[^/]+)/values/(?P<range>[^/?]+):append')
+VALUES_RE = re.compile(r'^/v4/spreadsheets/(?P<sheet>[^/]+)/values/(?P<range>[^/?:]+)')
+
+
+def load_recording(path: str):
+    """Read recorded replies written by ``StubState.save_recording``"""
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def completion_body(content, model: str = 'stub', usage=None):
+    """A chat completion whose message is ``content`` as JSON"""
+    return {
+        'id': 'chatcmpl-stub',
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': model,
+        'choices': [{
+            'index': 0,
+            'finish_reason': 'stop',
+            'message': {'role': 'assistant', 'content': json.dumps(content)},
+        }],
+        'usage': usage or {'prompt_tokens': 850, 'completion_tokens': 90, 'total_tokens': 940},
+    }
+
+
+def _column_index(letters: str) -> int:
+    index = 0
+    for letter in letters:
+        index = index * 26 + ord(letter) - 64
+    return index - 1
+
+
+def slice_range(rows, a1_range: str):
+    """Return the part of ``rows`` covered by an A1 range like ``I2:I``"""
+    match = A1_RE.match(unquote(a1_range))
+    if not match:
+        return [list(row) for row in rows]
+    first_col = _column_index(match.group('c1'))
+    last_col = _column_index(match.group('c2') or match.group('c1'))
+    first_row = int(match.group('r1') or 1) - 1
+    last_row = int(match.group('r2')) if match.group('r2') else len(rows)
+    return [list(row[first_col:last_col + 1]) for row in rows[first_row:last_row]]
+
+
+def value_range(a1_range: str, values):
+    """A ValueRange as the Sheets API returns it: without ``values`` when empty"""
+    if not any(values):
+        return {'range': a1_range}
+    return {'range': a1_range, 'values': values}
+
+
+def write_range(rows, a1_range: str, values) -> None:
+    """Write ``values`` into ``rows`` at an A1 range, growing rows as needed"""
+    match = A1_RE.match(unquote(a1_range))
+    first_col = _column_index(match.group('c1'))
+    first_row = int(match.group('r1') or 1) - 1
+    for offset, new_values in enumerate(values):
+        while len(rows) <= first_row + offset:
+            rows.append([])
+        row = list(rows[first_row + offset])
+        row += [''] * (first_col + len(new_values) - len(row))
+        row[first_col:first_col + len(new_values)] = new_values
+        rows[first_row + offset] = row
+
+
+class StubState:
+    """Shared configuration and counters for one stub server"""
+
+    def __init__(self, latency: float = 0.0, error_rate: float = 0.0, error_status: int = 503,
+                 rate_limit: int = None, record: bool = False, replay=None,
+                 upstream: str = None, upstream_key: str = None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.rate_limit = rate_limit
+        self.faults = defaultdict(deque)
+        self.windows = {}
+        self.calls = Counter()
+        self.rows = []
+        self.files = {}
+        self.batches = {}
+        self.record = record
+        self.recorded = []
+        self.replays = defaultdict(list)
+        for entry in replay or []:
+            self.replays[entry['route']].append(entry)
+        self.replayed = Counter()
+        self.upstream = upstream
+        self.upstream_key = upstream_key
+        self.lock = threading.Lock()
+
+    def count(self, route: str) -> None:
+        with self.lock:
+            self.calls[route] += 1
+
+    def next_replay(self, route: str):
+        """The next recorded reply for ``route``, or None to build one"""
+        with self.lock:
+            entries = self.replays.get(route)
+            if not entries:
+                return None
+            entry = entries[self.replayed[route] % len(entries)]
+            self.replayed[route] += 1
+            return entry
+
+    def keep(self, route: str, status: int, body) -> None:
+        if self.record:
+            with self.lock:
+                self.recorded.append({'route': route, 'status': status, 'body': body})
+
+    def save_recording(self, path: str) -> int:
+        """Write the recorded replies as JSON lines; returns how many"""
+        with self.lock:
+            entries = list(self.recorded)
+        with open(path, 'w', encoding='utf-8') as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + '\n')
+        return len(entries)
+
+    def inject(self, route: str, *statuses: int) -> None:
+        """Answer the next requests to ``route`` with these error statuses"""
+        with self.lock:
+            self.faults[route].extend(statuses)
+
+    def admit(self, route: str):
+        """Count a request and decide its fate.
+
+        Returns ``(status, headers)``: an error status to answer with (or
+        None to serve the request) and rate-limit headers to send.
+        """
+        with self.lock:
+            self.calls[route] += 1
+            if self.faults[route]:
+                status = self.faults[route].popleft()
+                self.calls[f'{route}.{status}'] += 1
+                return status, {'Retry-After': '0'} if status == 429 else {}
+
+            headers = {}
+            if self.rate_limit:
+                now = time.monotonic()
+                start, used = self.windows.get(route, (now, 0))
+                if now - start >= 1:
+                    start, used = now, 0
+                reset_ms = max(1, int((start + 1 - now) * 1000))
+                if used >= self.rate_limit:
+                    self.calls[f'{route}.429'] += 1
+                    return 429, {'Retry-After-Ms': str(reset_ms)}
+                self.windows[route] = (start, used + 1)
+                headers = {
+                    'x-ratelimit-limit-requests': str(self.rate_limit),
+                    'x-ratelimit-remaining-requests': str(self.rate_limit - used - 1),
+                    'x-ratelimit-reset-requests': f'{reset_ms}ms',
+                }
+
+            if self.error_rate and random.random() < self.error_rate:
+                self.calls[f'{route}.{self.error_status}'] += 1
+                return self.error_status, headers
+            return None, headers
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # Keep-alive, so connection reuse by the clients is observable
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def state(self) -> StubState:
+        return self.server.state
+
+    def _read_body(self) -> bytes:
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length) if length else b''
+
+    def _read_json(self):
+        body = self._read_body()
+        if not body:
+            return {}
+        try:
+            return json.loads(body)
+        except ValueError:
+            return {}
+
+    def _read_multipart(self):
+        """Return {field name: (filename, content)} for a multipart body"""
+        header = f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode('latin-1')
+        message = BytesParser().parsebytes(header + self._read_body())
+        fields = {}
+        for part in message.get_payload():
+            name = part.get_param('name', header='content-disposition')
+            fields[name] = (part.get_filename(), part.get_payload(decode=True))
+        return fields
+
+    def _send_bytes(self, body: bytes, content_type='application/octet-stream'):
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_json(self, payload, status=200, headers=None):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _admit(self, route: str):
+        """Count ``route``; answer with an injected fault and return None, or return headers"""
+        status, headers = self.state.admit(route)
+        if status is None:
+            return headers
+        self._send_json({'error': {'code': status, 'message': f'Injected {status}', 'status': 'STUB'}},
+                        status=status, headers=headers)
+        return None
+
+    def _reply(self, route: str, build, headers=None):
+        """Answer with the next replayed reply for ``route``, or ``build()``'s ``(status, body)``"""
+        entry = self.state.next_replay(route)
+        status, body = (entry['status'], entry['body']) if entry else build()
+        self.state.keep(route, status, body)
+        self._send_json(body, status=status, headers=headers)
+
+    def _forward(self, path: str, payload):
+        """Send a request on to the upstream API and return its ``(status, body)``"""
+        request = urllib.request.Request(
+            self.state.upstream.rstrip('/') + path.removeprefix('/v1'),
+            data=json.dumps(payload).encode('utf-8'),
+            headers={'Content-Type': 'application/json', 'Authorization': f'Bearer {self.state.upstream_key}'},
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=120) as response:
+                return response.status, json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            return e.code, json.loads(e.read() or b'{}')
+
+    def do_POST(self):
+        path = self.path.split('?', 1)[0]
+        if path == '/token':
+            self._read_json()
+            self.state.count('token')
+            return self._send_json({'access_token': 'stub-token', 'expires_in': 3600, 'token_type': 'Bearer'})
+
+        if path.endswith('/files'):
+            self.state.count('files.create')
+            return self._send_json(self._create_file(self._read_multipart()))
+
+        payload = self._read_json()
+        if path.endswith('/batches'):
+            self.state.count('batches.create')
+            return self._send_json(self._create_batch(payload))
+
+        if self.state.latency:
+            time.sleep(self.state.latency)
+
+        if path.endswith('/chat/completions'):
+            headers = self._admit('chat.completions')
+            if headers is not None:
+                if self.state.upstream:
+                    self._reply('chat.completions', lambda: self._forward(path, payload), headers)
+                else:
+                    self._reply('chat.completions', lambda: (200, self._completion(payload)), headers)
+            return
+
+        match = APPEND_RE.match(path)
+        if match:
+            if self._admit('values.append') is not None:
+                self._reply('values.append', lambda: (200, self._append(match.group('sheet'), payload)))
+            return
+
+        if path.endswith('/values:batchUpdate'):
+            if self._admit('values.batchUpdate') is None:
+                return
+            with self.state.lock:
+                for data in payload.get('data', []):
+                    write_range(self.state.rows, data['range'], data['values'])
+            return self._send_json({'totalUpdatedRows': len(payload.get('data', []))})
+
+        self._send_json({'error': {'message': f'Unknown route {path}'}}, status=404)
+
+    def do_PUT(self):
+        path = self.path.split('?', 1)[0]
+        payload = self._read_json()
+        if self.state.latency:
+            time.sleep(self.state.latency)
+        match = VALUES_RE.match(path)
+        if match:
+            if self._admit('values.update') is None:
+                return
+            with self.state.lock:
+                write_range(self.state.rows, match.group('range'), payload.get('values', []))
+            return self._send_json({'updatedRows': len(payload.get('values', []))})
+        self._send_json({'error': {'message': f'Unknown route {path}'}}, status=404)
+
+    def do_GET(self):
+        path = self.path.split('?', 1)[0]
+        if path == '/v1/batches':
+            self.state.count('batches.list')
+            with self.state.lock:
+                batches = [self._public_batch(batch) for batch in self.state.batches.values()]
+            return self._send_json({'object': 'list', 'data': batches, 'has_more': False})
+        match = re.match(r'^/v1/batches/(?P<batch>[^/]+)$', path)
+        if match:
+            self.state.count('batches.retrieve')
+            return self._send_json(self._retrieve_batch(match.group('batch')))
+        match = re.match(r'^/v1/files/(?P<file>[^/]+)/content$', path)
+        if match:
+            self.state.count('files.content')
+            return self._send_bytes(self.state.files[match.group('file')]['content'])
+
+        if self.state.latency:
+            time.sleep(self.state.latency)
+        if path.endswith('/values:batchGet'):
+            if self._admit('values.batchGet') is None:
+                return
+            ranges = parse_qs(urlsplit(self.path).query).get('ranges', [])
+
+            def batch_get():
+                with self.state.lock:
+                    return 200, {'valueRanges': [value_range(a1, slice_range(self.state.rows, a1))
+                                                 for a1 in ranges]}
+            return self._reply('values.batchGet', batch_get)
+        match = VALUES_RE.match(path)
+        if match:
+            if self._admit('values.get') is None:
+                return
+
+            def get():
+                with self.state.lock:
+                    values = slice_range(self.state.rows, match.group('range'))
+                return 200, value_range(match.group('range'), values)
+            return self._reply('values.get', get)
+        self._send_json({'error': {'message': f'Unknown route {path}'}}, status=404)
+
+    def _completion(self, payload):
+        # Structured output replies follow the schema's {"cards": [...]} shape
+        content = SAMPLE_CARD
+        if (payload.get('response_format') or {}).get('type') == 'json_schema':
+            content = {'cards': [SAMPLE_CARD]}
+        return completion_body(content, payload.get('model', 'stub'))
+
+    def _create_file(self, fields):
+        filename, content = fields['file']
+        file_id = f'file-{uuid.uuid4().hex[:12]}'
+        with self.state.lock:
+            self.state.files[file_id] = {'filename': filename, 'content': content}
+        return {
+            'id': file_id, 'object': 'file', 'bytes': len(content),
+            'created_at': int(time.time()), 'filename': filename or 'upload.jsonl',
+            'purpose': fields.get('purpose', (None, b'batch'))[1].decode(), 'status': 'processed',
+        }
+
+    def _create_batch(self, payload):
+        batch_id = f'batch_{uuid.uuid4().hex[:12]}'
+        lines = self.state.files[payload['input_file_id']]['content'].decode('utf-8').splitlines()
+        output = []
+        for line in lines:
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            output.append(json.dumps({
+                'id': f'batch_req_{uuid.uuid4().hex[:12]}',
+                'custom_id': request['custom_id'],
+                'response': {'status_code': 200, 'request_id': 'stub', 'body': self._completion(request['body'])},
+                'error': None,
+            }))
+        output_file_id = f'file-{uuid.uuid4().hex[:12]}'
+        with self.state.lock:
+            self.state.files[output_file_id] = {
+                'filename': 'output.jsonl', 'content': '\n'.join(output).encode('utf-8') + b'\n'
+            }
+            self.state.batches[batch_id] = {
+                'id': batch_id, 'object': 'batch', 'endpoint': payload['endpoint'],
+                'input_file_id': payload['input_file_id'],
+                'completion_window': payload['completion_window'],
+                'created_at': int(time.time()), 'status': 'validating',
+                'output_file_id': None, 'error_file_id': None,
+                'request_counts': {'total': len(output), 'completed': 0, 'failed': 0},
+                '_output_file_id': output_file_id,
+            }
+            return self._public_batch(self.state.batches[batch_id])
+
+    def _retrieve_batch(self, batch_id):
+        progression = {'validating': 'in_progress', 'in_progress': 'completed'}
+        with self.state.lock:
+            batch = self.state.batches[batch_id]
+            batch['status'] = progression.get(batch['status'], batch['status'])
+            if batch['status'] == 'completed':
+                batch['output_file_id'] = batch['_output_file_id']
+                batch['request_counts']['completed'] = batch['request_counts']['total']
+            return self._public_batch(batch)
+
+    @staticmethod
+    def _public_batch(batch):
+        return {key: value for key, value in batch.items() if not key.startswith('_')}
+
+    def _append(self, sheet_id, payload):
+        values = payload.get('values', [])
+        width = max((len(row) for row in values), default=1)
+        with self.state.lock:
+            start = len(self.state.rows) + 1
+            self.state.rows.extend(values)
+            end = len(self.state.rows)
+        return {
+            'spreadsheetId': sheet_id,
+            'updates': {
+                'spreadsheetId': sheet_id,
+                'updatedRange': f'Sheet1!A{start}:{chr(64 + width)}{end}',
+                'updatedRows': len(values),
+            },
+        }
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, state: StubState, address=('127.0.0.1', 0)):
+        super().__init__(address, StubHandler)
+        self.state = state
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+
+def start_stub_server(latency: float = 0.0, **options) -> StubServer:
+    """Start a stub server on a free local port in a background thread.
+
+    ``options`` are passed to StubState: faults (error_rate, error_status,
+    rate_limit) and recording (record, replay, upstream, upstream_key).
+    """
+    server = StubServer(StubState(latency=latency, **options))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
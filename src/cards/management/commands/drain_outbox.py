@@ -0,0 +1,38 @@
+import time
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from django.utils import timezone
+from cards.models import VisitingCard
+from cards.utils.outbox import drain_outbox
+
+class Command(BaseCommand):
+    help = "Push queued contacts from the local outbox to the Google Sheet"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None,
+                            help="Rows per values.append call (default: SHEETS_BATCH_MAX_ROWS)")
+        parser.add_argument('--loop', action='store_true',
+                            help="Keep draining until interrupted")
+        parser.add_argument('--interval', type=float, default=5.0,
+                            help="Seconds between drains in --loop mode")
+        parser.add_argument('--retry-failed', action='store_true',
+                            help="Requeue contacts that exhausted their attempts")
+
+    def handle(self, *args, **options):
+        if options['retry_failed']:
+            requeued = VisitingCard.objects.filter(
+                sheet_status=VisitingCard.SHEET_FAILED
+            ).update(
+                sheet_status=VisitingCard.SHEET_QUEUED,
+                sheet_attempts=0,
+                sheet_next_attempt_at=timezone.now()
+            )
+            self.stdout.write(f"Requeued {requeued} failed contacts")
+
+        while True:
+            synced = drain_outbox(batch_size=options['batch_size'])
+            self.stdout.write(f"Synced {synced} contacts")
+            if not options['loop']:
+                break
+            close_old_connections()
+            time.sleep(options['interval'])
@@ -0,0 +1,260 @@
+import json
+import os
+import tempfile
+import time
+from pathlib import Path
+from django.conf import settings
+from django.core.files import File
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from cards.utils.clients import get_openai_client
+from cards.utils.image_preprocess import image_buffer
+from cards.utils.openai_helper import build_vision_request, extract_card_details, prepare_image_url
+from cards.utils.outbox import drain_outbox, enqueue_cards
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.webp', '.gif'}
+MANIFEST_NAME = '.import_manifest.json'
+BATCH_ENDPOINT = '/v1/chat/completions'
+# Terminal batch states other than 'completed'; their files are resubmitted
+FAILED_BATCH_STATES = {'failed', 'expired', 'cancelled'}
+# Images whose contacts are written to the database in one bulk insert
+IMPORT_CHUNK_SIZE = 100
+
+class Command(BaseCommand):
+    help = (
+        "Import a directory of card scans through the OpenAI Batch API. "
+        "Progress is kept in a manifest in the directory, so re-running the "
+        "command resumes where it stopped."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('directory', help="Directory of card images (searched recursively)")
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help="Images per submitted batch")
+        parser.add_argument('--poll-interval', type=float, default=30.0,
+                            help="Seconds between batch status checks")
+        parser.add_argument('--no-wait', action='store_true',
+                            help="Submit pending images and exit without waiting for results")
+        parser.add_argument('--no-sync', action='store_true',
+                            help="Leave imported contacts queued instead of pushing them to the sheet")
+        parser.add_argument('--manifest', help=f"Manifest path (default: <directory>/{MANIFEST_NAME})")
+
+    def handle(self, *args, **options):
+        self.directory = Path(options['directory']).resolve()
+        if not self.directory.is_dir():
+            raise CommandError(f"{self.directory} is not a directory")
+        self.manifest_path = Path(options['manifest'] or self.directory / MANIFEST_NAME)
+        self.manifest = self.load_manifest()
+        self.client = get_openai_client()
+
+        self.discover_images()
+        self.resume_uploads()
+        self.submit_pending(options['batch_size'])
+
+        while not options['no_wait'] and self.open_batches():
+            self.poll_batches()
+            if self.open_batches():
+                time.sleep(options['poll_interval'])
+
+        if not options['no_sync']:
+            synced = drain_outbox()
+            self.stdout.write(f"Synced {synced} contacts to the Google Sheet")
+
+        counts = {}
+        for entry in self.manifest['files'].values():
+            counts[entry['status']] = counts.get(entry['status'], 0) + 1
+        self.stdout.write(self.style.SUCCESS(f"Import status: {counts}"))
+
+    # Manifest
+
+    def load_manifest(self):
+        if self.manifest_path.exists():
+            with open(self.manifest_path) as f:
+                return json.load(f)
+        return {'files': {}, 'batches': {}, 'uploads': {}}
+
+    def save_manifest(self):
+        # Write-then-rename so an interrupted run never leaves a torn manifest
+        temp_path = self.manifest_path.with_suffix('.tmp')
+        with open(temp_path, 'w') as f:
+            json.dump(self.manifest, f, indent=2, sort_keys=True)
+        os.replace(temp_path, self.manifest_path)
+
+    def open_batches(self):
+        return [batch_id for batch_id, batch in self.manifest['batches'].items() if not batch.get('done')]
+
+    # Submission
+
+    def discover_images(self):
+        added = 0
+        for path in sorted(self.directory.rglob('*')):
+            if path.suffix.lower() not in IMAGE_EXTENSIONS or not path.is_file():
+                continue
+            name = path.relative_to(self.directory).as_posix()
+            if name not in self.manifest['files']:
+                self.manifest['files'][name] = {'status': 'pending'}
+                added += 1
+        self.save_manifest()
+        self.stdout.write(f"Found {added} new images, {len(self.manifest['files'])} in total")
+
+    def submit_pending(self, batch_size):
+        pending = [name for name, entry in self.manifest['files'].items() if entry['status'] == 'pending']
+        for start in range(0, len(pending), batch_size):
+            self.submit_batch(pending[start:start + batch_size])
+
+    def write_requests(self, names, handle):
+        """Write one Batch API request line per image, streamed to disk.
+
+        Images that cannot be read or decoded are marked failed in the
+        manifest, so they neither abort the submission nor block later runs.
+        Returns the names that were written.
+        """
+        # Batch replies cannot be escalated, so use the strongest tier
+        tier = settings.VISION_MODEL_TIERS[-1]
+        written = []
+        for name in names:
+            try:
+                with open(self.directory / name, 'rb') as f:
+                    image_file = File(f, name=name)
+                    with image_buffer(image_file) as data:
+                        image_url = prepare_image_url(image_file, data)
+            except (OSError, ValueError) as e:
+                self.manifest['files'][name] = {'status': 'failed', 'error': str(e)}
+                self.stderr.write(f"Skipping {name}: {e}")
+                continue
+            line = {
+                'custom_id': name,
+                'method': 'POST',
+                'url': BATCH_ENDPOINT,
+                'body': build_vision_request(image_url, tier['model'], tier['detail'], max_tokens=tier['max_tokens']),
+            }
+            handle.write(json.dumps(line).encode('utf-8'))
+            handle.write(b'\n')
+            written.append(name)
+        return written
+
+    def submit_batch(self, names):
+        with tempfile.NamedTemporaryFile(suffix='.jsonl', delete=False) as handle:
+            names = self.write_requests(names, handle)
+        try:
+            if not names:
+                self.save_manifest()
+                return
+            with open(handle.name, 'rb') as f:
+                input_file = self.client.files.create(file=f, purpose='batch')
+        finally:
+            os.unlink(handle.name)
+
+        # Record the upload before creating the batch: if this run dies in
+        # between, the next one finds the batch (or creates it) from the
+        # manifest instead of submitting and paying for the images again
+        self.manifest.setdefault('uploads', {})[input_file.id] = {'files': names}
+        for name in names:
+            self.manifest['files'][name] = {'status': 'uploaded', 'input_file_id': input_file.id}
+        self.save_manifest()
+        self.create_batch(input_file.id)
+
+    def create_batch(self, input_file_id):
+        batch = self.client.batches.create(
+            input_file_id=input_file_id,
+            endpoint=BATCH_ENDPOINT,
+            completion_window='24h'
+        )
+        self.record_batch(batch)
+
+    def record_batch(self, batch):
+        """Move an upload's files into a batch in the manifest"""
+        names = self.manifest['uploads'].pop(batch.input_file_id)['files']
+        self.manifest['batches'][batch.id] = {
+            'input_file_id': batch.input_file_id,
+            'status': batch.status,
+            'submitted_at': timezone.now().isoformat(),
+            'files': names,
+        }
+        for name in names:
+            self.manifest['files'][name] = {'status': 'submitted', 'batch_id': batch.id}
+        self.save_manifest()
+        self.stdout.write(f"Submitted batch {batch.id} with {len(names)} images")
+
+    def resume_uploads(self):
+        """Finish submissions an earlier run uploaded but did not record a batch for"""
+        uploads = self.manifest.setdefault('uploads', {})
+        if not uploads:
+            return
+        for batch in self.client.batches.list(limit=100):
+            if batch.input_file_id in uploads:
+                self.record_batch(batch)
+        for input_file_id in list(uploads):
+            self.create_batch(input_file_id)
+
+    # Results
+
+    def poll_batches(self):
+        for batch_id in self.open_batches():
+            batch = self.client.batches.retrieve(batch_id)
+            entry = self.manifest['batches'][batch_id]
+            entry['status'] = batch.status
+
+            if batch.status == 'completed':
+                if batch.output_file_id:
+                    self.import_output(batch.output_file_id)
+                if batch.error_file_id:
+                    self.record_errors(batch.error_file_id)
+                entry['done'] = True
+            elif batch.status in FAILED_BATCH_STATES:
+                # Put the files back in the queue for the next run
+                for name in entry['files']:
+                    if self.manifest['files'][name]['status'] == 'submitted':
+                        self.manifest['files'][name] = {'status': 'pending', 'error': f"batch {batch.status}"}
+                entry['done'] = True
+            self.save_manifest()
+            self.stdout.write(f"Batch {batch_id}: {batch.status}")
+
+    def iter_output(self, file_id):
+        with self.client.files.with_streaming_response.content(file_id) as response:
+            for line in response.iter_lines():
+                if line.strip():
+                    yield json.loads(line)
+
+    def import_output(self, file_id):
+        imported = 0
+        chunk_names, chunk_cards = [], []
+
+        def flush():
+            enqueue_cards(chunk_cards, wake=False)
+            for name, count in chunk_names:
+                self.manifest['files'][name] = {'status': 'imported', 'contacts': count}
+            self.save_manifest()
+            chunk_names.clear()
+            chunk_cards.clear()
+
+        for result in self.iter_output(file_id):
+            name = result['custom_id']
+            if self.manifest['files'].get(name, {}).get('status') != 'submitted':
+                continue
+            response = result.get('response') or {}
+            if result.get('error') or response.get('status_code') != 200:
+                self.manifest['files'][name] = {'status': 'failed', 'error': result.get('error') or response.get('body')}
+                continue
+
+            try:
+                content = response['body']['choices'][0]['message']['content']
+                cards = extract_card_details(content)
+            except (KeyError, IndexError, ValueError) as e:
+                self.manifest['files'][name] = {'status': 'failed', 'error': str(e)}
+                continue
+
+            chunk_names.append((name, len(cards)))
+            chunk_cards.extend(cards)
+            imported += 1
+            if len(chunk_names) >= IMPORT_CHUNK_SIZE:
+                flush()
+
+        flush()
+        self.stdout.write(f"Imported {imported} images from {file_id}")
+
+    def record_errors(self, file_id):
+        for result in self.iter_output(file_id):
+            name = result['custom_id']
+            if self.manifest['files'].get(name, {}).get('status') == 'submitted':
+                self.manifest['files'][name] = {'status': 'failed', 'error': result.get('error')}
@@ -0,0 +1,32 @@
+from django.core.management.base import BaseCommand
+from cards.utils.outbox import drain_outbox
+from cards.utils.sheet_sync import pull_sheet
+
+class Command(BaseCommand):
+    help = (
+        "Two-way sync with the Google Sheet: apply edits made in the sheet to "
+        "the local contacts, then push new and changed contacts."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('--no-pull', action='store_true',
+                            help="Only push local changes")
+        parser.add_argument('--no-push', action='store_true',
+                            help="Only pull edits made in the sheet")
+        parser.add_argument('--pull-rows', type=int, default=None,
+                            help="Rows to read (default: SHEETS_PULL_MAX_ROWS); the next run continues after them")
+        parser.add_argument('--full', action='store_true',
+                            help="Read and apply the whole sheet, including ranges unchanged since the last pull")
+
+    def handle(self, *args, **options):
+        if not options['no_pull']:
+            stats = pull_sheet(max_rows=options['pull_rows'], full=options['full'])
+            self.stdout.write(
+                f"Pulled {stats['rows']} rows ({stats['skipped']} unchanged): {stats['updated']} updated, "
+                f"{stats['created']} created, {stats['moved']} moved"
+            )
+
+        if not options['no_push']:
+            # Pulled edits that still differ locally were queued above
+            synced = drain_outbox()
+            self.stdout.write(f"Pushed {synced} contacts")
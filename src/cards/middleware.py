@@ -0,0 +1,48 @@
+import time
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from .utils import metrics
+
+class ServerTimingMiddleware:
+    """Time each request and report its pipeline stages in Server-Timing.
+
+    Spans recorded by ``metrics.span`` while the view runs are collected
+    through a context variable and summed per stage. The request's duration
+    also goes to the ``http_request_seconds`` histogram, labelled by view.
+    Works under both WSGI and ASGI.
+    """
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        started = time.perf_counter()
+        spans, token = metrics.start_request()
+        try:
+            response = self.get_response(request)
+        finally:
+            metrics.end_request(token)
+        return self.finish(request, response, spans, started)
+
+    async def __acall__(self, request):
+        started = time.perf_counter()
+        spans, token = metrics.start_request()
+        try:
+            response = await self.get_response(request)
+        finally:
+            metrics.end_request(token)
+        return self.finish(request, response, spans, started)
+
+    def finish(self, request, response, spans, started):
+        total = time.perf_counter() - started
+        match = getattr(request, 'resolver_match', None)
+        metrics.REQUEST_SECONDS.observe(total, view=(match and match.url_name) or 'unresolved')
+        response['Server-Timing'] = metrics.server_timing(spans, total)
+        return response
@@ -0,0 +1,33 @@
+# Generated by Django 4.2 on 2026-10-18 11:07
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='VisitingCard',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=255)),
+                ('business_name', models.CharField(max_length=255)),
+                ('job_title', models.CharField(blank=True, max_length=255, null=True)),
+                ('contact_number', models.CharField(max_length=20)),
+                ('email', models.EmailField(blank=True, max_length=255, null=True)),
+                ('website', models.URLField(blank=True, max_length=255, null=True)),
+                ('address', models.TextField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('image', models.ImageField(blank=True, null=True, upload_to='cards/')),
+            ],
+            options={
+                'ordering': ['-created_at'],
+            },
+        ),
+    ]
@@ -0,0 +1,74 @@
+# Generated by Django 4.2 on 2026-10-18 11:10
+
+from django.db import migrations, models
+import django.utils.timezone
+import uuid
+
+
+def gen_sync_keys(apps, schema_editor):
+    VisitingCard = apps.get_model('cards', 'VisitingCard')
+    for card in VisitingCard.objects.filter(sync_key__isnull=True):
+        card.sync_key = uuid.uuid4()
+        card.save(update_fields=['sync_key'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cards', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='visitingcard',
+            name='sheet_attempts',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='visitingcard',
+            name='sheet_error',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddField(
+            model_name='visitingcard',
+            name='sheet_lease',
+            field=models.CharField(blank=True, default='', max_length=32),
+        ),
+        migrations.AddField(
+            model_name='visitingcard',
+            name='sheet_next_attempt_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='visitingcard',
+            name='sheet_status',
+            field=models.CharField(choices=[('queued', 'Queued'), ('synced', 'Synced'), ('failed', 'Failed')], default='queued', max_length=10),
+        ),
+        migrations.AddField(
+            model_name='visitingcard',
+            name='sheet_synced_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        # Unique field with a callable default: add it nullable, fill in a
+        # distinct key per existing row, then make it unique.
+        migrations.AddField(
+            model_name='visitingcard',
+            name='sync_key',
+            field=models.UUIDField(editable=False, null=True),
+        ),
+        migrations.RunPython(gen_sync_keys, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='visitingcard',
+            name='sync_key',
+            field=models.UUIDField(default=uuid.uuid4, editable=False, unique=True),
+        ),
+        migrations.AlterField(
+            model_name='visitingcard',
+            name='contact_number',
+            field=models.CharField(max_length=50),
+        ),
+        migrations.AddIndex(
+            model_name='visitingcard',
+            index=models.Index(fields=['sheet_status', 'sheet_next_attempt_at'], name='card_outbox_due_idx'),
+        ),
+    ]
@@ -0,0 +1,74 @@
+# Generated by Django 4.2 on 2026-10-18 11:29
+
+from django.db import migrations, models
+import django.utils.timezone
+from cards.utils.contacts import contact_keys
+
+
+def fill_contact_keys(apps, schema_editor):
+    VisitingCard = apps.get_model('cards', 'VisitingCard')
+    seen = set()
+    for card in VisitingCard.objects.order_by('pk').iterator():
+        keys = contact_keys(card.__dict__)
+        # Existing duplicates keep their rows; only the oldest owns the key
+        if keys['dedup_key'] in seen:
+            keys['dedup_key'] = None
+        seen.add(keys['dedup_key'])
+        VisitingCard.objects.filter(pk=card.pk).update(last_scanned_at=card.created_at, **keys)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cards', '0002_sheets_outbox'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='visitingcard',
+            name='business_key',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='visitingcard',
+            name='dedup_key',
+            field=models.CharField(blank=True, max_length=40, null=True, unique=True),
+        ),
+        migrations.AddField(
+            model_name='visitingcard',
+            name='last_scanned_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='visitingcard',
+            name='name_key',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='visitingcard',
+            name='normalized_phone',
+            field=models.CharField(blank=True, default='', max_length=32),
+        ),
+        migrations.AddField(
+            model_name='visitingcard',
+            name='scan_count',
+            field=models.PositiveIntegerField(default=1),
+        ),
+        migrations.RunPython(fill_contact_keys, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='visitingcard',
+            index=models.Index(fields=['email'], name='card_email_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='visitingcard',
+            index=models.Index(fields=['normalized_phone'], name='card_phone_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='visitingcard',
+            index=models.Index(fields=['name_key', 'business_key'], name='card_name_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='visitingcard',
+            index=models.Index(fields=['business_key'], name='card_business_idx'),
+        ),
+    ]
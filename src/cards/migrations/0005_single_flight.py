@@ -0,0 +1,28 @@
+# Generated by Django 4.2 on 2026-10-18 11:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cards', '0004_sheet_sync'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FlightRecord',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=64, unique=True)),
+                ('state', models.CharField(choices=[('running', 'Running'), ('done', 'Done')], default='running', max_length=10)),
+                ('lease', models.CharField(max_length=32)),
+                ('result', models.JSONField(blank=True, null=True)),
+                ('expires_at', models.DateTimeField()),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='flightrecord',
+            index=models.Index(fields=['expires_at'], name='flight_expires_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2 on 2026-10-18 14:02
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cards', '0005_single_flight'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='syncstate',
+            name='hashes',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 4.2 on 2026-10-18 12:35
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cards', '0006_syncstate_hashes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='flightrecord',
+            name='fingerprint',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+    ]
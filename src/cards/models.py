@@ -1,23 +1,75 @@
+import uuid
 from django.db import models
 from django.utils import timezone
+from .utils.contacts import contact_keys
 
 class VisitingCard(models.Model):
+    SHEET_QUEUED = 'queued'
+    SHEET_SYNCED = 'synced'
+    SHEET_FAILED = 'failed'
+    SHEET_STATUS_CHOICES = [
+        (SHEET_QUEUED, 'Queued'),
+        (SHEET_SYNCED, 'Synced'),
+        (SHEET_FAILED, 'Failed'),
+    ]
+
     name = models.CharField(max_length=255)
     business_name = models.CharField(max_length=255)
     job_title = models.CharField(max_length=255, blank=True, null=True)
-    contact_number = models.CharField(max_length=20)
+    contact_number = models.CharField(max_length=50)
     email = models.EmailField(max_length=255, blank=True, null=True)
     website = models.URLField(max_length=255, blank=True, null=True)
     address = models.TextField(blank=True, null=True)
     created_at = models.DateTimeField(default=timezone.now)
     image = models.ImageField(upload_to='cards/', blank=True, null=True)
 
+    # Google Sheets outbox. Cards are saved here first and pushed to the
+    # sheet by the outbox drainer; sync_key is written to the sheet as an
+    # idempotency key so a retried batch never duplicates rows.
+    sync_key = models.UUIDField(default=uuid.uuid4, unique=True, editable=False)
+    sheet_status = models.CharField(max_length=10, choices=SHEET_STATUS_CHOICES, default=SHEET_QUEUED)
+    sheet_attempts = models.PositiveIntegerField(default=0)
+    sheet_next_attempt_at = models.DateTimeField(default=timezone.now)
+    sheet_lease = models.CharField(max_length=32, blank=True, default='')
+    sheet_synced_at = models.DateTimeField(blank=True, null=True)
+    sheet_error = models.TextField(blank=True, default='')
+    # Where the card lives in the sheet and its contact columns as last
+    # written or read there. sheet_values is the common ancestor when
+    # merging edits made on both sides; sheet_hash is its row_hash.
+    sheet_row = models.PositiveIntegerField(blank=True, null=True)
+    sheet_values = models.JSONField(blank=True, null=True)
+    sheet_hash = models.CharField(max_length=40, blank=True, default='')
+
+    # Lookup columns derived from the contact fields (see contact_keys).
+    # dedup_key identifies a contact across scans, so re-scanning a card
+    # updates its row instead of adding another; it is None when a card has
+    # too little data to tell contacts apart.
+    normalized_phone = models.CharField(max_length=32, blank=True, default='')
+    name_key = models.CharField(max_length=255, blank=True, default='')
+    business_key = models.CharField(max_length=255, blank=True, default='')
+    dedup_key = models.CharField(max_length=40, blank=True, null=True, unique=True)
+    scan_count = models.PositiveIntegerField(default=1)
+    last_scanned_at = models.DateTimeField(default=timezone.now)
+
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['sheet_status', 'sheet_next_attempt_at'], name='card_outbox_due_idx'),
+            models.Index(fields=['email'], name='card_email_idx'),
+            models.Index(fields=['normalized_phone'], name='card_phone_idx'),
+            models.Index(fields=['name_key', 'business_key'], name='card_name_idx'),
+            models.Index(fields=['business_key'], name='card_business_idx'),
+        ]
 
     def __str__(self):
         return f"{self.name} - {self.business_name}"
 
+    def save(self, *args, **kwargs):
+        # bulk_create/bulk_update skip this; enqueue_cards sets the keys itself
+        for field, value in contact_keys(self.__dict__).items():
+            setattr(self, field, value)
+        super().save(*args, **kwargs)
+
     def to_dict(self):
         """Convert model instance to dictionary for Google Sheets"""
         return {
@@ -28,5 +80,73 @@ class VisitingCard(models.Model):
             'Email': self.email or '',
             'Website': self.website or '',
             'Address': self.address or '',
-            'Created At': self.created_at.strftime('%Y-%m-%d %H:%M:%S')
-        }
\ No newline at end of file
+            'Created At': self.created_at.strftime('%Y-%m-%d %H:%M:%S'),
+            'Card ID': str(self.sync_key)
+        }
+
+    def requeue_for_sheet(self):
+        """Queue the card so its changed fields are pushed to the sheet"""
+        self.sheet_status = self.SHEET_QUEUED
+        self.sheet_attempts = 0
+        self.sheet_next_attempt_at = timezone.now()
+        # Drop any lease, so an in-flight push of the old values does not
+        # mark the new ones as synced
+        self.sheet_lease = ''
+
+    def to_card_data(self):
+        """Convert model instance to the card dict used by the helpers"""
+        return {
+            'id': self.pk,
+            'name': self.name,
+            'business_name': self.business_name,
+            'job_title': self.job_title or '',
+            'contact_number': self.contact_number,
+            'email': self.email or '',
+            'website': self.website or '',
+            'address': self.address or '',
+            'created_at': self.created_at.strftime('%Y-%m-%d %H:%M:%S'),
+            'sync_key': str(self.sync_key),
+            'sheet_status': self.sheet_status
+        }
+
+class SyncState(models.Model):
+    """Progress markers for incremental sync jobs, one row per job"""
+    name = models.CharField(max_length=50, unique=True)
+    cursor = models.PositiveIntegerField(default=0)
+    # Content hash of each range the job last read, keyed by its first row
+    hashes = models.JSONField(default=dict, blank=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.name} @ {self.cursor}"
+
+class FlightRecord(models.Model):
+    """A claim on deduplicated work, then its result (see utils/single_flight.py).
+
+    While the work runs, ``lease`` identifies the claimant and
+    ``expires_at`` is when others may take over; once done, ``result``
+    is replayed to callers with the same key until ``expires_at``.
+    ``fingerprint`` digests the request behind the key, so a key reused
+    for a different request can be told apart.
+    """
+    STATE_RUNNING = 'running'
+    STATE_DONE = 'done'
+    STATE_CHOICES = [
+        (STATE_RUNNING, 'Running'),
+        (STATE_DONE, 'Done'),
+    ]
+
+    key = models.CharField(max_length=64, unique=True)
+    state = models.CharField(max_length=10, choices=STATE_CHOICES, default=STATE_RUNNING)
+    lease = models.CharField(max_length=32)
+    result = models.JSONField(blank=True, null=True)
+    fingerprint = models.CharField(max_length=64, blank=True, default='')
+    expires_at = models.DateTimeField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['expires_at'], name='flight_expires_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.key[:12]} ({self.state})"
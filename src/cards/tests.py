@@ -0,0 +1,943 @@
+import asyncio
+import hashlib
+import io
+import json
+import os
+import re
+import tempfile
+import threading
+from datetime import timedelta
+from unittest import mock
+
+import httplib2
+import httpx
+import openai
+from asgiref.sync import async_to_sync
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection
+from django.http import JsonResponse
+from django.test import Client, RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.client import encode_multipart
+from django.utils import timezone
+from google.oauth2.credentials import Credentials
+from googleapiclient.errors import HttpError
+from PIL import Image, ImageDraw, ImageFont
+
+from .models import FlightRecord, VisitingCard
+from benchmarks.bench_contacts import make_contacts
+from benchmarks.corpus import build_corpus, make_image
+from benchmarks.stubs import start_stub_server
+from .utils import (
+    card_detection, clients, model_routing, resilience, sheet_sync, sheets_helper, single_flight, uploads
+)
+from .utils.image_preprocess import detect_mime, preprocess_image
+from .utils.openai_helper import _decode_json, extract_card_details, parse_stats
+from .utils.outbox import drain_outbox, enqueue_cards
+from .utils.sheet_sync import pull_sheet
+from .utils.resilience import (
+    CircuitBreaker, CircuitOpenError, RateLimitedError, UnavailableError, Upstream, UpstreamError,
+    classify_google, classify_openai, parse_duration, retry_after,
+)
+
+UPSTREAM_CONFIG = {
+    'rate': 1000, 'burst': 1000, 'max_attempts': 4, 'base_backoff': 0.5, 'max_backoff': 20,
+    'max_wait': 30, 'circuit_threshold': 5, 'circuit_reset': 30,
+}
+
+def openai_error(status, headers=None):
+    request = httpx.Request('POST', 'https://api.openai.com/v1/chat/completions')
+    response = httpx.Response(status, headers=headers or {}, request=request)
+    error_class = {429: openai.RateLimitError, 500: openai.InternalServerError}.get(status, openai.APIStatusError)
+    return error_class(f"Error code: {status}", response=response, body=None)
+
+def google_error(status, headers=None):
+    return HttpError(httplib2.Response(dict(headers or {}, status=status)), b'{}')
+
+class FakeSheetsService:
+    """In-memory stand-in for the spreadsheets().values() API.
+
+    Supports the whole-row and single-cell reads, updates and appends the
+    app makes. Errors queued in ``failures`` are raised by the next
+    requests, before they apply.
+    """
+
+    RANGE_RE = re.compile(r'^(?P<column>[A-Z])(?P<first>\d+)(?::[A-Z]+(?P<last>\d+))?$')
+
+    def __init__(self):
+        self.rows = []
+        self.requests = []
+        self.failures = []
+
+    def spreadsheets(self):
+        return self
+
+    def values(self):
+        return self
+
+    def _request(self, method, apply, **kwargs):
+        def execute():
+            self.requests.append((method, kwargs))
+            if self.failures:
+                raise self.failures.pop(0)
+            return apply()
+        return mock.Mock(execute=execute)
+
+    def _span(self, range):
+        match = self.RANGE_RE.match(range)
+        first = int(match.group('first'))
+        return ord(match.group('column')) - ord('A'), first, int(match.group('last') or first)
+
+    def _read(self, range):
+        column, first, last = self._span(range)
+        width = None if ':' in range else 1
+        values = [row[column:column + width if width else None] for row in self.rows[first - 1:last]]
+        while values and not any(values[-1]):
+            values.pop()
+        return {'values': values} if values else {}
+
+    def _write(self, range, values):
+        column, first, _ = self._span(range)
+        for offset, row in enumerate(values):
+            while len(self.rows) < first + offset:
+                self.rows.append([])
+            target = self.rows[first - 1 + offset]
+            target.extend([''] * (column + len(row) - len(target)))
+            target[column:column + len(row)] = row
+
+    def get(self, spreadsheetId, range):
+        return self._request('get', lambda: self._read(range), range=range)
+
+    def batchGet(self, spreadsheetId, ranges):
+        return self._request(
+            'batchGet', lambda: {'valueRanges': [self._read(range) for range in ranges]}, ranges=ranges
+        )
+
+    def update(self, spreadsheetId, range, valueInputOption, body):
+        def apply():
+            self._write(range, body['values'])
+            return {'updatedRows': len(body['values'])}
+        return self._request('update', apply, range=range, body=body)
+
+    def batchUpdate(self, spreadsheetId, body):
+        def apply():
+            for data in body['data']:
+                self._write(data['range'], data['values'])
+            return {'totalUpdatedRows': len(body['data'])}
+        return self._request('batchUpdate', apply, body=body)
+
+    def append(self, spreadsheetId, range, valueInputOption, insertDataOption, body):
+        def apply():
+            first = len(self.rows) + 1
+            self.rows.extend(list(row) for row in body['values'])
+            return {'updates': {'updatedRange': f"Sheet1!A{first}:I{len(self.rows)}"}}
+        return self._request('append', apply, range=range, body=body)
+
+    def calls(self, method):
+        return [kwargs for name, kwargs in self.requests if name == method]
+
+class FakeSheetsMixin:
+    """Route sheets_helper through a FakeSheetsService, without pauses"""
+
+    def setUp(self):
+        super().setUp()
+        self.sheet = FakeSheetsService()
+        for patcher in (
+            mock.patch.object(sheets_helper, 'get_sheets_service', return_value=self.sheet),
+            mock.patch.object(resilience.time, 'sleep'),
+            mock.patch.dict(sheets_helper._headers, {'pid': None}),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        resilience.reset_upstreams()
+        self.addCleanup(resilience.reset_upstreams)
+
+class RetryAfterTests(SimpleTestCase):
+    def test_seconds_and_durations(self):
+        self.assertEqual(parse_duration('2'), 2.0)
+        self.assertEqual(parse_duration('1.5'), 1.5)
+        self.assertEqual(parse_duration('6m0s'), 360.0)
+        self.assertEqual(parse_duration('20ms'), 0.02)
+        self.assertIsNone(parse_duration(None))
+
+    def test_malformed_values_are_ignored(self):
+        for value in ('', 'soon', 'Wed, 21 Oct 2015 07:28:00 GMT', '-5', 'inf', 'nan'):
+            with self.subTest(value=value):
+                self.assertIsNone(parse_duration(value))
+                self.assertIsNone(retry_after({'retry-after': value}))
+
+    def test_milliseconds_take_precedence(self):
+        self.assertEqual(retry_after({'retry-after-ms': '250', 'retry-after': '3'}), 0.25)
+
+    def test_malformed_milliseconds_fall_back_to_seconds(self):
+        self.assertEqual(retry_after({'retry-after-ms': 'soon', 'retry-after': '3'}), 3.0)
+        self.assertIsNone(retry_after({'retry-after-ms': 'soon'}))
+        self.assertIsNone(retry_after({'retry-after-ms': ''}))
+
+    def test_missing_headers(self):
+        self.assertIsNone(retry_after(None))
+        self.assertIsNone(retry_after({}))
+
+class ClassifyTests(SimpleTestCase):
+    def test_openai_rate_limit(self):
+        error = classify_openai('openai', openai_error(429, {'retry-after': '2'}))
+        self.assertIsInstance(error, RateLimitedError)
+        self.assertTrue(error.retryable)
+        self.assertEqual((error.status, error.retry_after), (429, 2.0))
+
+    def test_openai_rate_limit_with_malformed_retry_after(self):
+        error = classify_openai('openai', openai_error(429, {'retry-after-ms': 'soon'}))
+        self.assertIsInstance(error, RateLimitedError)
+        self.assertIsNone(error.retry_after)
+
+    def test_openai_server_errors_are_retryable(self):
+        for status in (408, 409, 500, 503):
+            with self.subTest(status=status):
+                self.assertIsInstance(classify_openai('openai', openai_error(status)), UnavailableError)
+
+    def test_openai_client_errors_are_final(self):
+        error = classify_openai('openai', openai_error(400))
+        self.assertIs(type(error), UpstreamError)
+        self.assertFalse(error.retryable)
+
+    def test_openai_connection_errors_are_retryable(self):
+        request = httpx.Request('POST', 'https://api.openai.com/v1/chat/completions')
+        error = classify_openai('openai', openai.APIConnectionError(request=request))
+        self.assertIsInstance(error, UnavailableError)
+        self.assertIsNone(error.status)
+
+    def test_other_errors_are_not_upstream_errors(self):
+        self.assertIsNone(classify_openai('openai', ValueError('bad')))
+        self.assertIsNone(classify_google('sheets', ValueError('bad')))
+
+    def test_google_errors(self):
+        error = classify_google('sheets', google_error(429, {'retry-after': '3'}))
+        self.assertIsInstance(error, RateLimitedError)
+        self.assertEqual(error.retry_after, 3.0)
+        self.assertIsInstance(classify_google('sheets', google_error(503)), UnavailableError)
+        self.assertFalse(classify_google('sheets', google_error(403)).retryable)
+        self.assertIsInstance(classify_google('sheets', TimeoutError('timed out')), UnavailableError)
+
+class UpstreamTests(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch.object(resilience.time, 'sleep')
+        self.sleep = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.upstream = Upstream('openai', UPSTREAM_CONFIG, classify_openai)
+
+    def test_backoff_honours_retry_after_and_cap(self):
+        error = RateLimitedError('openai', 'slow down', 429, retry_after=7.0)
+        for attempt in range(10):
+            delay = self.upstream.backoff(attempt, error)
+            self.assertGreaterEqual(delay, 7.0)
+            self.assertLessEqual(delay, UPSTREAM_CONFIG['max_backoff'])
+        no_hint = UnavailableError('openai', 'down', 503)
+        self.assertLessEqual(self.upstream.backoff(0, no_hint), UPSTREAM_CONFIG['base_backoff'])
+
+    def test_retries_retryable_errors(self):
+        func = mock.Mock(side_effect=[openai_error(503), openai_error(429, {'retry-after': '1'}), 'ok'])
+        self.assertEqual(self.upstream.call(func), 'ok')
+        self.assertEqual(func.call_count, 3)
+        self.assertEqual(self.upstream.stats['retries'], 2)
+        # The 429's Retry-After is the floor of the second delay
+        self.assertGreaterEqual(self.sleep.call_args_list[-1].args[0], 1.0)
+
+    def test_final_errors_are_not_retried(self):
+        func = mock.Mock(side_effect=openai_error(400))
+        with self.assertRaises(UpstreamError):
+            self.upstream.call(func)
+        self.assertEqual(func.call_count, 1)
+
+    def test_gives_up_after_max_attempts(self):
+        func = mock.Mock(side_effect=openai_error(503))
+        with self.assertRaises(UnavailableError):
+            self.upstream.call(func)
+        self.assertEqual(func.call_count, UPSTREAM_CONFIG['max_attempts'])
+        self.assertEqual(self.upstream.stats['failed'], 1)
+
+    def test_non_idempotent_calls_are_not_retried_without_a_response(self):
+        request = httpx.Request('POST', 'https://api.openai.com/v1/files')
+        func = mock.Mock(side_effect=openai.APITimeoutError(request=request))
+        with self.assertRaises(UnavailableError):
+            self.upstream.call(func, idempotent=False)
+        self.assertEqual(func.call_count, 1)
+
+    def test_other_errors_propagate_unchanged(self):
+        func = mock.Mock(side_effect=KeyError('field'))
+        with self.assertRaises(KeyError):
+            self.upstream.call(func)
+
+    def test_open_circuit_fails_fast(self):
+        upstream = Upstream('openai', dict(UPSTREAM_CONFIG, circuit_threshold=2), classify_openai)
+        func = mock.Mock(side_effect=openai_error(503))
+        # The second failure opens the circuit, so the third attempt never runs
+        with self.assertRaises(CircuitOpenError):
+            upstream.call(func)
+        self.assertEqual(upstream.breaker.state, CircuitBreaker.OPEN)
+        with self.assertRaises(CircuitOpenError):
+            upstream.call(func)
+        self.assertEqual(func.call_count, 2)
+        self.assertEqual(upstream.stats['rejected'], 2)
+
+class CircuitBreakerTests(SimpleTestCase):
+    def setUp(self):
+        patcher = mock.patch.object(resilience.time, 'monotonic', return_value=1000.0)
+        self.clock = patcher.start()
+        self.addCleanup(patcher.stop)
+        self.breaker = CircuitBreaker(threshold=2, reset_timeout=30)
+
+    def open_circuit(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+
+    def test_opens_after_consecutive_failures(self):
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(self.breaker.retry_in(), 30)
+
+    def test_success_resets_the_failure_count(self):
+        self.breaker.record_failure()
+        self.breaker.record_success()
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+
+    def test_half_open_lets_one_probe_through(self):
+        self.open_circuit()
+        self.clock.return_value += 30
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual(self.breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertFalse(self.breaker.allow())
+
+    def test_successful_probe_closes(self):
+        self.open_circuit()
+        self.clock.return_value += 30
+        self.breaker.allow()
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.state, CircuitBreaker.CLOSED)
+        self.assertTrue(self.breaker.allow())
+
+    def test_failed_probe_opens_again(self):
+        self.open_circuit()
+        self.clock.return_value += 30
+        self.breaker.allow()
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertEqual(self.breaker.retry_in(), 30)
+
+    def test_released_probe_can_be_retried(self):
+        self.open_circuit()
+        self.clock.return_value += 30
+        self.breaker.allow()
+        self.breaker.release()
+        self.assertEqual(self.breaker.state, CircuitBreaker.OPEN)
+        self.assertTrue(self.breaker.allow())
+
+class AppendRowsTests(FakeSheetsMixin, SimpleTestCase):
+    cards = [
+        {'name': 'Ada Lovelace', 'email': 'ada@example.com', 'sync_key': 'key-1'},
+        {'name': 'Alan Turing', 'business_name': 'NPL', 'sync_key': 'key-2'},
+        {'name': 'Grace Hopper', 'job_title': 'Rear Admiral', 'sync_key': 'key-3'},
+    ]
+
+    def test_one_request_for_many_cards(self):
+        result = sheets_helper.append_rows(self.cards)
+        self.assertEqual(len(self.sheet.requests), 1)
+        self.assertEqual(sheets_helper.appended_rows(result), (1, 3))
+        self.assertEqual(self.sheet.rows, [sheets_helper.card_to_row(card) for card in self.cards])
+        self.assertEqual(self.sheet.rows[1][1], 'NPL')
+        self.assertEqual(self.sheet.rows[2][8], 'key-3')
+
+    def test_empty_batch_makes_no_request(self):
+        self.assertEqual(sheets_helper.append_rows([]), {})
+        self.assertEqual(self.sheet.requests, [])
+
+    def test_rejected_append_is_retried(self):
+        self.sheet.failures.append(google_error(503))
+        sheets_helper.append_rows(self.cards)
+        self.assertEqual(len(self.sheet.calls('append')), 2)
+        self.assertEqual(len(self.sheet.rows), 3)
+
+    def test_append_without_a_response_is_not_retried(self):
+        # It may have been applied, so the outbox checks Card IDs instead
+        self.sheet.failures.append(TimeoutError('timed out'))
+        with self.assertRaises(UnavailableError):
+            sheets_helper.append_rows(self.cards)
+        self.assertEqual(len(self.sheet.calls('append')), 1)
+
+class OutboxTests(FakeSheetsMixin, TestCase):
+    def test_drain_appends_the_batch_in_one_request(self):
+        enqueue_cards([
+            {'name': f'Contact {index}', 'email': f'contact{index}@example.com'} for index in range(3)
+        ], wake=False)
+        self.assertEqual(drain_outbox(), 3)
+
+        self.assertEqual(len(self.sheet.calls('append')), 1)
+        self.assertEqual(self.sheet.rows[0], sheets_helper.SHEET_COLUMNS)
+        cards = list(VisitingCard.objects.order_by('pk'))
+        self.assertEqual([card.sheet_row for card in cards], [2, 3, 4])
+        self.assertEqual({card.sheet_status for card in cards}, {VisitingCard.SHEET_SYNCED})
+        self.assertEqual([row[8] for row in self.sheet.rows[1:]], [str(card.sync_key) for card in cards])
+        self.assertEqual(drain_outbox(), 0)
+
+    @override_settings(SHEETS_OUTBOX_WORKER=False, SHEETS_OUTBOX_CRON=False)
+    def test_enqueue_drains_inline_without_a_worker_or_cron(self):
+        cards = [{'name': 'Ada Lovelace', 'email': 'ada@example.com'}]
+        enqueue_cards(cards)
+        self.assertEqual(len(self.sheet.calls('append')), 1)
+        self.assertEqual(cards[0]['sheet_status'], VisitingCard.SHEET_SYNCED)
+        self.assertEqual(VisitingCard.objects.get().sheet_status, VisitingCard.SHEET_SYNCED)
+
+    @override_settings(SHEETS_OUTBOX_WORKER=False, SHEETS_OUTBOX_CRON=False)
+    def test_failed_inline_drain_leaves_cards_queued(self):
+        self.sheet.failures.extend(google_error(403) for _ in range(2))
+        cards = [{'name': 'Ada Lovelace', 'email': 'ada@example.com'}]
+        enqueue_cards(cards)
+        self.assertEqual(cards[0]['sheet_status'], VisitingCard.SHEET_QUEUED)
+        self.assertEqual(VisitingCard.objects.get().sheet_status, VisitingCard.SHEET_QUEUED)
+
+    @override_settings(SHEETS_OUTBOX_WORKER=False, SHEETS_OUTBOX_CRON=True)
+    def test_enqueue_leaves_the_drain_to_cron(self):
+        cards = [{'name': 'Ada Lovelace', 'email': 'ada@example.com'}]
+        enqueue_cards(cards)
+        self.assertEqual(self.sheet.requests, [])
+        self.assertEqual(cards[0]['sheet_status'], VisitingCard.SHEET_QUEUED)
+
+class SheetPullTests(FakeSheetsMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        enqueue_cards([
+            {'name': f'Contact {index}', 'email': f'contact{index}@example.com'} for index in range(3)
+        ], wake=False)
+        drain_outbox()
+        self.cards = list(VisitingCard.objects.order_by('pk'))
+        self.sheet.requests.clear()
+
+    def test_unchanged_sheet_changes_nothing(self):
+        stats = pull_sheet(full=True)
+        self.assertEqual((stats['rows'], stats['updated'], stats['created'], stats['moved']), (3, 0, 0, 0))
+        self.assertEqual(self.sheet.calls('batchUpdate'), [])
+
+    def test_new_row_becomes_a_contact_with_a_card_id(self):
+        self.sheet.rows.append(['Typed In', 'ACME', '', '', 'typed@example.com'])
+        self.assertEqual(pull_sheet(full=True)['created'], 1)
+
+        card = VisitingCard.objects.get(name='Typed In')
+        self.assertEqual(card.sheet_row, 5)
+        self.assertEqual(self.sheet.rows[4][8], str(card.sync_key))
+        self.assertEqual(pull_sheet(full=True)['created'], 0)
+
+    def test_failed_card_id_write_is_not_applied_twice(self):
+        self.sheet.rows.append(['Typed In', 'ACME', '', '', 'typed@example.com'])
+        with mock.patch.object(sheet_sync, 'write_card_ids', side_effect=UnavailableError('sheets', 'down')):
+            with self.assertRaises(UnavailableError):
+                pull_sheet(full=True)
+        self.assertFalse(VisitingCard.objects.filter(name='Typed In').exists())
+
+        pull_sheet(full=True)
+        self.assertEqual(VisitingCard.objects.filter(name='Typed In').count(), 1)
+
+    def test_edited_row_updates_its_contact(self):
+        self.sheet.rows[2][2] = 'Director'
+        stats = pull_sheet(full=True)
+        self.assertEqual((stats['updated'], stats['created']), (1, 0))
+        card = VisitingCard.objects.get(pk=self.cards[1].pk)
+        self.assertEqual(card.job_title, 'Director')
+        self.assertEqual(card.sheet_status, VisitingCard.SHEET_SYNCED)
+
+    def test_moved_rows_follow_their_card_ids(self):
+        self.sheet.rows[1], self.sheet.rows[3] = self.sheet.rows[3], self.sheet.rows[1]
+        stats = pull_sheet(full=True)
+        self.assertEqual((stats['moved'], stats['created']), (2, 0))
+        rows = dict(VisitingCard.objects.values_list('pk', 'sheet_row'))
+        self.assertEqual([rows[card.pk] for card in self.cards], [4, 3, 2])
+
+    @override_settings(SHEETS_PULL_PAGE_ROWS=2)
+    def test_card_id_copied_to_another_page_becomes_a_new_contact(self):
+        original = self.cards[0]
+        self.sheet.rows.append(list(self.sheet.rows[1]))
+        self.sheet.rows[4][0] = 'Copied Contact'
+
+        self.assertEqual(pull_sheet(full=True)['created'], 1)
+        copy = VisitingCard.objects.get(name='Copied Contact')
+        self.assertNotEqual(copy.sync_key, original.sync_key)
+        self.assertEqual(self.sheet.rows[4][8], str(copy.sync_key))
+        # Pulled again, neither row claims the other's contact
+        stats = pull_sheet(full=True)
+        self.assertEqual((stats['updated'], stats['created'], stats['moved']), (0, 0, 0))
+        self.assertEqual(VisitingCard.objects.get(pk=original.pk).sheet_row, 2)
+        self.assertEqual(VisitingCard.objects.get(pk=copy.pk).sheet_row, 5)
+
+class ClientRegistryTests(SimpleTestCase):
+    def setUp(self):
+        clients.reset_clients()
+        self.addCleanup(clients.reset_clients)
+
+    def in_thread(self, func):
+        result = []
+        thread = threading.Thread(target=lambda: result.append(func()))
+        thread.start()
+        thread.join()
+        return result[0]
+
+    def test_openai_client_is_shared_by_threads(self):
+        client = clients.get_openai_client()
+        self.assertIs(clients.get_openai_client(), client)
+        self.assertIs(self.in_thread(clients.get_openai_client), client)
+
+    def test_async_openai_client_is_per_event_loop(self):
+        async def twice():
+            return clients.get_async_openai_client(), clients.get_async_openai_client()
+
+        first, again = asyncio.run(twice())
+        self.assertIs(first, again)
+        other, _ = asyncio.run(twice())
+        self.assertIsNot(other, first)
+
+    def test_sheets_service_is_per_thread(self):
+        credentials = Credentials(token='token')
+        with mock.patch.object(clients, 'get_sheets_credentials', return_value=credentials):
+            service = clients.get_sheets_service()
+            self.assertIs(clients.get_sheets_service(), service)
+            self.assertIsNot(self.in_thread(clients.get_sheets_service), service)
+
+    def test_clients_are_rebuilt_in_a_new_process(self):
+        client = clients.get_openai_client()
+        # As seen by a forked worker, whose pid differs from the parent's
+        clients._registry['pid'] = None
+        self.assertIsNot(clients.get_openai_client(), client)
+
+class UploadTests(SimpleTestCase):
+    data = bytes(range(256)) * 32
+    digest = hashlib.sha256(data).hexdigest()
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        patcher = override_settings(UPLOAD_DIR=self.directory, UPLOAD_CHUNK_SIZE=4096)
+        patcher.enable()
+        self.addCleanup(patcher.disable)
+
+    def send(self, start, end, total=None, data=None, digest=None):
+        body = (data or self.data)[start:end + 1]
+        content_range = f"bytes {start}-{end}/{total or len(self.data)}"
+        return uploads.write_chunk(digest or self.digest, content_range, io.BytesIO(body))
+
+    def test_chunks_complete_an_upload(self):
+        self.assertEqual(self.send(0, 4095)['received'], 4096)
+        self.assertEqual(uploads.status(self.digest), {'digest': self.digest, 'received': 4096, 'complete': False})
+        self.assertTrue(self.send(4096, len(self.data) - 1)['complete'])
+        with uploads.open_upload(self.digest, 'card.jpg') as image:
+            self.assertEqual(image.read(), self.data)
+        self.assertEqual(os.listdir(self.directory), [self.digest])
+        # A finished upload is not written again
+        self.assertTrue(self.send(0, 4095)['complete'])
+
+    def test_chunk_at_the_wrong_offset_is_rejected(self):
+        self.send(0, 4095)
+        with self.assertRaises(uploads.UploadError) as raised:
+            self.send(0, 4095)
+        self.assertEqual((raised.exception.status, raised.exception.received), (409, 4096))
+
+    def test_total_must_match_the_first_chunk(self):
+        self.send(0, 4095)
+        with self.assertRaises(uploads.UploadError) as raised:
+            self.send(4096, 8191, total=len(self.data) + 1)
+        self.assertEqual((raised.exception.status, raised.exception.received), (409, 4096))
+
+    def test_content_must_match_the_digest(self):
+        with self.assertRaises(uploads.UploadError) as raised:
+            self.send(0, 4095, total=4096, digest='0' * 64)
+        self.assertEqual(raised.exception.status, 422)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_prune_removes_abandoned_uploads(self):
+        self.send(0, 4095)
+        with mock.patch.dict(uploads._last_prune, {'at': 0.0}):
+            uploads._prune()
+        self.assertEqual(len(os.listdir(self.directory)), 2)
+        with override_settings(UPLOAD_RETENTION=-1), mock.patch.dict(uploads._last_prune, {'at': 0.0}):
+            uploads._prune()
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_disabled_without_upload_dir(self):
+        with override_settings(UPLOAD_DIR=None):
+            self.assertFalse(uploads.enabled())
+            with self.assertRaises(uploads.UploadError) as raised:
+                uploads.status(self.digest)
+        self.assertEqual(raised.exception.status, 404)
+
+def encode(img, image_format='JPEG', **options):
+    output = io.BytesIO()
+    img.save(output, format=image_format, **options)
+    return output.getvalue()
+
+class CardDetectionTests(SimpleTestCase):
+    def close_up(self):
+        """One card filling the frame, with a logo and a QR-style block beside its text"""
+        img = Image.new('RGB', (1600, 1000), 'white')
+        draw = ImageDraw.Draw(img)
+        draw.rectangle((80, 80, 560, 360), fill=(200, 30, 40))
+        draw.rectangle((1100, 680, 1500, 920), fill=(20, 20, 20))
+        font = ImageFont.load_default(48)
+        for index, line in enumerate(['Jane Example', 'Head of Sales', 'ACME Corp', '+1 555 0100', 'jane@acme.test']):
+            draw.text((620, 120 + index * 90), line, font=font, fill=(30, 30, 30))
+        return img
+
+    def test_single_card_with_logo_is_not_split(self):
+        img = self.close_up()
+        self.assertEqual(card_detection.detect_cards(img), [])
+        self.assertEqual(card_detection.split_cards(ContentFile(encode(img), name='card.jpg')), [])
+
+    def test_photo_of_two_cards_is_split(self):
+        data, _ = make_image('multi', make_contacts(2), edge=2000, seed=1)
+        boxes = card_detection.detect_cards(Image.open(io.BytesIO(data)))
+        self.assertEqual(len(boxes), 2)
+        # Side by side, in reading order
+        self.assertLess(boxes[0][2], boxes[1][0])
+
+        crops = card_detection.split_cards(ContentFile(data, name='photo.jpg'))
+        self.assertEqual([crop.name for crop in crops], ['photo.jpg#1', 'photo.jpg#2'])
+        for crop in crops:
+            width, height = Image.open(crop).size
+            self.assertTrue(card_detection.MIN_ASPECT <= width / height <= card_detection.MAX_ASPECT)
+
+    def test_photo_of_one_card_is_not_split(self):
+        data, _ = make_image('photo', make_contacts(1), edge=2000, seed=1)
+        self.assertEqual(card_detection.split_cards(ContentFile(data, name='photo.jpg')), [])
+
+@override_settings(INTERNAL_API_TOKEN='s3cret')
+class InternalApiTests(TestCase):
+    urls = ['/contacts/', '/metrics', '/analyze/cache-stats/', '/analyze/parse-stats/']
+
+    def setUp(self):
+        self.client = Client(HTTP_HOST='localhost')
+        VisitingCard.objects.create(name='Jane Example', email='jane@acme.test')
+
+    def test_anonymous_requests_are_refused(self):
+        for url in self.urls:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, 401, url)
+            self.assertEqual(response['WWW-Authenticate'], 'Bearer')
+        response = self.client.get('/contacts/', HTTP_AUTHORIZATION='Bearer wrong')
+        self.assertEqual(response.status_code, 401)
+
+    def test_token_holders_get_in(self):
+        for url in self.urls:
+            response = self.client.get(url, HTTP_AUTHORIZATION='Bearer s3cret')
+            self.assertEqual(response.status_code, 200, url)
+        response = self.client.get('/contacts/', HTTP_AUTHORIZATION='Bearer s3cret')
+        self.assertEqual([card['name'] for card in response.json()['results']], ['Jane Example'])
+
+    def test_staff_sessions_get_in(self):
+        user = User.objects.create_user('ops', password='x')
+        self.client.force_login(user)
+        self.assertEqual(self.client.get('/contacts/').status_code, 401)
+        user.is_staff = True
+        user.save()
+        for url in self.urls:
+            self.assertEqual(self.client.get(url).status_code, 200, url)
+
+    @override_settings(INTERNAL_API_TOKEN='')
+    def test_no_token_configured_lets_no_bearer_in(self):
+        response = self.client.get('/contacts/', HTTP_AUTHORIZATION='Bearer ')
+        self.assertEqual(response.status_code, 401)
+
+class SingleFlightThreadTests(TransactionTestCase):
+    def in_thread(self, func, results):
+        def target():
+            try:
+                results.append(func())
+            finally:
+                connection.close()
+        thread = threading.Thread(target=target)
+        thread.start()
+        return thread
+
+    def test_concurrent_callers_share_one_run(self):
+        started, release = threading.Event(), threading.Event()
+        calls = []
+
+        def work():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return {'answer': 42}
+
+        before = single_flight.stats()
+        results = []
+        threads = [self.in_thread(lambda: single_flight.run('threads', work), results)]
+        self.assertTrue(started.wait(5))
+        threads += [self.in_thread(lambda: single_flight.run('threads', work), results) for _ in range(3)]
+        for _ in range(500):
+            if single_flight.stats()['joined'] - before['joined'] == 3:
+                break
+            threading.Event().wait(0.01)
+        release.set()
+        for thread in threads:
+            thread.join(5)
+
+        self.assertEqual(calls, [1])
+        self.assertEqual(results, [{'answer': 42}] * 4)
+        self.assertEqual(single_flight.stats()['joined'] - before['joined'], 3)
+        # Later callers get the retained result
+        self.assertEqual(single_flight.run('threads', work), {'answer': 42})
+        self.assertEqual(calls, [1])
+
+class SingleFlightRecordTests(TestCase):
+    def record(self, key, **fields):
+        fields.setdefault('expires_at', timezone.now() + timedelta(seconds=60))
+        return FlightRecord.objects.create(key=key, lease='other-process', **fields)
+
+    def test_waits_for_a_run_in_another_process(self):
+        self.record('elsewhere')
+        work = mock.Mock()
+
+        def other_process_finishes(seconds):
+            FlightRecord.objects.filter(key='elsewhere').update(state=FlightRecord.STATE_DONE, result={'answer': 7})
+
+        before = single_flight.stats()
+        with mock.patch.object(single_flight.time, 'sleep', side_effect=other_process_finishes) as sleep:
+            self.assertEqual(single_flight.run('elsewhere', work), {'answer': 7})
+        sleep.assert_called_once()
+        work.assert_not_called()
+        self.assertEqual(single_flight.stats()['waited'] - before['waited'], 1)
+
+    def test_stale_lease_is_taken_over(self):
+        self.record('stale', expires_at=timezone.now() - timedelta(seconds=1))
+        self.assertEqual(single_flight.run('stale', lambda: {'answer': 1}), {'answer': 1})
+        record = FlightRecord.objects.get(key='stale')
+        self.assertEqual((record.state, record.result), (FlightRecord.STATE_DONE, {'answer': 1}))
+        self.assertNotEqual(record.lease, 'other-process')
+
+    def test_key_held_for_other_work_is_refused(self):
+        self.record('taken', fingerprint='a')
+        with self.assertRaises(single_flight.FingerprintMismatch):
+            single_flight.run('taken', mock.Mock(), fingerprint='b')
+
+class IdempotencyKeyTests(TestCase):
+    def setUp(self):
+        self.calls = 0
+
+        def view(request):
+            self.calls += 1
+            return JsonResponse({'call': self.calls, 'size': request.FILES['images'].size})
+
+        async def async_view(request):
+            return view(request)
+
+        self.view = single_flight.idempotent(view)
+        self.async_view = single_flight.idempotent(async_view)
+
+    def upload(self, content, boundary='boundary-1', address='10.0.0.1', key='key-1'):
+        image = SimpleUploadedFile('card.jpg', content, content_type='image/jpeg')
+        return RequestFactory().post(
+            '/analyze/', encode_multipart(boundary, {'images': image}),
+            content_type=f'multipart/form-data; boundary={boundary}',
+            HTTP_IDEMPOTENCY_KEY=key, REMOTE_ADDR=address
+        )
+
+    def test_retry_of_the_same_upload_is_replayed(self):
+        self.assertEqual(self.view(self.upload(b'card')).status_code, 200)
+        response = self.view(self.upload(b'card', boundary='boundary-2'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, b'{"call": 1, "size": 4}')
+        self.assertEqual(self.calls, 1)
+
+    def test_key_reused_with_another_body_is_refused(self):
+        self.view(self.upload(b'card'))
+        self.assertEqual(self.view(self.upload(b'other card')).status_code, 422)
+        self.assertEqual(async_to_sync(self.async_view)(self.upload(b'other card')).status_code, 422)
+        self.assertEqual(self.calls, 1)
+
+    def test_keys_are_scoped_to_the_client(self):
+        self.view(self.upload(b'card'))
+        response = self.view(self.upload(b'other card', address='10.0.0.2'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.calls, 2)
+
+    def test_async_view_replays(self):
+        first = async_to_sync(self.async_view)(self.upload(b'card'))
+        again = async_to_sync(self.async_view)(self.upload(b'card', boundary='boundary-2'))
+        self.assertEqual(first.content, again.content)
+        self.assertEqual(self.calls, 1)
+
+class ImportCardsTests(TestCase):
+    def setUp(self):
+        self.server = start_stub_server()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        settings_override = override_settings(OPENAI_BASE_URL=f'{self.server.url}/v1')
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        clients.reset_clients()
+        self.addCleanup(clients.reset_clients)
+
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        for index, item in enumerate(build_corpus(3, kinds=('scan',), edge=800)):
+            with open(os.path.join(self.directory, f'card{index}.jpg'), 'wb') as f:
+                f.write(item['data'])
+        with open(os.path.join(self.directory, 'broken.jpg'), 'wb') as f:
+            f.write(b'not an image')
+
+    def import_cards(self):
+        call_command('import_cards', self.directory, '--poll-interval', '0', '--no-sync',
+                     stdout=io.StringIO(), stderr=io.StringIO())
+        with open(os.path.join(self.directory, '.import_manifest.json')) as f:
+            return json.load(f)
+
+    def test_import_and_rerun(self):
+        manifest = self.import_cards()
+        self.assertEqual(
+            {name: entry['status'] for name, entry in manifest['files'].items()},
+            {'card0.jpg': 'imported', 'card1.jpg': 'imported', 'card2.jpg': 'imported', 'broken.jpg': 'failed'}
+        )
+        # The stub reads the same contact off every card, so they merge
+        card = VisitingCard.objects.get()
+        self.assertEqual((card.name, card.scan_count), ('Jane Doe', 3))
+        self.assertEqual(card.sheet_status, VisitingCard.SHEET_QUEUED)
+        calls = dict(self.server.state.calls)
+        self.assertEqual((calls['files.create'], calls['batches.create']), (1, 1))
+
+        self.import_cards()
+        self.assertEqual(self.server.state.calls['files.create'], 1)
+        self.assertEqual(self.server.state.calls['batches.create'], 1)
+        self.assertEqual(VisitingCard.objects.get().scan_count, 3)
+
+    def test_interrupted_run_resumes_without_uploading_again(self):
+        with mock.patch('openai.resources.batches.Batches.create', side_effect=KeyboardInterrupt):
+            with self.assertRaises(KeyboardInterrupt):
+                self.import_cards()
+        self.assertEqual(self.server.state.calls['files.create'], 1)
+
+        manifest = self.import_cards()
+        self.assertEqual(manifest['uploads'], {})
+        self.assertEqual(self.server.state.calls['files.create'], 1)
+        self.assertEqual(self.server.state.calls['batches.create'], 1)
+        self.assertEqual(VisitingCard.objects.get().scan_count, 3)
+
+class PhoneValidatorTests(SimpleTestCase):
+    def test_common_formats(self):
+        for value in ['+1 555 0100', '(555) 010-0100', '022/1234 5678', '+49 30/1234-567', '555.010.0100 ext. 12']:
+            self.assertTrue(model_routing.valid_phone(value), value)
+
+    def test_rejects_text_and_wrong_lengths(self):
+        for value in ['call me', '12345', '+1 555 0100 0100 0100 99', 'jane@acme.test']:
+            self.assertFalse(model_routing.valid_phone(value), value)
+
+class PreprocessTests(SimpleTestCase):
+    def decoded(self, data):
+        return Image.open(io.BytesIO(data))
+
+    def test_exif_orientation_is_applied(self):
+        exif = Image.Exif()
+        exif[0x0112] = 6  # rotated 90 degrees clockwise
+        data = encode(Image.new('RGB', (400, 200), 'white'), exif=exif.tobytes())
+
+        output, mime_type = preprocess_image(data, max_edge=1024, image_format='JPEG')
+        self.assertEqual(mime_type, 'image/jpeg')
+        img = self.decoded(output)
+        self.assertEqual(img.size, (200, 400))
+        self.assertFalse(img.getexif())
+
+    @override_settings(VISION_IMAGE_MAX_EDGE=1024)
+    def test_downscales_to_the_longest_edge(self):
+        data = encode(Image.new('RGB', (3000, 1500), 'white'), 'PNG')
+        output, _ = preprocess_image(io.BytesIO(data))
+        self.assertEqual(self.decoded(output).size, (1024, 512))
+
+    def test_transparency_is_flattened_onto_white(self):
+        data = encode(Image.new('RGBA', (100, 100), (0, 0, 0, 0)), 'PNG')
+        output, _ = preprocess_image(data, max_edge=1024, image_format='JPEG')
+        img = self.decoded(output)
+        self.assertEqual(img.mode, 'RGB')
+        self.assertGreater(min(img.getpixel((50, 50))), 250)
+
+    def test_prepared_image_is_sent_unchanged(self):
+        data = encode(Image.new('RGB', (800, 500), 'white'))
+        self.assertEqual(preprocess_image(data, max_edge=1024, image_format='JPEG'), (data, 'image/jpeg'))
+
+    def test_non_image_is_rejected(self):
+        for source in (b'not an image', io.BytesIO(b'%PDF-1.4')):
+            with self.assertRaises(ValueError):
+                preprocess_image(source)
+            with self.assertRaises(ValueError):
+                detect_mime(source)
+
+class ReplyParsingTests(SimpleTestCase):
+    card = {'name': 'Jane Doe', 'business_name': 'Acme Corp', 'contact_number': '+1 555 0100'}
+
+    def test_plain_json_needs_no_fallback(self):
+        reply = json.dumps({'cards': [self.card]})
+        self.assertEqual(_decode_json(reply), ({'cards': [self.card]}, False))
+
+    def test_fenced_json(self):
+        reply = f"```json\n{json.dumps(self.card)}\n```"
+        self.assertEqual(_decode_json(reply), (self.card, True))
+
+    def test_trailing_text(self):
+        reply = f"Here is the card:\n{json.dumps(self.card)}\nLet me know if you need more."
+        self.assertEqual(_decode_json(reply), (self.card, True))
+
+    def test_truncated_list_keeps_complete_cards(self):
+        reply = '[' + json.dumps(self.card) + ', {"name": "Cut O'
+        self.assertEqual(_decode_json(reply), (self.card, True))
+
+    def test_no_json_raises(self):
+        with self.assertRaises(ValueError):
+            _decode_json("I could not read this card.")
+
+    def test_recovered_replies_are_counted_and_normalized(self):
+        before = parse_stats()
+        cards = extract_card_details('Sure! {"Name": "Jane Doe", "Company": "Acme Corp", "Phone": "+1 555 0100"} Done.')
+        self.assertEqual(cards[0]['name'], 'Jane Doe')
+        self.assertEqual(cards[0]['contact_number'], '+1 555 0100')
+        after = parse_stats()
+        self.assertEqual(after['recovered'] - before['recovered'], 1)
+        self.assertEqual(after['parsed'], before['parsed'])
+
+# analyze/ runs images on worker threads, whose database connections do not
+# share a test case's transaction. One at a time: the in-memory test database
+# locks whole tables against concurrent writers.
+@override_settings(SHEETS_OUTBOX_CRON=True, CARD_DETECTION_ENABLED=False, ANALYZE_MAX_WORKERS=1)
+class AsyncAnalyzeViewTests(TransactionTestCase):
+    def setUp(self):
+        self.server = start_stub_server()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        settings_override = override_settings(OPENAI_BASE_URL=f'{self.server.url}/v1')
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        clients.reset_clients()
+        self.addCleanup(clients.reset_clients)
+        self.client = Client(HTTP_HOST='localhost', enforce_csrf_checks=True)
+
+    def post(self, url, color):
+        images = [
+            SimpleUploadedFile('card.jpg', encode(Image.new('RGB', (800, 500), color)), content_type='image/jpeg'),
+            SimpleUploadedFile('notes.txt', b'not an image', content_type='text/plain'),
+        ]
+        return self.client.post(url, {'images': images})
+
+    def test_matches_the_sync_view(self):
+        # Different images, so neither response is a replay of the other
+        sync = self.post('/analyze/', 'white')
+        async_ = self.post('/analyze/async/', 'ivory')
+        self.assertEqual(sync.status_code, 200)
+        self.assertEqual(async_.status_code, 200)
+        self.assertEqual(async_.json(), sync.json())
+        self.assertEqual(async_.json()['results'][0]['name'], 'Jane Doe')
+        self.assertIn('error', async_.json()['results'][1])
+        self.assertEqual(self.server.state.calls['chat.completions'], 2)
+
+    def test_is_exempt_from_csrf_checks(self):
+        self.assertEqual(self.client.post('/analyze/async/').status_code, 400)
+        # Views without the exemption refuse such a post
+        self.assertEqual(self.client.post('/admin/login/').status_code, 403)
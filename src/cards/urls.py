@@ -4,4 +4,13 @@ from . import views
 urlpatterns = [
     path('', views.index, name='index'),
     path('analyze/', views.analyze_card, name='analyze_card'),
+    path('analyze/async/', views.analyze_card_async, name='analyze_card_async'),
+    path('analyze/cache-stats/', views.cache_stats, name='cache_stats'),
+    path('analyze/parse-stats/', views.response_stats, name='parse_stats'),
+    path('contacts/', views.contact_list, name='contact_list'),
+    path('metrics', views.metrics_view, name='metrics'),
+    path('uploads/<str:digest>/', views.upload_image, name='upload_image'),
+    path('analyze/jobs/', views.create_job, name='create_job'),
+    path('analyze/jobs/<str:job_id>/', views.job_status, name='job_status'),
+    path('analyze/jobs/<str:job_id>/stream/', views.job_stream, name='job_stream'),
 ]
\ No newline at end of file
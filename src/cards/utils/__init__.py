@@ -1,7 +1,8 @@
 from .sheets_helper import (
     initialize_sheet,
     append_to_sheet as append_to_google_sheet,
+    append_rows,
     get_sheet_data as get_google_sheet_data
 )
 
-__all__ = ['initialize_sheet', 'append_to_google_sheet', 'get_google_sheet_data']
\ No newline at end of file
+__all__ = ['initialize_sheet', 'append_to_google_sheet', 'append_rows', 'get_google_sheet_data']
\ No newline at end of file
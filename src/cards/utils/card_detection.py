@@ -0,0 +1,199 @@
+import io
+import math
+import logging
+from typing import List, Tuple
+import numpy as np
+from django.conf import settings
+from django.core.files.base import ContentFile
+from PIL import Image, ImageOps, UnidentifiedImageError
+from .image_preprocess import decode_slot
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+# Detection runs on a small grayscale copy; cards stay well above this size
+DETECTION_EDGE = 512
+# Width/height ratios accepted as card-shaped (ISO ID-1 is 1.59, US 1.75)
+MIN_ASPECT = 1.2
+MAX_ASPECT = 2.2
+# Smallest card area as a fraction of the photo
+MIN_AREA_FRACTION = 0.02
+# Share of a box that must be foreground for it to count as a solid card
+MIN_FILL = 0.6
+# Rows/columns with less foreground than this are treated as gaps
+GAP_THRESHOLD = 0.08
+# On a close-up of one card, solid blocks (logos, QR codes) can pass for
+# cards on their own. Real cards carry print: each box needs this share of
+# ink pixels inside it, and together the boxes must hold this share of all
+# the ink in the photo (the text around a logo is outside any box).
+MIN_INK = 0.02
+MIN_INK_COVERAGE = 0.75
+# Local contrast (in gray levels) that counts as ink
+INK_CONTRAST = 24
+
+Box = Tuple[int, int, int, int]  # left, top, right, bottom
+
+def _box_blur(values: np.ndarray, radius: int) -> np.ndarray:
+    """Mean filter using an integral image"""
+    size = 2 * radius + 1
+    padded = np.pad(values, radius + 1, mode='edge').astype(np.float64)
+    integral = padded.cumsum(axis=0).cumsum(axis=1)
+    total = (integral[size:, size:] - integral[:-size, size:]
+             - integral[size:, :-size] + integral[:-size, :-size])
+    return total[:values.shape[0], :values.shape[1]] / (size * size)
+
+def _otsu_threshold(values: np.ndarray) -> float:
+    """Threshold that best separates a bimodal value distribution"""
+    hist, edges = np.histogram(values, bins=256)
+    hist = hist.astype(np.float64)
+    centers = (edges[:-1] + edges[1:]) / 2
+    weight_low = hist.cumsum()
+    weight_high = weight_low[-1] - weight_low
+    sum_low = (hist * centers).cumsum()
+    mean_low = sum_low / np.maximum(weight_low, 1)
+    mean_high = (sum_low[-1] - sum_low) / np.maximum(weight_high, 1)
+    variance = weight_low * weight_high * (mean_low - mean_high) ** 2
+    return centers[int(np.argmax(variance))]
+
+def foreground_mask(gray: np.ndarray) -> np.ndarray:
+    """Separate cards from the surface they lie on.
+
+    The photo border is assumed to be mostly background, so pixels that
+    differ strongly from the border's median tone are foreground. Blurring
+    first merges printed text into its card.
+    """
+    smooth = _box_blur(gray, max(1, min(gray.shape) // 100))
+    border = np.concatenate([smooth[0], smooth[-1], smooth[:, 0], smooth[:, -1]])
+    difference = np.abs(smooth - np.median(border))
+    if difference.max() < 16:
+        return np.zeros(gray.shape, dtype=bool)
+    return difference > _otsu_threshold(difference)
+
+def ink_mask(gray: np.ndarray) -> np.ndarray:
+    """Printed detail: pixels that stand out from their surroundings"""
+    radius = max(1, min(gray.shape) // 100)
+    return np.abs(_box_blur(gray, 1) - _box_blur(gray, 4 * radius)) > INK_CONTRAST
+
+def _printed(ink: np.ndarray, boxes: List[Box]) -> bool:
+    """Whether ``boxes`` look like printed cards rather than solid blocks"""
+    # Stay clear of box edges, where the contrast is the card's outline
+    pad = 5 * max(1, min(ink.shape) // 100)
+    for left, top, right, bottom in boxes:
+        interior = ink[top + pad:bottom - pad, left + pad:right - pad]
+        if not interior.size or interior.mean() < MIN_INK:
+            return False
+    inside = np.zeros(ink.shape, dtype=bool)
+    for left, top, right, bottom in boxes:
+        inside[max(0, top - pad):bottom + pad, max(0, left - pad):right + pad] = True
+    return ink[inside].sum() >= MIN_INK_COVERAGE * ink.sum()
+
+def _segments(profile: np.ndarray, min_gap: int) -> List[Tuple[int, int]]:
+    """Split a projection profile into runs separated by gaps"""
+    filled = profile >= GAP_THRESHOLD
+    segments = []
+    start = None
+    gap = 0
+    for index, value in enumerate(filled):
+        if value:
+            if start is None:
+                start = index
+            gap = 0
+        elif start is not None:
+            gap += 1
+            if gap >= min_gap:
+                segments.append((start, index - gap + 1))
+                start = None
+                gap = 0
+    if start is not None:
+        segments.append((start, len(profile) - gap))
+    return segments
+
+def _xy_cut(mask: np.ndarray, left: int, top: int, min_gap: int, depth: int = 0) -> List[Box]:
+    """Recursively split a mask along empty rows and columns (XY-cut)"""
+    rows = _segments(mask.mean(axis=1), min_gap)
+    cols = _segments(mask.mean(axis=0), min_gap)
+    if depth < 8:
+        if len(rows) > 1:
+            return [box for r0, r1 in rows
+                    for box in _xy_cut(mask[r0:r1], left, top + r0, min_gap, depth + 1)]
+        if len(cols) > 1:
+            return [box for c0, c1 in cols
+                    for box in _xy_cut(mask[:, c0:c1], left + c0, top, min_gap, depth + 1)]
+    if not rows or not cols:
+        return []
+    return [(left + cols[0][0], top + rows[0][0], left + cols[0][1], top + rows[0][1])]
+
+def detect_cards(img: Image.Image) -> List[Box]:
+    """Find card-shaped rectangles in a photo.
+
+    Returns boxes in the coordinates of ``img``, in reading order. Cards
+    must be roughly axis-aligned and separated by some visible background.
+    Returns no boxes when they do not look like printed cards, e.g. the
+    logo and QR code on a close-up of a single card.
+    """
+    scale = min(1.0, DETECTION_EDGE / max(img.size))
+    small = img.convert('L').resize(
+        (max(1, round(img.width * scale)), max(1, round(img.height * scale))),
+        Image.BILINEAR
+    )
+    gray = np.asarray(small, dtype=np.float64)
+    mask = foreground_mask(gray)
+    min_gap = max(2, min(mask.shape) // 100)
+
+    found = []
+    min_area = MIN_AREA_FRACTION * mask.size
+    for left, top, right, bottom in _xy_cut(mask, 0, 0, min_gap):
+        width, height = right - left, bottom - top
+        if width * height < min_area:
+            continue
+        aspect = max(width, height) / max(1, min(width, height))
+        if not MIN_ASPECT <= aspect <= MAX_ASPECT:
+            continue
+        if mask[top:bottom, left:right].mean() < MIN_FILL:
+            continue
+        found.append((left, top, right, bottom))
+
+    if not found or not _printed(ink_mask(gray), found):
+        return []
+    return [
+        (math.floor(left / scale), math.floor(top / scale),
+         min(img.width, math.ceil(right / scale)), min(img.height, math.ceil(bottom / scale)))
+        for left, top, right, bottom in found
+    ]
+
+def split_cards(image_file) -> List[ContentFile]:
+    """Crop each card in a multi-card photo into its own image.
+
+    Returns an empty list when fewer than two cards are found, so callers
+    fall back to analyzing the whole image. Crops are encoded as
+    high-quality JPEGs and named after the upload (``photo.jpg#1`` ...).
+    """
+    max_edge = settings.CARD_DETECTION_MAX_EDGE
+    try:
+        image_file.seek(0)
+        with decode_slot(), Image.open(image_file) as img:
+            if img.format == 'JPEG' and max(img.size) > max_edge:
+                scale = max_edge / max(img.size)
+                img.draft(img.mode, (math.ceil(img.width * scale), math.ceil(img.height * scale)))
+            img = ImageOps.exif_transpose(img)
+            if img.mode != 'RGB':
+                img = img.convert('RGB')
+
+            boxes = detect_cards(img)
+            if len(boxes) < 2 or len(boxes) > settings.CARD_DETECTION_MAX_CARDS:
+                logger.debug("Card detection found %d cards, using whole image", len(boxes))
+                return []
+
+            crops = []
+            for index, box in enumerate(boxes, start=1):
+                output = io.BytesIO()
+                img.crop(box).save(output, format='JPEG', quality=92)
+                crops.append(ContentFile(output.getvalue(), name=f"{image_file.name}#{index}"))
+    except (UnidentifiedImageError, OSError, Image.DecompressionBombError) as e:
+        logger.warning("Card detection skipped for %s: %s", image_file.name, e)
+        return []
+    finally:
+        image_file.seek(0)
+
+    logger.info("Detected %d cards in %s", len(crops), image_file.name)
+    return crops
@@ -0,0 +1,178 @@
+import os
+import json
+import asyncio
+import threading
+import weakref
+import logging
+from django.conf import settings
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+SHEETS_SCOPES = ['https://www.googleapis.com/auth/spreadsheets']
+# Sheets v4 discovery document from google-api-python-client 2.120.0, trimmed
+# to the spreadsheets.values methods the app calls and the schemas they use.
+# Building from it skips reading and parsing the full 285 KB document.
+SHEETS_DISCOVERY_DOCUMENT = os.path.join(os.path.dirname(__file__), 'discovery', 'sheets.v4.json')
+
+# Process-wide client registry. Everything in here is created lazily on first
+# use and dropped again after a fork, so gunicorn pre-fork workers never share
+# sockets or TLS sessions with the master process.
+_lock = threading.Lock()
+_registry = {
+    'pid': None,
+    'openai': None,
+    'sheets_credentials': None,
+    'sheets_discovery': None,
+}
+# googleapiclient service objects sit on top of httplib2, which is not
+# thread-safe, so each thread gets its own service sharing one set of
+# credentials.
+_local = threading.local()
+# Async connections belong to the event loop that opened them, so AsyncOpenAI
+# clients are kept per loop (one per ASGI worker process in practice).
+_async_openai = weakref.WeakKeyDictionary()
+
+def _check_pid() -> None:
+    """Drop clients inherited from a parent process"""
+    if _registry['pid'] != os.getpid():
+        reset_clients()
+
+def reset_clients() -> None:
+    """Forget all cached clients; the next call builds fresh ones"""
+    _registry['pid'] = os.getpid()
+    _registry['openai'] = None
+    _registry['sheets_credentials'] = None
+    _registry['sheets_discovery'] = None
+    _local.__dict__.clear()
+    _async_openai.clear()
+
+def _after_fork_in_child() -> None:
+    # The parent may have held the lock while forking
+    global _lock
+    _lock = threading.Lock()
+    reset_clients()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_after_fork_in_child)
+
+def get_openai_client():
+    """Return the shared OpenAI client for this process.
+
+    The client is thread-safe and keeps a pool of keep-alive connections,
+    so concurrent image analyses reuse TLS sessions instead of opening a
+    new one per card.
+    """
+    _check_pid()
+    client = _registry['openai']
+    if client is None:
+        with _lock:
+            client = _registry['openai']
+            if client is None:
+                from openai import OpenAI, DefaultHttpxClient
+                import httpx
+
+                logger.info("Creating shared OpenAI client")
+                client = OpenAI(
+                    api_key=settings.OPENAI_API_KEY,
+                    base_url=settings.OPENAI_BASE_URL or None,
+                    timeout=settings.OPENAI_TIMEOUT,
+                    http_client=DefaultHttpxClient(
+                        limits=httpx.Limits(
+                            max_connections=settings.OPENAI_MAX_CONNECTIONS,
+                            max_keepalive_connections=settings.OPENAI_MAX_CONNECTIONS,
+                        )
+                    ),
+                )
+                _registry['openai'] = client
+    return client
+
+def get_async_openai_client():
+    """Return the shared AsyncOpenAI client for the running event loop.
+
+    One client serves every request on the loop, so its pool is sized by
+    OPENAI_ASYNC_MAX_CONNECTIONS rather than by a number of threads.
+    """
+    _check_pid()
+    loop = asyncio.get_running_loop()
+    client = _async_openai.get(loop)
+    if client is None:
+        with _lock:
+            client = _async_openai.get(loop)
+            if client is None:
+                from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+                import httpx
+
+                logger.info("Creating shared AsyncOpenAI client")
+                client = AsyncOpenAI(
+                    api_key=settings.OPENAI_API_KEY,
+                    base_url=settings.OPENAI_BASE_URL or None,
+                    timeout=settings.OPENAI_TIMEOUT,
+                    http_client=DefaultAsyncHttpxClient(
+                        limits=httpx.Limits(
+                            max_connections=settings.OPENAI_ASYNC_MAX_CONNECTIONS,
+                            max_keepalive_connections=settings.OPENAI_ASYNC_MAX_CONNECTIONS,
+                        )
+                    ),
+                )
+                _async_openai[loop] = client
+    return client
+
+def get_sheets_credentials():
+    """Return the shared service-account credentials for this process.
+
+    The key file is read once. Access tokens are refreshed on demand by the
+    authorized HTTP transport whenever they expire.
+    """
+    _check_pid()
+    credentials = _registry['sheets_credentials']
+    if credentials is None:
+        with _lock:
+            credentials = _registry['sheets_credentials']
+            if credentials is None:
+                from google.oauth2 import service_account
+
+                logger.info("Loading Google service account credentials")
+                credentials = service_account.Credentials.from_service_account_file(
+                    settings.GOOGLE_APPLICATION_CREDENTIALS,
+                    scopes=SHEETS_SCOPES
+                )
+                _registry['sheets_credentials'] = credentials
+    return credentials
+
+def _sheets_discovery():
+    discovery = _registry['sheets_discovery']
+    if discovery is None:
+        with open(SHEETS_DISCOVERY_DOCUMENT) as f:
+            discovery = _registry['sheets_discovery'] = json.load(f)
+    return discovery
+
+def get_sheets_service():
+    """Return a Google Sheets service for the calling thread.
+
+    The service is built once per thread from the discovery document bundled
+    with the app and keeps its HTTP connection open between calls. The
+    Google client libraries are imported on first use, not at startup.
+    """
+    _check_pid()
+    service = getattr(_local, 'sheets_service', None)
+    if service is None:
+        import httplib2
+        from google_auth_httplib2 import AuthorizedHttp
+        from googleapiclient.discovery import build_from_document
+
+        client_options = None
+        if settings.GOOGLE_SHEETS_API_ENDPOINT:
+            client_options = {'api_endpoint': settings.GOOGLE_SHEETS_API_ENDPOINT}
+
+        http = AuthorizedHttp(
+            get_sheets_credentials(),
+            http=httplib2.Http(timeout=settings.GOOGLE_SHEETS_TIMEOUT)
+        )
+        service = build_from_document(
+            _sheets_discovery(),
+            http=http,
+            client_options=client_options
+        )
+        _local.sheets_service = service
+    return service
@@ -0,0 +1,47 @@
+import re
+import hashlib
+import unicodedata
+from typing import Any, Dict, Optional
+
+# Separators between several numbers in one field ("+1 555 0100, +1 555 0199")
+PHONE_SEPARATORS = re.compile(r'[,;/|]|\s{2,}')
+
+def normalize_text(value: Any) -> str:
+    """Lowercase, accent-free, single-spaced text for keys and prefix search"""
+    text = unicodedata.normalize('NFKD', str(value or ''))
+    text = ''.join(char for char in text if not unicodedata.combining(char))
+    return ' '.join(re.sub(r'[^\w\s]', ' ', text.lower()).split())
+
+def normalize_email(value: Any) -> str:
+    return str(value or '').strip().lower()
+
+def normalize_phone(value: Any) -> str:
+    """Digits of the first number in a phone field"""
+    first = PHONE_SEPARATORS.split(str(value or '').strip())[0]
+    return re.sub(r'\D', '', first)
+
+def dedup_key(fields: Dict[str, Any]) -> Optional[str]:
+    """Identity of a contact across scans.
+
+    The normalized name plus the most specific contact detail available:
+    email, then phone, then business name. Returns None when there is not
+    enough to tell contacts apart.
+    """
+    name = normalize_text(fields.get('name'))
+    detail = (
+        normalize_email(fields.get('email'))
+        or normalize_phone(fields.get('contact_number'))
+        or normalize_text(fields.get('business_name'))
+    )
+    if not name or not detail:
+        return None
+    return hashlib.sha1(f"{name}\0{detail}".encode('utf-8')).hexdigest()
+
+def contact_keys(fields: Dict[str, Any]) -> Dict[str, Any]:
+    """Derived lookup columns for a VisitingCard's contact fields"""
+    return {
+        'normalized_phone': normalize_phone(fields.get('contact_number'))[:32],
+        'name_key': normalize_text(fields.get('name'))[:255],
+        'business_key': normalize_text(fields.get('business_name'))[:255],
+        'dedup_key': dedup_key(fields),
+    }
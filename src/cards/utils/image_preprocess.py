@@ -0,0 +1,183 @@
+import io
+import math
+import mmap
+import threading
+import logging
+from contextlib import contextmanager
+from typing import Iterator, Optional, Tuple, Union
+from django.conf import settings
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+# Bytes, a buffer or a seekable file object
+ImageSource = Union[bytes, bytearray, memoryview, io.IOBase]
+
+@contextmanager
+def image_buffer(image_file) -> Iterator[memoryview]:
+    """Give read-only access to an upload's bytes without copying them.
+
+    Uploads spooled to disk (``TemporaryUploadedFile``) are memory-mapped,
+    in-memory uploads expose their existing buffer, and anything else is
+    read in chunks into a single preallocated buffer.
+    """
+    if hasattr(image_file, 'temporary_file_path'):
+        with open(image_file.temporary_file_path(), 'rb') as f:
+            if image_file.size == 0:
+                yield memoryview(b'')
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                view = memoryview(mapped)
+                try:
+                    yield view
+                finally:
+                    view.release()
+        return
+
+    raw = getattr(image_file, 'file', image_file)
+    if hasattr(raw, 'getbuffer'):
+        view = raw.getbuffer()
+        readonly = view.toreadonly()
+        try:
+            yield readonly
+        finally:
+            # The BytesIO cannot be closed while exports are alive
+            readonly.release()
+            view.release()
+        return
+
+    buffer = bytearray(image_file.size)
+    view = memoryview(buffer)
+    offset = 0
+    image_file.seek(0)
+    for chunk in image_file.chunks():
+        view[offset:offset + len(chunk)] = chunk
+        offset += len(chunk)
+    image_file.seek(0)
+    readonly = view[:offset].toreadonly()
+    try:
+        yield readonly
+    finally:
+        readonly.release()
+        view.release()
+
+def _open(source: ImageSource) -> Image.Image:
+    if hasattr(source, 'read'):
+        source.seek(0)
+        return Image.open(source)
+    return Image.open(io.BytesIO(source))
+
+def detect_mime(source: ImageSource) -> str:
+    """Detect the MIME type of an image from its content.
+
+    Raises ValueError for content Pillow cannot identify as an image (e.g.
+    HEIC without a plugin), so it is never sent to the vision API under a
+    guessed type.
+    """
+    try:
+        with _open(source) as img:
+            mime_type = Image.MIME.get(img.format)
+    except (UnidentifiedImageError, OSError):
+        raise ValueError("Not a supported image format")
+    finally:
+        if hasattr(source, 'seek'):
+            source.seek(0)
+    if mime_type is None:
+        raise ValueError("Not a supported image format")
+    return mime_type
+
+_decode_lock = threading.Lock()
+_decode_slots = None
+
+def decode_slot() -> threading.BoundedSemaphore:
+    """Process-wide cap on images being decoded at the same time"""
+    global _decode_slots
+    with _decode_lock:
+        if _decode_slots is None:
+            _decode_slots = threading.BoundedSemaphore(settings.VISION_PREPROCESS_CONCURRENCY)
+        return _decode_slots
+
+def preprocess_options() -> dict:
+    """Current preprocessing settings, e.g. for use in cache keys"""
+    return {
+        'enabled': settings.VISION_PREPROCESS_ENABLED,
+        'max_edge': settings.VISION_IMAGE_MAX_EDGE,
+        'format': settings.VISION_IMAGE_FORMAT,
+        'quality': settings.VISION_IMAGE_QUALITY,
+        'grayscale': settings.VISION_IMAGE_GRAYSCALE,
+    }
+
+def preprocess_image(source: ImageSource,
+                     max_edge: Optional[int] = None,
+                     image_format: Optional[str] = None,
+                     quality: Optional[int] = None,
+                     grayscale: Optional[bool] = None) -> Tuple[bytes, str]:
+    """Prepare an uploaded image for the vision API.
+
+    Applies the EXIF orientation, downscales so the longest edge is at most
+    ``max_edge`` pixels, optionally converts to grayscale and re-encodes as
+    JPEG or WebP. Re-encoding drops EXIF and other metadata. RGB images
+    already in that format and size and without EXIF data (as the browser
+    prepares them) are sent unchanged. Arguments left as None fall back to
+    the VISION_IMAGE_* settings.
+
+    ``source`` may be bytes or a file object, which Pillow reads directly
+    rather than from an in-memory copy. At most VISION_PREPROCESS_CONCURRENCY
+    images are decoded at once per process, which bounds the memory spent on
+    decoded pixels.
+
+    Returns the bytes to send and their MIME type. Images Pillow identifies
+    but cannot decode are passed through unchanged; content it cannot
+    identify raises ValueError.
+    """
+    max_edge = settings.VISION_IMAGE_MAX_EDGE if max_edge is None else max_edge
+    image_format = (image_format or settings.VISION_IMAGE_FORMAT).upper()
+    quality = settings.VISION_IMAGE_QUALITY if quality is None else quality
+    grayscale = settings.VISION_IMAGE_GRAYSCALE if grayscale is None else grayscale
+
+    try:
+        with decode_slot(), _open(source) as img:
+            if (img.format == image_format and img.mode == 'RGB' and not grayscale
+                    and not (max_edge and max(img.size) > max_edge) and not img.getexif()):
+                # Already shrunk and re-encoded, e.g. by the browser before
+                # upload: decoding and encoding again would only lose quality
+                logger.debug("Image is already prepared, sending it unchanged")
+                if hasattr(source, 'read'):
+                    source.seek(0)
+                    return source.read(), Image.MIME[image_format]
+                return bytes(source), Image.MIME[image_format]
+            if max_edge and img.format == 'JPEG' and max(img.size) > max_edge:
+                # Let the JPEG decoder downscale by 1/2..1/8 while decoding,
+                # which is much faster than decoding at full size
+                scale = max_edge / max(img.size)
+                img.draft(img.mode, (math.ceil(img.width * scale), math.ceil(img.height * scale)))
+            img = ImageOps.exif_transpose(img)
+            if max_edge and max(img.size) > max_edge:
+                img.thumbnail((max_edge, max_edge), Image.LANCZOS)
+
+            if grayscale:
+                img = img.convert('L')
+            elif img.mode != 'RGB':
+                # Flatten transparency onto white; JPEG has no alpha channel
+                img = img.convert('RGBA')
+                background = Image.new('RGB', img.size, (255, 255, 255))
+                background.paste(img, mask=img.getchannel('A'))
+                img = background
+
+            output = io.BytesIO()
+            img.save(output, format=image_format, quality=quality)
+    except Image.DecompressionBombError as e:
+        raise ValueError(f"Image is too large to process: {str(e)}")
+    except UnidentifiedImageError:
+        raise ValueError("Not a supported image format")
+    except OSError as e:
+        logger.warning("Could not preprocess image, sending it unchanged: %s", e)
+        if hasattr(source, 'read'):
+            source.seek(0)
+            return source.read(), detect_mime(source)
+        return source, detect_mime(source)
+
+    processed = output.getvalue()
+    logger.debug("Preprocessed image to %d bytes", len(processed))
+    return processed, Image.MIME[image_format]
@@ -0,0 +1,200 @@
+import os
+import json
+import time
+import uuid
+import asyncio
+import tempfile
+import threading
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, List, Optional
+from django.conf import settings
+from django.core.files import File
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+# Analysis jobs live in memory in the process that accepted the upload, so
+# the stream must be read from the same process (single worker or sticky
+# routing). Finished jobs are kept for JOB_RETENTION seconds.
+_lock = threading.Lock()
+_jobs: Dict[str, 'Job'] = {}
+_executor = {'pid': None, 'pool': None}
+
+class Job:
+    """An upload being analyzed in the background.
+
+    Progress is an append-only list of events. Readers keep a cursor (the
+    ``seq`` of the last event they saw) and wait for new events, either on
+    a thread (``wait``) or on an event loop (``wait_async``), so a stream
+    can resume after a dropped connection.
+    """
+
+    def __init__(self, total: int):
+        self.id = uuid.uuid4().hex
+        self.total = total
+        self.completed = 0
+        self.contacts = 0
+        self.finished = False
+        self.finished_at = None
+        self.events: List[Dict[str, Any]] = []
+        self._condition = threading.Condition()
+        self._async_waiters = set()
+
+    def publish(self, event: Dict[str, Any]) -> None:
+        with self._condition:
+            event['seq'] = len(self.events) + 1
+            self.events.append(event)
+            if event['type'] == 'done':
+                self.finished = True
+                self.finished_at = time.monotonic()
+            self._condition.notify_all()
+            waiters = list(self._async_waiters)
+
+        for loop, ready in waiters:
+            try:
+                loop.call_soon_threadsafe(ready.set)
+            except RuntimeError:
+                # The reader's event loop has already closed
+                pass
+
+    def events_after(self, cursor: int) -> List[Dict[str, Any]]:
+        with self._condition:
+            return self.events[cursor:]
+
+    def _has_news(self, cursor: int) -> bool:
+        return self.finished or len(self.events) > cursor
+
+    def wait(self, cursor: int, timeout: float) -> bool:
+        """Block until there are events after ``cursor``; False on timeout"""
+        with self._condition:
+            return self._condition.wait_for(lambda: self._has_news(cursor), timeout)
+
+    async def wait_async(self, cursor: int, timeout: float) -> bool:
+        """Like ``wait`` but suspends the coroutine instead of a thread"""
+        waiter = (asyncio.get_running_loop(), asyncio.Event())
+        with self._condition:
+            if self._has_news(cursor):
+                return True
+            self._async_waiters.add(waiter)
+        try:
+            await asyncio.wait_for(waiter[1].wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            with self._condition:
+                self._async_waiters.discard(waiter)
+
+    def to_dict(self, cursor: int = 0) -> Dict[str, Any]:
+        with self._condition:
+            return {
+                'job_id': self.id,
+                'total': self.total,
+                'completed': self.completed,
+                'contacts': self.contacts,
+                'finished': self.finished,
+                'events': self.events[cursor:],
+            }
+
+def _pool() -> ThreadPoolExecutor:
+    """Process-wide pool running job images; rebuilt after a fork"""
+    with _lock:
+        if _executor['pool'] is None or _executor['pid'] != os.getpid():
+            _executor['pool'] = ThreadPoolExecutor(
+                max_workers=settings.JOB_MAX_WORKERS, thread_name_prefix='analyze-job'
+            )
+            _executor['pid'] = os.getpid()
+        return _executor['pool']
+
+def _prune() -> None:
+    cutoff = time.monotonic() - settings.JOB_RETENTION
+    for job_id in [job_id for job_id, job in _jobs.items()
+                   if job.finished and job.finished_at < cutoff]:
+        del _jobs[job_id]
+
+def detach_upload(upload) -> File:
+    """Copy an upload so it outlives the request.
+
+    Django closes (and deletes) uploaded files when the response is sent,
+    while job images are still being processed. Small files stay in memory,
+    larger ones are spooled to disk.
+    """
+    spooled = tempfile.SpooledTemporaryFile(max_size=settings.FILE_UPLOAD_MAX_MEMORY_SIZE)
+    for chunk in upload.chunks():
+        spooled.write(chunk)
+    spooled.seek(0)
+    return File(spooled, name=upload.name)
+
+def _run_image(job: Job, image: File, handler: Callable[[File], List[Dict[str, Any]]]) -> None:
+    try:
+        entries = handler(image)
+    except Exception as e:
+        logger.error("Job %s failed on %s: %s", job.id, image.name, e, exc_info=True)
+        entries = [{'error': f'Error processing image: {str(e)}', 'image': image.name}]
+    finally:
+        image.close()
+
+    for entry in entries:
+        if 'error' in entry:
+            job.publish({'type': 'error', 'image': entry.get('image', image.name), 'error': entry['error']})
+        else:
+            job.publish({'type': 'card', 'image': image.name, 'card': entry})
+
+    with job._condition:
+        job.completed += 1
+        job.contacts += sum(1 for entry in entries if 'error' not in entry)
+        completed = job.completed
+    job.publish({'type': 'progress', 'image': image.name, 'completed': completed, 'total': job.total})
+    if completed == job.total:
+        logger.info("Job %s finished: %d contacts from %d images", job.id, job.contacts, job.total)
+        job.publish({'type': 'done', 'completed': completed, 'contacts': job.contacts})
+
+def start_job(images: List[File], handler: Callable[[File], List[Dict[str, Any]]]) -> Job:
+    """Process ``images`` in the background and return the job tracking them.
+
+    ``handler`` turns one image into a list of display entries (cards, or
+    dicts with an ``error`` key). Images are processed on the shared job
+    pool, so concurrent uploads share JOB_MAX_WORKERS threads.
+    """
+    job = Job(total=len(images))
+    with _lock:
+        _prune()
+        _jobs[job.id] = job
+    job.publish({'type': 'job', 'job_id': job.id, 'total': job.total})
+
+    pool = _pool()
+    for image in images:
+        pool.submit(_run_image, job, image, handler)
+    logger.info("Started job %s with %d images", job.id, job.total)
+    return job
+
+def get_job(job_id: str) -> Optional[Job]:
+    with _lock:
+        return _jobs.get(job_id)
+
+def _line(event: Dict[str, Any]) -> bytes:
+    return json.dumps(event).encode('utf-8') + b'\n'
+
+def iter_ndjson(job: Job, cursor: int = 0) -> Iterator[bytes]:
+    """Stream job events as NDJSON lines, blocking the calling thread"""
+    while True:
+        for event in job.events_after(cursor):
+            cursor = event['seq']
+            yield _line(event)
+        if job.finished and cursor >= len(job.events):
+            return
+        if not job.wait(cursor, settings.JOB_KEEPALIVE):
+            # Keep proxies from closing an idle connection
+            yield _line({'type': 'ping'})
+
+async def aiter_ndjson(job: Job, cursor: int = 0) -> AsyncIterator[bytes]:
+    """Stream job events as NDJSON lines without holding a thread"""
+    while True:
+        for event in job.events_after(cursor):
+            cursor = event['seq']
+            yield _line(event)
+        if job.finished and cursor >= len(job.events):
+            return
+        if not await job.wait_async(cursor, settings.JOB_KEEPALIVE):
+            yield _line({'type': 'ping'})
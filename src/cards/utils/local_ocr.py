@@ -0,0 +1,256 @@
+import re
+import json
+import math
+import time
+import threading
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+from django.conf import settings
+from PIL import Image, ImageOps, UnidentifiedImageError
+from . import metrics
+from .image_preprocess import decode_slot
+from .openai_helper import CARD_FIELDS, REQUIRED_FIELDS
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+# Optional CPU-only first tier: read the card with Tesseract (pytesseract plus
+# the tesseract binary) and only send it to the vision model when the text is
+# unclear or a required field is missing.
+
+# Tesseract reads best with text around 30 px high, so small photos are upscaled
+MIN_OCR_EDGE = 1200
+
+EMAIL_RE = re.compile(r'[\w.+-]+@[\w-]+(?:\.[\w-]+)+')
+WEBSITE_RE = re.compile(
+    r'(?<![@\w.])(?:(?:https?://|www\.)[^\s,;]+'
+    r'|[a-z0-9-]+\.(?:com|net|org|io|co|biz|info|in|uk|de|ae|au|ca)(?:\.[a-z]{2})?(?:/[^\s,;]*)?)',
+    re.IGNORECASE
+)
+PHONE_RE = re.compile(r'\+?\(?\d[\d\s().-]{5,}\d')
+POSTCODE_RE = re.compile(r'\b\d{3}\s?\d{3}\b|\b\d{5}(?:-\d{4})?\b|\b[A-Z]{1,2}\d[A-Z\d]? \d[A-Z]{2}\b')
+# Field labels printed before values ("Tel:", "E-mail:", "M.")
+LABEL_RE = re.compile(r'^(?:tel|ph|phone|mob|mobile|cell|fax|m|t|p|e|e-?mail|w|web|website)\s*[:.]\s*', re.IGNORECASE)
+
+TITLE_WORDS = {
+    'manager', 'director', 'engineer', 'ceo', 'cto', 'cfo', 'coo', 'founder', 'co-founder',
+    'president', 'head', 'lead', 'officer', 'consultant', 'executive', 'partner', 'owner',
+    'developer', 'designer', 'architect', 'analyst', 'specialist', 'coordinator', 'advisor',
+    'chairman', 'proprietor', 'representative', 'secretary', 'supervisor', 'administrator',
+}
+COMPANY_WORDS = {
+    'ltd', 'limited', 'inc', 'llc', 'llp', 'gmbh', 'corp', 'corporation', 'co', 'company',
+    'pvt', 'plc', 'group', 'industries', 'solutions', 'technologies', 'technology', 'systems',
+    'services', 'enterprises', 'consulting', 'labs', 'studio', 'agency', 'international',
+    'global', 'traders', 'exports', 'ventures', 'holdings',
+}
+ADDRESS_WORDS = {
+    'street', 'st', 'road', 'rd', 'avenue', 'ave', 'floor', 'suite', 'building', 'bldg',
+    'lane', 'nagar', 'sector', 'block', 'plot', 'park', 'tower', 'highway', 'box', 'district',
+}
+
+_lock = threading.Lock()
+_state = {'checked': False, 'available': False}
+_stats = {
+    'attempts': 0, 'answered': 0, 'escalated': 0,
+    'no_text': 0, 'missing_fields': 0, 'low_confidence': 0, 'errors': 0,
+    'seconds': 0.0,
+}
+
+def _count(outcome: str, seconds: float) -> None:
+    with _lock:
+        _stats['attempts'] += 1
+        _stats['seconds'] += seconds
+        if outcome == 'answered':
+            _stats['answered'] += 1
+        else:
+            _stats['escalated'] += 1
+            _stats[outcome] += 1
+
+def stats() -> Dict[str, Any]:
+    """Return local OCR counters for this process.
+
+    ``answered`` cards never reached the vision model; ``escalated`` ones
+    did, for the reason counted under ``no_text``, ``missing_fields``,
+    ``low_confidence`` or ``errors``. ``mean_ms`` is the OCR time per card,
+    spent on every attempt whatever its outcome.
+    """
+    with _lock:
+        counters = dict(_stats)
+    seconds = counters.pop('seconds')
+    attempts = counters['attempts']
+    counters['hit_ratio'] = round(counters['answered'] / attempts, 4) if attempts else 0.0
+    counters['mean_ms'] = round(seconds * 1000 / attempts, 1) if attempts else 0.0
+    return counters
+
+def available() -> bool:
+    """Whether the local tier is enabled and Tesseract can be run"""
+    if not settings.LOCAL_OCR_ENABLED:
+        return False
+    with _lock:
+        if not _state['checked']:
+            try:
+                import pytesseract
+                pytesseract.get_tesseract_version()
+                _state['available'] = True
+            except Exception as e:
+                logger.warning("LOCAL_OCR_ENABLED is set but Tesseract is not available: %s", e)
+            _state['checked'] = True
+        return _state['available']
+
+def _ocr_image(image_file) -> Image.Image:
+    """Decode an upload into an upright, high-contrast grayscale image"""
+    max_edge = settings.LOCAL_OCR_MAX_EDGE
+    image_file.seek(0)
+    try:
+        with decode_slot(), Image.open(image_file) as img:
+            if img.format == 'JPEG' and max(img.size) > max_edge:
+                scale = max_edge / max(img.size)
+                img.draft('L', (math.ceil(img.width * scale), math.ceil(img.height * scale)))
+            img = ImageOps.exif_transpose(img).convert('L')
+            if max(img.size) > max_edge:
+                img.thumbnail((max_edge, max_edge), Image.LANCZOS)
+            elif max(img.size) < MIN_OCR_EDGE:
+                scale = MIN_OCR_EDGE / max(img.size)
+                img = img.resize((round(img.width * scale), round(img.height * scale)), Image.LANCZOS)
+            return ImageOps.autocontrast(img)
+    finally:
+        image_file.seek(0)
+
+def read_lines(image_file) -> List[Dict[str, Any]]:
+    """OCR an image into text lines in reading order.
+
+    Each line has its ``text``, the mean word ``confidence`` (0 to 1) and
+    the median word ``height`` in pixels.
+    """
+    import pytesseract
+
+    data = pytesseract.image_to_data(
+        _ocr_image(image_file), lang=settings.LOCAL_OCR_LANG, config='--psm 3',
+        timeout=settings.LOCAL_OCR_TIMEOUT, output_type=pytesseract.Output.DICT
+    )
+    lines: Dict[Tuple[int, int, int], List[Tuple[str, float, int]]] = {}
+    for index, word in enumerate(data['text']):
+        confidence = float(data['conf'][index])
+        if not word.strip() or confidence < 0:
+            continue
+        key = (data['block_num'][index], data['par_num'][index], data['line_num'][index])
+        lines.setdefault(key, []).append((word.strip(), confidence, data['height'][index]))
+
+    result = []
+    for words in lines.values():
+        heights = sorted(height for _, _, height in words)
+        result.append({
+            'text': ' '.join(text for text, _, _ in words),
+            'confidence': sum(confidence for _, confidence, _ in words) / len(words) / 100,
+            'height': heights[len(heights) // 2],
+        })
+    return result
+
+def _words(text: str) -> List[str]:
+    return re.findall(r"[a-z][a-z'-]*", text.lower())
+
+def _is_name(text: str) -> bool:
+    words = text.split()
+    return (
+        2 <= len(words) <= 4
+        and all(re.fullmatch(r"[A-Z][A-Za-z'.-]*", word) for word in words)
+        and not set(_words(text)) & (TITLE_WORDS | COMPANY_WORDS | ADDRESS_WORDS)
+    )
+
+def parse_lines(lines: List[Dict[str, Any]]) -> Tuple[Dict[str, str], Dict[str, float]]:
+    """Pick contact fields out of OCR lines with layout-free heuristics.
+
+    Emails, websites and phone numbers are matched by pattern anywhere in a
+    line. Of the remaining text, lines with title, company or address words
+    fill those fields, and the tallest line that looks like a person's name
+    is the name. A business name can also come from a line matching the
+    website or email domain. Returns the card and the confidence of the
+    line each field came from.
+    """
+    card = dict.fromkeys(CARD_FIELDS, '')
+    confidence: Dict[str, float] = {}
+
+    def take(field: str, value: str, line: Dict[str, Any]) -> None:
+        if value and not card[field]:
+            card[field] = value
+            confidence[field] = line['confidence']
+
+    rest = []
+    for line in lines:
+        text = LABEL_RE.sub('', line['text'])
+        for email in EMAIL_RE.findall(text):
+            take('email', email.lower(), line)
+        text = EMAIL_RE.sub(' ', text)
+        for website in WEBSITE_RE.findall(text):
+            take('website', website.lower(), line)
+        text = WEBSITE_RE.sub(' ', text)
+        for phone in PHONE_RE.findall(text):
+            if 7 <= len(re.sub(r'\D', '', phone)) <= 15 and not POSTCODE_RE.fullmatch(phone.strip()):
+                take('contact_number', phone.strip(' .-'), line)
+                text = text.replace(phone, ' ')
+        text = LABEL_RE.sub('', ' '.join(text.split()).strip(' ,;|:-'))
+        if len(text) > 1:
+            rest.append(dict(line, text=text))
+
+    names = []
+    for line in rest:
+        words = set(_words(line['text']))
+        if words & TITLE_WORDS:
+            take('job_title', line['text'], line)
+        elif words & COMPANY_WORDS:
+            take('business_name', line['text'], line)
+        elif words & ADDRESS_WORDS or POSTCODE_RE.search(line['text']):
+            take('address', line['text'], line)
+        elif _is_name(line['text']):
+            names.append(line)
+    if names:
+        name = max(names, key=lambda line: line['height'])
+        take('name', name['text'], name)
+        names.remove(name)
+
+    if not card['business_name']:
+        domain = re.sub(r'^(?:https?://)?(?:www\.)?', '', card['website']).split('.')[0] or \
+            card['email'].partition('@')[2].split('.')[0]
+        for line in names + rest:
+            if domain and re.sub(r'[^a-z0-9]', '', line['text'].lower()) == domain.replace('-', ''):
+                take('business_name', line['text'], line)
+                break
+    return card, confidence
+
+def local_analysis(image_file) -> Optional[str]:
+    """Answer a card from local OCR, or return None to use the vision model.
+
+    The card is escalated when OCR finds no text, a REQUIRED_FIELDS field
+    is missing, or the line of any required field was read with less than
+    LOCAL_OCR_MIN_CONFIDENCE. An answer is returned in the vision model's
+    reply format, so it is parsed and stored like any other.
+    """
+    if not available():
+        return None
+
+    outcome = 'answered'
+    card = None
+    started = time.perf_counter()
+    with metrics.span('ocr'):
+        try:
+            lines = read_lines(image_file)
+            if not lines:
+                outcome = 'no_text'
+            else:
+                card, confidence = parse_lines(lines)
+                if any(not card[field] for field in REQUIRED_FIELDS):
+                    outcome = 'missing_fields'
+                elif min(confidence[field] for field in REQUIRED_FIELDS) < settings.LOCAL_OCR_MIN_CONFIDENCE:
+                    outcome = 'low_confidence'
+        except (UnidentifiedImageError, OSError, RuntimeError, Image.DecompressionBombError) as e:
+            # RuntimeError is pytesseract's timeout
+            logger.warning("Local OCR failed for %s: %s", image_file.name, e)
+            outcome = 'errors'
+    _count(outcome, time.perf_counter() - started)
+
+    if outcome != 'answered':
+        logger.debug("Escalating %s to the vision model: %s", image_file.name, outcome)
+        return None
+    logger.debug("Answered %s from local OCR", image_file.name)
+    return json.dumps({'cards': [card]})
@@ -0,0 +1,190 @@
+import math
+import time
+import threading
+import contextvars
+import logging
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+# In-process metrics in the Prometheus text format. Each worker process keeps
+# its own counts, so scrape every process (or run one) to see them all.
+_lock = threading.Lock()
+_registry: List['Metric'] = []
+
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+BYTE_BUCKETS = (16e3, 64e3, 256e3, 1e6, 4e6, 16e6)
+TOKEN_BUCKETS = (100, 250, 500, 1000, 2000, 4000, 8000, 16000)
+
+# Spans recorded while handling the current request, for Server-Timing.
+# None outside a request (background jobs and the outbox worker).
+_request_spans: contextvars.ContextVar[Optional[List[Tuple[str, float]]]] = \
+    contextvars.ContextVar('request_spans', default=None)
+
+def _labels(labels: Dict[str, Any]) -> str:
+    if not labels:
+        return ''
+    pairs = ','.join(
+        '{}="{}"'.format(name, str(value).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n'))
+        for name, value in sorted(labels.items())
+    )
+    return '{' + pairs + '}'
+
+def _number(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help = help_text
+        self._values: Dict[Tuple, Any] = {}
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with _lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        with _lock:
+            values = dict(self._values)
+        return [f"{self.name}{_labels(dict(key))} {_number(value)}" for key, value in sorted(values.items())]
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name: str, help_text: str, buckets: Iterable[float] = TIME_BUCKETS):
+        super().__init__(name, help_text)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value: float, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with _lock:
+            series = self._values.get(key)
+            if series is None:
+                series = self._values[key] = {'counts': [0] * len(self.buckets), 'sum': 0.0, 'count': 0}
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series['counts'][index] += 1
+                    break
+            series['sum'] += value
+            series['count'] += 1
+
+    def render(self) -> List[str]:
+        with _lock:
+            values = {key: dict(series, counts=list(series['counts'])) for key, series in self._values.items()}
+        lines = []
+        for key, series in sorted(values.items()):
+            labels = dict(key)
+            cumulative = 0
+            for bound, count in zip(self.buckets, series['counts']):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_labels(dict(labels, le=_number(bound)))} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(labels)} {series['sum']:.6f}")
+            lines.append(f"{self.name}_count{_labels(labels)} {series['count']}")
+        return lines
+
+def _register(metric: Metric) -> Metric:
+    _registry.append(metric)
+    return metric
+
+def counter(name: str, help_text: str) -> Counter:
+    return _register(Counter(name, help_text))
+
+def histogram(name: str, help_text: str, buckets: Iterable[float] = TIME_BUCKETS) -> Histogram:
+    return _register(Histogram(name, help_text, buckets))
+
+STAGE_SECONDS = histogram('card_stage_seconds', "Time spent in each stage of the card pipeline")
+REQUEST_SECONDS = histogram('http_request_seconds', "Time to produce a response, by view")
+IMAGE_BYTES = histogram('vision_image_bytes', "Size of the encoded image sent per vision request", BYTE_BUCKETS)
+TOKENS = histogram('openai_tokens', "Tokens per vision request", TOKEN_BUCKETS)
+TOKENS_TOTAL = counter('openai_tokens_total', "Tokens used by vision requests")
+CARDS_TOTAL = counter('cards_extracted_total', "Contacts extracted from vision replies")
+TIER_SECONDS = histogram('vision_tier_seconds', "Time to get a vision reply, by model tier")
+
+@contextmanager
+def span(stage: str):
+    """Time a pipeline stage into STAGE_SECONDS and the request's Server-Timing"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - started
+        STAGE_SECONDS.observe(duration, stage=stage)
+        spans = _request_spans.get()
+        if spans is not None:
+            spans.append((stage, duration))
+
+def in_context(func: Callable) -> Callable:
+    """Wrap ``func`` to run in a copy of the caller's context.
+
+    Pool threads do not inherit context variables, so spans recorded there
+    would miss the request's Server-Timing. Each call gets its own copy,
+    since one context cannot be entered by two threads at once.
+    """
+    context = contextvars.copy_context()
+
+    def run(*args, **kwargs):
+        return context.copy().run(func, *args, **kwargs)
+    return run
+
+def record_usage(usage: Any, model: str) -> None:
+    """Count the tokens of one completion"""
+    if usage is None:
+        return
+    for kind in ('prompt', 'completion'):
+        tokens = getattr(usage, f'{kind}_tokens', None) or 0
+        TOKENS.observe(tokens, kind=kind, model=model)
+        TOKENS_TOTAL.inc(tokens, kind=kind, model=model)
+
+def start_request() -> Tuple[List[Tuple[str, float]], contextvars.Token]:
+    spans: List[Tuple[str, float]] = []
+    return spans, _request_spans.set(spans)
+
+def end_request(token: contextvars.Token) -> None:
+    _request_spans.reset(token)
+
+def server_timing(spans: List[Tuple[str, float]], total: float) -> str:
+    """Server-Timing header value: each stage's summed time in milliseconds.
+
+    Stages that ran several times (one per image or crop, possibly in
+    parallel) report their count; their sum can exceed the total.
+    """
+    totals: Dict[str, List[float]] = {}
+    for stage, duration in spans:
+        totals.setdefault(stage, []).append(duration)
+    entries = []
+    for stage, durations in totals.items():
+        entry = f"{stage};dur={sum(durations) * 1000:.1f}"
+        if len(durations) > 1:
+            entry += f';desc="x{len(durations)}"'
+        entries.append(entry)
+    entries.append(f"total;dur={total * 1000:.1f}")
+    return ', '.join(entries)
+
+def render(families: Iterable[Tuple[str, str, str, List[Tuple[Dict[str, Any], float]]]] = ()) -> str:
+    """All registered metrics in the Prometheus text format.
+
+    ``families`` adds metrics kept elsewhere, as ``(name, type, help,
+    [(labels, value), ...])``.
+    """
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.header())
+        lines.extend(metric.render())
+    for name, kind, help_text, samples in families:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        lines.extend(f"{name}{_labels(labels)} {_number(value)}" for labels, value in samples)
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,101 @@
+import re
+import threading
+import logging
+from typing import Any, Callable, Dict, List
+from django.conf import settings
+from . import metrics
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+# Tiered vision analysis: an image goes to the first (cheapest) tier of
+# VISION_MODEL_TIERS, and a reply scoring below VISION_ESCALATION_MIN_SCORE
+# is retried on the next one. The last tier's reply is always used.
+
+EMAIL_RE = re.compile(r'^[\w.+-]+@[\w-]+(?:\.[\w-]+)+$')
+URL_RE = re.compile(r'^(?:https?://)?(?:www\.)?[a-z0-9-]+(?:\.[a-z0-9-]+)+(?::\d+)?(?:[/?#]\S*)?$', re.IGNORECASE)
+PHONE_RE = re.compile(r'^\+?[\d\s()./-]+(?:\s*(?:x|ext\.?)\s*\d+)?$', re.IGNORECASE)
+# Fields may hold several values, e.g. "+1 555 0100, +1 555 0101"
+SEPARATOR_RE = re.compile(r'\s*[,;|]\s*')
+
+def valid_phone(value: str) -> bool:
+    return bool(PHONE_RE.match(value)) and 7 <= len(re.sub(r'\D', '', value)) <= 15
+
+VALIDATORS: Dict[str, Callable[[str], bool]] = {
+    'email': lambda value: bool(EMAIL_RE.match(value)),
+    'contact_number': valid_phone,
+    'website': lambda value: bool(URL_RE.match(value)),
+}
+
+_lock = threading.Lock()
+_stats: Dict[str, Dict[str, float]] = {}
+
+def tier_name(tier: Dict[str, Any]) -> str:
+    return f"{tier['model']}:{tier['detail']}"
+
+def signature() -> str:
+    """The tier configuration, for keys of results that depend on it"""
+    tiers = ','.join(f"{tier_name(tier)}:{tier['max_tokens']}" for tier in settings.VISION_MODEL_TIERS)
+    return f"{tiers}@{settings.VISION_ESCALATION_MIN_SCORE}"
+
+def score_cards(cards: List[Dict[str, str]], required_fields: List[str]) -> float:
+    """Score parsed cards from 0 to 1.
+
+    Each card scores the share of its checks that pass: one per required
+    field (present) and one per email, phone or website it has (well
+    formed). A reply scores as its worst card; one without cards scores 0.
+    """
+    if not cards:
+        return 0.0
+    scores = []
+    for card in cards:
+        checks = [bool(card.get(field)) for field in required_fields]
+        for field, valid in VALIDATORS.items():
+            if card.get(field):
+                checks.append(all(valid(value) for value in SEPARATOR_RE.split(card[field]) if value))
+        scores.append(sum(checks) / len(checks))
+    return min(scores)
+
+def settle(index: int, score: float, seconds: float, usage: Any = None, cached: bool = False) -> bool:
+    """Record a reply from tier ``index`` and decide whether to use it.
+
+    Returns False when the reply should be escalated to the next tier.
+    ``usage`` is the completion's token usage (None for cached replies).
+    """
+    tiers = settings.VISION_MODEL_TIERS
+    accepted = index == len(tiers) - 1 or score >= settings.VISION_ESCALATION_MIN_SCORE
+    name = tier_name(tiers[index])
+    metrics.TIER_SECONDS.observe(seconds, tier=name)
+    with _lock:
+        counters = _stats.setdefault(name, {
+            'replies': 0, 'cached': 0, 'accepted': 0, 'escalated': 0,
+            'score': 0.0, 'seconds': 0.0, 'prompt_tokens': 0, 'completion_tokens': 0,
+        })
+        counters['replies'] += 1
+        counters['cached'] += cached
+        counters['accepted' if accepted else 'escalated'] += 1
+        counters['score'] += score
+        counters['seconds'] += seconds
+        if usage is not None:
+            counters['prompt_tokens'] += getattr(usage, 'prompt_tokens', None) or 0
+            counters['completion_tokens'] += getattr(usage, 'completion_tokens', None) or 0
+    if not accepted:
+        logger.debug("Escalating reply from %s with score %.2f", name, score)
+    return accepted
+
+def stats() -> Dict[str, Dict[str, Any]]:
+    """Return counters per tier (``model:detail``) for this process.
+
+    ``replies`` counts every reply a tier gave, ``cached`` the ones from the
+    vision cache. ``escalation_ratio`` is the share passed on to the next
+    tier; ``mean_ms`` and ``mean_score`` are per reply and token counts are
+    totals of API calls.
+    """
+    with _lock:
+        tiers = {name: dict(counters) for name, counters in _stats.items()}
+    for counters in tiers.values():
+        replies = counters['replies']
+        counters['escalation_ratio'] = round(counters['escalated'] / replies, 4)
+        counters['mean_score'] = round(counters.pop('score') / replies, 4)
+        counters['mean_ms'] = round(counters.pop('seconds') * 1000 / replies, 1)
+    return tiers
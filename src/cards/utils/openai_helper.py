@@ -1,125 +1,483 @@
 import os
-import base64
-from typing import Dict, Any, List
-from openai import OpenAI
+import re
+import time
+import random
+import binascii
+import threading
+from typing import Dict, Any, List, Optional, Tuple
 import json
+from asgiref.sync import sync_to_async
 from django.conf import settings
 import logging
+from .clients import get_async_openai_client, get_openai_client
+from . import metrics, model_routing, vision_cache
+from .resilience import UpstreamError, get_upstream
+from .image_preprocess import detect_mime, image_buffer, preprocess_image, preprocess_options
 
 # Configure logger
 logger = logging.getLogger(__name__)
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# Multiple of 3 so chunks encode without padding in the middle of the URL
+ENCODE_CHUNK_SIZE = 3 * 256 * 1024
+
+# Contact fields, matching VisitingCard
+CARD_FIELDS = [
+    'name',
+    'business_name',
+    'job_title',
+    'contact_number',
+    'email',
+    'website',
+    'address'
+]
+# Fields every card should have; cards without them are flagged, and the
+# local OCR tier escalates them to the vision model
+REQUIRED_FIELDS = ['name', 'business_name', 'contact_number']
+
+# Kept short: it is sent with every image, to every tier. The keys name the
+# fields, so they are not also spelled out in prose.
+CARD_PROMPT = (
+    "Extract each person's contact details from this business card as JSON: an object "
+    "with a \"cards\" list, one entry per person, with the keys "
+    + ", ".join(CARD_FIELDS) + ". Use \"\" for anything not on the card."
 )
 
-def encode_image(image_file) -> str:
-    """Encode image file object to base64 string"""
+# Schema for structured output mode. Strict mode requires every property to
+# be listed as required, so missing values come back as empty strings.
+CARD_SCHEMA = {
+    "name": "business_cards",
+    "strict": True,
+    "schema": {
+        "type": "object",
+        "properties": {
+            "cards": {
+                "type": "array",
+                "items": {
+                    "type": "object",
+                    "properties": {field: {"type": "string"} for field in CARD_FIELDS},
+                    "required": CARD_FIELDS,
+                    "additionalProperties": False
+                }
+            }
+        },
+        "required": ["cards"],
+        "additionalProperties": False
+    }
+}
+
+# Other names models use for the card fields, after normalizing to
+# lowercase snake_case
+FIELD_ALIASES = {
+    'full_name': 'name',
+    'contact_name': 'name',
+    'person_name': 'name',
+    'business': 'business_name',
+    'company': 'business_name',
+    'company_name': 'business_name',
+    'organization': 'business_name',
+    'organisation': 'business_name',
+    'title': 'job_title',
+    'position': 'job_title',
+    'designation': 'job_title',
+    'role': 'job_title',
+    'phone': 'contact_number',
+    'phone_number': 'contact_number',
+    'telephone': 'contact_number',
+    'mobile': 'contact_number',
+    'mobile_number': 'contact_number',
+    'contact': 'contact_number',
+    'email_address': 'email',
+    'e_mail': 'email',
+    'web': 'website',
+    'web_site': 'website',
+    'url': 'website',
+    'location': 'address',
+    'office_address': 'address',
+}
+
+# Keys that wrap the card list, e.g. {"cards": [...]}
+CONTAINER_KEYS = ('cards', 'contacts', 'business_cards', 'results', 'data')
+
+JSON_START = re.compile(r'[\[{]')
+
+_parse_lock = threading.Lock()
+_parse_stats = {'parsed': 0, 'recovered': 0, 'normalized': 0, 'empty': 0, 'failed': 0}
+
+def _count_parse(name: str) -> None:
+    with _parse_lock:
+        _parse_stats[name] += 1
+
+def parse_stats() -> Dict[str, Any]:
+    """Return response parsing counters for this process.
+
+    ``parsed`` responses were valid JSON as they came, ``recovered`` ones
+    needed the fallback scan and ``failed`` ones could not be used at all
+    (each of those is a wasted API call). ``normalized`` counts responses
+    that used non-standard field names.
+    """
+    with _parse_lock:
+        counters = dict(_parse_stats)
+    responses = counters['parsed'] + counters['recovered'] + counters['failed']
+    counters['failure_ratio'] = round(counters['failed'] / responses, 4) if responses else 0.0
+    return counters
+
+def encode_data_url(data, mime_type: str) -> str:
+    """Build a base64 data URL for image bytes.
+
+    The URL is assembled in one preallocated buffer, encoding the input a
+    chunk at a time, so the only full-size copies alive are the input, that
+    buffer and the final string.
+    """
+    prefix = f"data:{mime_type};base64,".encode('ascii')
+    data = memoryview(data).cast('B')
+    buffer = bytearray(len(prefix) + 4 * ((len(data) + 2) // 3))
+    buffer[:len(prefix)] = prefix
+    offset = len(prefix)
+    for start in range(0, len(data), ENCODE_CHUNK_SIZE):
+        encoded = binascii.b2a_base64(data[start:start + ENCODE_CHUNK_SIZE], newline=False)
+        buffer[offset:offset + len(encoded)] = encoded
+        offset += len(encoded)
+    return buffer.decode('ascii')
+
+def image_cache_key(data, model: str, detail: str, max_tokens: Optional[int] = None) -> str:
+    """Vision cache key for image bytes under the current settings"""
+    return vision_cache.make_key(
+        data, prompt=CARD_PROMPT, model=model, detail=detail,
+        max_tokens=max_tokens or settings.VISION_MAX_TOKENS,
+        structured=settings.OPENAI_STRUCTURED_OUTPUT, **preprocess_options()
+    )
+
+def prepare_image_url(image_file, data) -> str:
+    """Preprocess an upload and return it as a base64 data URL"""
+    # Shrink and re-encode before paying to upload and tokenize it
+    if settings.VISION_PREPROCESS_ENABLED:
+        payload, mime_type = preprocess_image(image_file)
+    else:
+        payload, mime_type = data, detect_mime(image_file)
+    return encode_data_url(payload, mime_type)
+
+def build_vision_request(image_url: str, model: str, detail: str,
+                         structured: Optional[bool] = None,
+                         max_tokens: Optional[int] = None) -> Dict[str, Any]:
+    """Chat completions request body for extracting a card from an image.
+
+    Shared by the interactive path and the Batch API importer, so both send
+    exactly the same prompt. With ``structured`` (default
+    OPENAI_STRUCTURED_OUTPUT) the reply is constrained to CARD_SCHEMA.
+    ``max_tokens`` defaults to VISION_MAX_TOKENS.
+    """
+    if structured is None:
+        structured = settings.OPENAI_STRUCTURED_OUTPUT
+
+    request = {
+        "model": model,
+        "messages": [
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": CARD_PROMPT
+                    },
+                    {
+                        "type": "image_url",
+                        "image_url": {
+                            "url": image_url,
+                            "detail": detail
+                        }
+                    }
+                ]
+            }
+        ],
+        "max_tokens": max_tokens or settings.VISION_MAX_TOKENS
+    }
+    if structured:
+        request["response_format"] = {"type": "json_schema", "json_schema": CARD_SCHEMA}
+    return request
+
+def prepare_request(image_file, model: str, detail: str, max_tokens: Optional[int] = None,
+                    image_url: Optional[str] = None):
+    """Look an image up in the vision cache and build its request.
+
+    Returns ``(cache_key, cached_reply, request_body)``; exactly one of the
+    last two is None. This is the CPU-bound half of an analysis (hashing,
+    decoding and re-encoding), so async callers run it on a thread. Pass
+    the ``image_url`` of an earlier request for the same image to skip
+    preprocessing it again.
+    """
+    with metrics.span('preprocess'), image_buffer(image_file) as data:
+        key = image_cache_key(data, model, detail, max_tokens)
+        cached = vision_cache.lookup(key)
+        if cached is not None:
+            logger.debug("Returning cached analysis for %s", image_file.name)
+            return key, cached, None
+
+        if image_url is None:
+            logger.debug("Encoding image to base64")
+            image_url = prepare_image_url(image_file, data)
+            logger.debug("Image encoded successfully")
+            metrics.IMAGE_BYTES.observe(len(image_url))
+    return key, None, build_vision_request(image_url, model, detail, max_tokens=max_tokens)
+
+def request_image_url(request: Dict[str, Any]) -> str:
+    """The image data URL of a request built by ``build_vision_request``"""
+    return request['messages'][0]['content'][1]['image_url']['url']
+
+def _reply_content(completion, image_file) -> str:
+    choice = completion.choices[0]
+    content = choice.message.content
+    if content is None:
+        # Structured output reports refusals separately from the content
+        raise ValueError(f"Model returned no content: {getattr(choice.message, 'refusal', None)}")
+    if choice.finish_reason == 'length':
+        logger.warning("Response for %s was cut off at max_tokens", image_file.name)
+    return content
+
+def read_cards(analysis_response: str) -> List[Dict[str, str]]:
+    """Parse a reply into normalized cards, without counting or logging it.
+
+    Raises ValueError when the reply holds no usable JSON.
+    """
+    if not isinstance(analysis_response, str) or not analysis_response.strip():
+        raise ValueError("Empty response")
+    decoded, _ = _decode_json(analysis_response)
+    return [card for card in map(normalize_card, _card_dicts(decoded)) if any(card.values())]
+
+def score_reply(analysis_response: str, truncated: bool = False) -> float:
+    """Quality of a reply from 0 to 1, for deciding whether to escalate it.
+
+    Unparseable replies and replies cut off at max_tokens score 0;
+    otherwise the cards are scored by ``model_routing.score_cards``.
+    """
+    if truncated:
+        return 0.0
     try:
-        logger.debug(f"Attempting to encode image file: {image_file.name}")
-        encoded_string = base64.b64encode(image_file.read()).decode("utf-8")
-        logger.debug("Image successfully encoded to base64")
-        image_file.seek(0)  # Reset file pointer for future reads
-        return encoded_string
-    except Exception as e:
-        logger.error(f"Error encoding image: {str(e)}")
-        raise
+        return model_routing.score_cards(read_cards(analysis_response), REQUIRED_FIELDS)
+    except ValueError:
+        return 0.0
+
+def _settle_reply(index: int, completion, content: str, started: float) -> Tuple[bool, bool]:
+    """Score a tier's reply; returns whether to use it and whether to cache it"""
+    truncated = completion is not None and completion.choices[0].finish_reason == 'length'
+    accepted = model_routing.settle(
+        index, score_reply(content, truncated), time.perf_counter() - started,
+        usage=completion.usage if completion is not None else None, cached=completion is None
+    )
+    # A truncated reply that gets escalated would only be escalated again
+    return accepted, completion is not None and (accepted or not truncated)
 
 def analyze_image(image_file) -> Dict[str, Any]:
     """
     Analyze image using OpenAI's Vision API through the Python SDK
+
+    The image goes through VISION_MODEL_TIERS in order until a reply scores
+    at least VISION_ESCALATION_MIN_SCORE (see ``score_reply``); it is
+    preprocessed once for all of them. Responses are cached by image
+    content, prompt and tier, so re-uploads of the same photo skip the API
+    calls. Calls go through the shared 'openai' upstream limiter, which
+    retries 429s and 5xx; failures raise an UpstreamError.
     """
     try:
-        logger.info("Starting image analysis")
-        logger.debug(f"Image file received: {image_file.name}")
-
-        # Initialize OpenAI client with only the required parameters
-        client = OpenAI(
-            api_key=settings.OPENAI_API_KEY
-        )
-        
-        # Encode image
-        logger.debug("Encoding image to base64")
-        base64_image = encode_image(image_file)
-        logger.debug("Image encoded successfully")
-
-        # Make API request
-        logger.info("Sending request to OpenAI API")
-        completion = client.chat.completions.create(
-            model="gpt-4.1-mini",
-            messages=[
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": "Extract the following information from this business card: name, business name, job title, contact number, email, website, and address. Return the data in JSON format."
-                        },
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/jpeg;base64,{base64_image}"
-                            }
-                        }
-                    ]
-                }
-            ],
-            max_tokens=500
-        )
-        
-        logger.info("Successfully received response from OpenAI")
-        return completion.choices[0].message.content
+        logger.debug("Starting image analysis")
+        logger.debug("Image file received: %s", image_file.name)
+
+        image_url = None
+        for index, tier in enumerate(settings.VISION_MODEL_TIERS):
+            started = time.perf_counter()
+            key, content, request = prepare_request(
+                image_file, tier['model'], tier['detail'], tier['max_tokens'], image_url
+            )
+            completion = None
+            if content is None:
+                image_url = request_image_url(request)
+
+                # Reuse the process-wide client and its connection pool.
+                # Retries are left to the upstream limiter so it sees every
+                # attempt, and the raw response carries the rate-limit
+                # headers it adapts to.
+                client = get_openai_client().with_options(max_retries=0)
+
+                # Make API request
+                logger.debug("Sending request to OpenAI API (%s)", model_routing.tier_name(tier))
+                with metrics.span('openai'):
+                    raw_response = get_upstream('openai').call(
+                        client.chat.completions.with_raw_response.create, **request
+                    )
+                completion = raw_response.parse()
+                metrics.record_usage(completion.usage, request['model'])
+                content = _reply_content(completion, image_file)
 
+            accepted, cache = _settle_reply(index, completion, content, started)
+            if cache:
+                vision_cache.store(key, content)
+            if accepted:
+                break
+        logger.debug("Successfully received response from OpenAI")
+        return content
+
+    except UpstreamError as e:
+        logger.error("OpenAI API request failed: %s", e)
+        raise
     except Exception as e:
-        logger.error(f"Error in analyze_image: {str(e)}", exc_info=True)
-        raise Exception(f"OpenAI API request failed: {str(e)}")
+        logger.error("Error in analyze_image: %s", e, exc_info=True)
+        raise
+
+async def analyze_image_async(image_file) -> Dict[str, Any]:
+    """
+    Async variant of ``analyze_image`` for ASGI views
+
+    Hashing and preprocessing run on a worker thread; the API calls are
+    awaited on the event loop's shared AsyncOpenAI client, so waiting for
+    the model holds no thread.
+    """
+    try:
+        logger.debug("Starting async image analysis of %s", image_file.name)
+
+        image_url = None
+        for index, tier in enumerate(settings.VISION_MODEL_TIERS):
+            started = time.perf_counter()
+            key, content, request = await sync_to_async(prepare_request, thread_sensitive=False)(
+                image_file, tier['model'], tier['detail'], tier['max_tokens'], image_url
+            )
+            completion = None
+            if content is None:
+                image_url = request_image_url(request)
+                client = get_async_openai_client().with_options(max_retries=0)
+                with metrics.span('openai'):
+                    raw_response = await get_upstream('openai').acall(
+                        client.chat.completions.with_raw_response.create, **request
+                    )
+                completion = raw_response.parse()
+                metrics.record_usage(completion.usage, request['model'])
+                content = _reply_content(completion, image_file)
+
+            accepted, cache = _settle_reply(index, completion, content, started)
+            if cache:
+                await sync_to_async(vision_cache.store, thread_sensitive=False)(key, content)
+            if accepted:
+                break
+        logger.debug("Successfully received response from OpenAI")
+        return content
+
+    except UpstreamError as e:
+        logger.error("OpenAI API request failed: %s", e)
+        raise
+    except Exception as e:
+        logger.error("Error in analyze_image_async: %s", e, exc_info=True)
+        raise
+
+def _decode_json(text: str) -> Tuple[Any, bool]:
+    """Decode a model reply, tolerating surrounding prose and truncation.
+
+    Tries the whole reply first. Otherwise the reply is scanned for JSON
+    values, decoding each one incrementally from its opening bracket, so
+    markdown fences and commentary are skipped and the complete objects of
+    a truncated list are kept. Returns a tuple of the decoded value and
+    whether the fallback scan was needed.
+    """
+    text = text.strip()
+    try:
+        return json.loads(text), False
+    except json.JSONDecodeError:
+        pass
+
+    decoder = json.JSONDecoder()
+    values = []
+    position = 0
+    while True:
+        match = JSON_START.search(text, position)
+        if not match:
+            break
+        try:
+            value, position = decoder.raw_decode(text, match.start())
+        except json.JSONDecodeError:
+            position = match.start() + 1
+            continue
+        if isinstance(value, (dict, list)):
+            values.append(value)
+
+    if not values:
+        raise ValueError("Could not find valid JSON content in response")
+    return (values[0] if len(values) == 1 else values), True
+
+def _card_dicts(value: Any) -> List[Dict[str, Any]]:
+    """Flatten a decoded reply into a list of card dicts"""
+    if isinstance(value, list):
+        return [card for item in value for card in _card_dicts(item)]
+    if not isinstance(value, dict):
+        return []
+    for key in value:
+        if normalize_key(key) in CONTAINER_KEYS and isinstance(value[key], (list, dict)):
+            return _card_dicts(value[key])
+    return [value]
+
+def normalize_key(key: str) -> str:
+    """Map a field name such as "Business Name" onto a card field"""
+    key = re.sub(r'[^a-z0-9]+', '_', str(key).lower()).strip('_')
+    return FIELD_ALIASES.get(key, key)
+
+def _normalize_value(value: Any) -> str:
+    if value is None:
+        return ''
+    if isinstance(value, (list, tuple)):
+        return ', '.join(str(item).strip() for item in value if item)
+    return str(value).strip()
+
+def normalize_card(card: Dict[str, Any]) -> Dict[str, str]:
+    """Return a card with exactly the CARD_FIELDS keys"""
+    normalized = dict.fromkeys(CARD_FIELDS, '')
+    for key, value in card.items():
+        field = normalize_key(key)
+        if field in normalized and not normalized[field]:
+            normalized[field] = _normalize_value(value)
+    return normalized
+
+def _log_reply(analysis_response: str) -> None:
+    # Replies can be long and hold personal data, so only a sample is logged
+    if settings.LOG_PAYLOAD_SAMPLE_RATE and random.random() < settings.LOG_PAYLOAD_SAMPLE_RATE:
+        logger.info("Sampled raw response: %s", analysis_response)
 
 def extract_card_details(analysis_response: str) -> List[Dict[str, Any]]:
     """
     Extract structured card details from the API response
+
+    Structured output replies parse directly. Free-form replies are
+    recovered where possible and their field names normalized. Raises
+    ValueError when the reply holds no usable JSON.
     """
     try:
-        logger.debug(f"Raw response received: {analysis_response}")
-        
-        # Clean the response if it contains markdown code blocks
-        if analysis_response.startswith('```'):
-            # Find the start of JSON content
-            start_idx = analysis_response.find('[')
-            if start_idx == -1:
-                start_idx = analysis_response.find('{')
-            # Find the end of JSON content
-            end_idx = analysis_response.rfind(']')
-            if end_idx == -1:
-                end_idx = analysis_response.rfind('}')
-            
-            if start_idx == -1 or end_idx == -1:
-                raise ValueError("Could not find valid JSON content in response")
-                
-            # Extract just the JSON part
-            analysis_response = analysis_response[start_idx:end_idx + 1]
-        
-        logger.debug(f"Cleaned response for parsing: {analysis_response}")
-        
-        # Parse the JSON
-        card_details = json.loads(analysis_response)
-        
-        # Ensure we have a list of cards
-        if isinstance(card_details, dict):
-            card_details = [card_details]
-            
+        _log_reply(analysis_response)
+        if not isinstance(analysis_response, str) or not analysis_response.strip():
+            raise ValueError("Empty response")
+
+        decoded, recovered = _decode_json(analysis_response)
+        if recovered:
+            logger.info("Recovered JSON from a free-form response")
+
+        card_details = []
+        renamed = False
+        for card in _card_dicts(decoded):
+            renamed = renamed or any(key not in CARD_FIELDS for key in card)
+            normalized = normalize_card(card)
+            if any(normalized.values()):
+                card_details.append(normalized)
+
+        _count_parse('recovered' if recovered else 'parsed')
+        if renamed:
+            _count_parse('normalized')
+        if not card_details:
+            _count_parse('empty')
+
         # Validate each card has required fields
-        required_fields = ['name', 'business_name', 'contact_number']
         for card in card_details:
-            missing_fields = [field for field in required_fields if not card.get(field)]
+            missing_fields = [field for field in REQUIRED_FIELDS if not card.get(field)]
             if missing_fields:
-                logger.warning(f"Card for {card.get('name', 'Unknown')} is missing fields: {missing_fields}")
-        
-        logger.info(f"Successfully parsed {len(card_details)} cards")
+                logger.warning("Card for %s is missing fields: %s", card.get('name') or 'Unknown', missing_fields)
+
+        logger.debug("Successfully parsed %d cards", len(card_details))
         return card_details
-        
-    except json.JSONDecodeError as e:
-        logger.error(f"JSON parsing error: {str(e)}", exc_info=True)
+
+    except ValueError as e:
+        _count_parse('failed')
+        logger.error("Failed to parse API response: %s", e)
         raise ValueError(f"Failed to parse API response: {str(e)}")
-    except Exception as e:
-        logger.error(f"Unexpected error in extract_card_details: {str(e)}", exc_info=True)
-        raise
\ No newline at end of file
@@ -0,0 +1,360 @@
+import os
+import random
+import threading
+import time
+import uuid
+import logging
+from datetime import timedelta
+from typing import Any, Dict, List, Tuple
+from django.conf import settings
+from django.db import IntegrityError, close_old_connections, transaction
+from django.db.models import F
+from django.utils import timezone
+from ..models import VisitingCard
+from . import metrics
+from .contacts import contact_keys, normalize_email
+from .openai_helper import CARD_FIELDS
+from .resilience import CircuitOpenError
+from .sheets_helper import (
+    CONTACT_COLUMNS,
+    append_rows,
+    appended_rows,
+    card_to_row,
+    ensure_headers,
+    get_card_ids_at,
+    get_card_rows,
+    row_hash,
+    update_rows
+)
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+# Columns written when a re-scan is merged into an existing contact
+MERGED_FIELDS = CARD_FIELDS + [
+    'normalized_phone', 'name_key', 'business_key', 'scan_count', 'last_scanned_at',
+    'sheet_status', 'sheet_attempts', 'sheet_next_attempt_at', 'sheet_lease'
+]
+
+def _card_fields(card: Dict[str, Any]) -> Dict[str, Any]:
+    """Map an extracted card dict onto VisitingCard fields"""
+    fields = {}
+    for name in CARD_FIELDS:
+        value = card.get(name) or ''
+        max_length = VisitingCard._meta.get_field(name).max_length
+        fields[name] = str(value)[:max_length] if max_length else str(value)
+    fields['email'] = normalize_email(fields['email'])
+    fields.update(contact_keys(fields))
+    return fields
+
+def _merge(instance: VisitingCard, fields: Dict[str, Any], now) -> None:
+    """Fold a re-scan into an existing contact, filling in blank fields"""
+    changed = False
+    for name in CARD_FIELDS:
+        if fields[name] and not getattr(instance, name):
+            setattr(instance, name, fields[name])
+            changed = True
+    if changed and instance.sheet_status == VisitingCard.SHEET_SYNCED:
+        instance.requeue_for_sheet()
+    for name, value in contact_keys(instance.__dict__).items():
+        if name != 'dedup_key':
+            setattr(instance, name, value)
+    instance.scan_count += 1
+    instance.last_scanned_at = now
+
+def _save_cards(fields_list: List[Dict[str, Any]]) -> List[Tuple[VisitingCard, bool]]:
+    """Insert new contacts and merge re-scans of known ones, in one transaction.
+
+    Returns ``(instance, duplicate)`` per card, in order.
+    """
+    now = timezone.now()
+    keys = {fields['dedup_key'] for fields in fields_list if fields['dedup_key']}
+    known = {card.dedup_key: card for card in VisitingCard.objects.filter(dedup_key__in=keys)}
+
+    results, created, merged = [], [], {}
+    for fields in fields_list:
+        instance = known.get(fields['dedup_key']) if fields['dedup_key'] else None
+        if instance is None:
+            instance = VisitingCard(last_scanned_at=now, **fields)
+            created.append(instance)
+            if fields['dedup_key']:
+                known[fields['dedup_key']] = instance
+            results.append((instance, False))
+        else:
+            _merge(instance, fields, now)
+            if instance.pk is not None:
+                merged[instance.pk] = instance
+            results.append((instance, True))
+
+    with transaction.atomic():
+        VisitingCard.objects.bulk_create(created)
+        if merged:
+            VisitingCard.objects.bulk_update(merged.values(), MERGED_FIELDS)
+
+    if merged:
+        logger.info("Merged %d re-scanned contacts into existing rows", len(merged))
+    return results
+
+def enqueue_cards(cards: List[Dict[str, Any]], wake: bool = True) -> List[VisitingCard]:
+    """Save extracted cards to the local outbox.
+
+    A card whose dedup key matches a stored contact is merged into that row
+    instead of creating another one. Each card dict is updated in place
+    with its ``id``, ``sync_key``, ``created_at``, ``sheet_status`` and a
+    ``duplicate`` flag. Unless ``wake`` is False, new rows are pushed to the
+    sheet: by the background worker when enabled, otherwise right here
+    unless cron drains the outbox.
+    """
+    if not cards:
+        return []
+
+    fields_list = [_card_fields(card) for card in cards]
+    try:
+        results = _save_cards(fields_list)
+    except IntegrityError:
+        # A concurrent request stored one of these contacts first; the
+        # retry sees its row and merges into it
+        results = _save_cards(fields_list)
+
+    instances = [instance for instance, _ in results]
+    logger.info("Queued %d contacts for the Google Sheet", len(instances))
+    if wake:
+        if settings.SHEETS_OUTBOX_WORKER:
+            wake_outbox_worker()
+        elif not settings.SHEETS_OUTBOX_CRON:
+            _drain_inline(instances)
+
+    for card, (instance, duplicate) in zip(cards, results):
+        card.update(
+            id=instance.pk,
+            sync_key=str(instance.sync_key),
+            created_at=instance.created_at.strftime('%Y-%m-%d %H:%M:%S'),
+            sheet_status=instance.sheet_status,
+            duplicate=duplicate
+        )
+    return instances
+
+def _drain_inline(instances: List[VisitingCard]) -> None:
+    """Drain the outbox now, when nothing else will, and refresh statuses"""
+    try:
+        drain_outbox()
+    except Exception as e:
+        # The cards are stored; the next upload retries them
+        logger.error("Outbox drain failed: %s", e, exc_info=True)
+        return
+    statuses = dict(
+        VisitingCard.objects.filter(pk__in=[instance.pk for instance in instances])
+        .values_list('pk', 'sheet_status')
+    )
+    for instance in instances:
+        instance.sheet_status = statuses.get(instance.pk, instance.sheet_status)
+
+def backoff_delay(attempts: int) -> float:
+    """Jittered exponential delay in seconds before the next attempt"""
+    delay = min(
+        settings.SHEETS_OUTBOX_MAX_BACKOFF,
+        settings.SHEETS_OUTBOX_BASE_BACKOFF * 2 ** max(attempts - 1, 0)
+    )
+    return delay * random.uniform(0.5, 1.0)
+
+def _claim_batch(limit: int) -> List[VisitingCard]:
+    """Lease up to ``limit`` due cards so concurrent drainers skip them"""
+    now = timezone.now()
+    due = list(
+        VisitingCard.objects
+        .filter(sheet_status=VisitingCard.SHEET_QUEUED, sheet_next_attempt_at__lte=now)
+        .order_by('sheet_next_attempt_at', 'pk')
+        .values_list('pk', flat=True)[:limit]
+    )
+    if not due:
+        return []
+
+    # The conditional update is atomic, so a card is only leased once even
+    # when several workers pick the same candidates.
+    lease = uuid.uuid4().hex
+    claimed = VisitingCard.objects.filter(
+        pk__in=due,
+        sheet_status=VisitingCard.SHEET_QUEUED,
+        sheet_next_attempt_at__lte=now
+    ).update(
+        sheet_lease=lease,
+        sheet_next_attempt_at=now + timedelta(seconds=settings.SHEETS_OUTBOX_LEASE)
+    )
+    if not claimed:
+        return []
+    return list(VisitingCard.objects.filter(sheet_lease=lease).order_by('pk'))
+
+def sheet_row_values(card: VisitingCard) -> List[Any]:
+    return card_to_row(card.to_card_data())
+
+def _locate(cards: List[VisitingCard], card_rows: Dict[str, int]) -> None:
+    for card in cards:
+        card.sheet_row = card_rows.get(str(card.sync_key))
+
+def _push_batch(batch: List[VisitingCard]) -> None:
+    """Write a leased batch to the sheet.
+
+    New cards are appended in one values.append; changed cards are
+    rewritten in place with one values.batchUpdate. Sets ``sheet_row`` on
+    every card. Only a moved row or a retried append needs the full Card ID
+    column; otherwise the cost is proportional to the batch.
+    """
+    ensure_headers()
+    appends = [card for card in batch if card.sheet_row is None]
+    updates = [card for card in batch if card.sheet_row is not None]
+    card_rows = None
+
+    if updates:
+        # People sort, insert and delete rows, so check each card is still
+        # where it was last written before overwriting that row
+        found = get_card_ids_at(card.sheet_row for card in updates)
+        moved = [card for card in updates if found.get(card.sheet_row) != str(card.sync_key)]
+        if moved:
+            card_rows = get_card_rows()
+            _locate(moved, card_rows)
+            # Rows deleted in the sheet are appended again with the new values
+            appends += [card for card in moved if card.sheet_row is None]
+            updates = [card for card in updates if card.sheet_row is not None]
+
+    if any(card.sheet_attempts for card in appends):
+        # A failed attempt may still have reached the sheet (e.g. a timeout
+        # after the append was applied), so check the idempotency keys.
+        if card_rows is None:
+            card_rows = get_card_rows()
+        _locate(appends, card_rows)
+        written = [card for card in appends if card.sheet_row is not None]
+        if written:
+            logger.info("Skipping append of %d contacts already present in the sheet", len(written))
+        updates += written
+        appends = [card for card in appends if card.sheet_row is None]
+
+    update_rows({card.sheet_row: sheet_row_values(card) for card in updates})
+    if appends:
+        result = append_rows([card.to_card_data() for card in appends])
+        span = appended_rows(result)
+        for offset, card in enumerate(appends):
+            card.sheet_row = span[0] + offset if span else None
+
+def _mark_synced(batch: List[VisitingCard]) -> None:
+    now = timezone.now()
+    with transaction.atomic():
+        for card in batch:
+            row = sheet_row_values(card)
+            written = {
+                'sheet_row': card.sheet_row,
+                'sheet_values': dict(zip(CARD_FIELDS, row[:CONTACT_COLUMNS])),
+                'sheet_hash': row_hash(row),
+            }
+            updated = VisitingCard.objects.filter(pk=card.pk, sheet_lease=card.sheet_lease).update(
+                sheet_status=VisitingCard.SHEET_SYNCED,
+                sheet_synced_at=now,
+                sheet_attempts=F('sheet_attempts') + 1,
+                sheet_lease='',
+                sheet_error='',
+                **written
+            )
+            if not updated:
+                # Changed again while this push was in flight: it stays
+                # queued, but must remember the row it now has
+                VisitingCard.objects.filter(pk=card.pk).update(**written)
+
+def _reschedule(batch: List[VisitingCard], error: Exception) -> None:
+    now = timezone.now()
+    for card in batch:
+        attempts = card.sheet_attempts + 1
+        status = VisitingCard.SHEET_QUEUED
+        if attempts >= settings.SHEETS_OUTBOX_MAX_ATTEMPTS:
+            status = VisitingCard.SHEET_FAILED
+        VisitingCard.objects.filter(pk=card.pk).update(
+            sheet_status=status,
+            sheet_attempts=attempts,
+            sheet_next_attempt_at=now + timedelta(seconds=backoff_delay(attempts)),
+            sheet_lease='',
+            sheet_error=str(error)
+        )
+
+def _postpone(batch: List[VisitingCard], delay: float) -> None:
+    """Release a batch that was never sent, without counting an attempt"""
+    VisitingCard.objects.filter(pk__in=[card.pk for card in batch]).update(
+        sheet_next_attempt_at=timezone.now() + timedelta(seconds=delay),
+        sheet_lease=''
+    )
+
+def drain_outbox(batch_size: int = None, max_batches: int = None) -> int:
+    """Push due outbox cards to the Google Sheet in batches.
+
+    Stops at the first failed batch, since the upstream is unlikely to
+    recover within this round. Returns the number of cards synced.
+    """
+    batch_size = batch_size or settings.SHEETS_BATCH_MAX_ROWS
+    synced = 0
+    batches = 0
+
+    while max_batches is None or batches < max_batches:
+        batch = _claim_batch(batch_size)
+        if not batch:
+            break
+        batches += 1
+
+        try:
+            with metrics.span('sheet'):
+                _push_batch(batch)
+        except CircuitOpenError as e:
+            logger.warning("Google Sheet unavailable, postponing %d contacts: %s", len(batch), e)
+            _postpone(batch, e.retry_after or settings.SHEETS_OUTBOX_BASE_BACKOFF)
+            break
+        except Exception as e:
+            logger.warning("Failed to push %d contacts to Google Sheet, will retry: %s", len(batch), e)
+            _reschedule(batch, e)
+            break
+
+        _mark_synced(batch)
+        synced += len(batch)
+
+    if synced:
+        logger.info("Synced %d contacts to the Google Sheet", synced)
+    return synced
+
+class OutboxWorker(threading.Thread):
+    """Background thread that drains the outbox.
+
+    It runs every ``interval`` seconds to pick up retries, and immediately
+    after ``wake()`` once the coalescing window has passed, so rows from
+    concurrent requests go out in one batch.
+    """
+
+    def __init__(self, interval: float):
+        super().__init__(name='sheets-outbox', daemon=True)
+        self.interval = interval
+        self._wake = threading.Event()
+
+    def wake(self) -> None:
+        self._wake.set()
+
+    def run(self) -> None:
+        while True:
+            if self._wake.wait(self.interval):
+                time.sleep(settings.SHEETS_BATCH_MAX_WAIT)
+            self._wake.clear()
+            try:
+                drain_outbox()
+            except Exception as e:
+                logger.error("Outbox drain failed: %s", e, exc_info=True)
+            finally:
+                close_old_connections()
+
+_worker_lock = threading.Lock()
+_worker = {'pid': None, 'thread': None}
+
+def wake_outbox_worker() -> None:
+    """Start this process's outbox worker if needed and wake it up"""
+    if not settings.SHEETS_OUTBOX_WORKER:
+        return
+
+    with _worker_lock:
+        # Threads do not survive a fork, so each worker process starts its own
+        if _worker['thread'] is None or _worker['pid'] != os.getpid():
+            _worker['thread'] = OutboxWorker(settings.SHEETS_OUTBOX_POLL_INTERVAL)
+            _worker['pid'] = os.getpid()
+            _worker['thread'].start()
+        _worker['thread'].wake()
@@ -0,0 +1,368 @@
+import os
+import re
+import math
+import time
+import random
+import asyncio
+import threading
+import logging
+from typing import Any, Callable, Dict, Mapping, Optional
+from django.conf import settings
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+# Durations in OpenAI rate-limit headers look like "20ms", "1s" or "6m0s"
+DURATION_RE = re.compile(r'(\d+(?:\.\d+)?)(ms|s|m|h)')
+DURATION_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+
+class UpstreamError(Exception):
+    """A call to an external API failed"""
+
+    retryable = False
+
+    def __init__(self, upstream: str, message: str, status: Optional[int] = None,
+                 retry_after: Optional[float] = None):
+        super().__init__(f"{upstream}: {message}")
+        self.upstream = upstream
+        self.status = status
+        self.retry_after = retry_after
+
+class RateLimitedError(UpstreamError):
+    """The upstream answered 429; worth retrying after a pause"""
+
+    retryable = True
+
+class UnavailableError(UpstreamError):
+    """5xx, timeout or connection failure; worth retrying"""
+
+    retryable = True
+
+class CircuitOpenError(UpstreamError):
+    """The upstream failed repeatedly, so calls fail fast until it recovers"""
+
+def parse_duration(value: Any) -> Optional[float]:
+    """Seconds in a Retry-After or x-ratelimit-reset-* header value"""
+    if value is None:
+        return None
+    value = str(value).strip()
+    try:
+        seconds = float(value)
+    except ValueError:
+        pass
+    else:
+        # "inf", "nan" and negative values are not durations
+        return seconds if math.isfinite(seconds) and seconds >= 0 else None
+    parts = DURATION_RE.findall(value)
+    if not parts:
+        return None
+    return sum(float(amount) * DURATION_UNITS[unit] for amount, unit in parts)
+
+def retry_after(headers: Optional[Mapping[str, str]]) -> Optional[float]:
+    if not headers:
+        return None
+    # A malformed retry-after-ms falls back to retry-after
+    milliseconds = parse_duration(headers.get('retry-after-ms'))
+    if milliseconds is not None:
+        return milliseconds / 1000
+    return parse_duration(headers.get('retry-after'))
+
+class TokenBucket:
+    """Request-rate limiter shared by every thread calling one upstream.
+
+    ``reserve`` takes a token and returns how long the caller must wait
+    for it, so sync callers sleep and async callers await the same
+    reservation. The rate adapts: rate-limit headers set it directly,
+    a 429 halves it and pauses the bucket, and successes without headers
+    raise it back towards the configured rate.
+    """
+
+    def __init__(self, rate: float, burst: int):
+        self.max_rate = rate
+        self.min_rate = rate / 20
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float) -> None:
+        if now > self.updated:
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+
+    def reserve(self, max_wait: float) -> Optional[float]:
+        """Seconds until a token is available, or None if over ``max_wait``"""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            # Tokens may go negative: each waiter queues behind the previous
+            wait = max(0.0, self.updated - now) + max(0.0, 1 - self.tokens) / self.rate
+            if wait > max_wait:
+                return None
+            self.tokens -= 1
+            return wait
+
+    def observe(self, remaining: Optional[float], reset: Optional[float]) -> None:
+        """Adapt to a successful response's rate-limit headers"""
+        with self._lock:
+            if remaining is not None and reset:
+                self.rate = min(self.max_rate, max(self.min_rate, remaining / reset))
+                self.tokens = min(self.tokens, remaining)
+            else:
+                self.rate = min(self.max_rate, self.rate + self.max_rate / 10)
+
+    def throttle(self, pause: Optional[float]) -> None:
+        """Back off after a 429: halve the rate and stop issuing tokens for ``pause``"""
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = min(self.tokens, 0.0)
+            if pause:
+                self.updated = max(self.updated, now + pause)
+
+class CircuitBreaker:
+    """Fail fast while an upstream is down.
+
+    Opens after ``threshold`` consecutive failures. After ``reset_timeout``
+    seconds one probe call is let through; its outcome closes the circuit
+    or opens it again.
+    """
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, threshold: int, reset_timeout: float):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def retry_in(self) -> float:
+        return max(0.0, self.opened_at + self.reset_timeout - time.monotonic())
+
+    def allow(self) -> bool:
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and not self.retry_in():
+                self.state = self.HALF_OPEN
+                return True
+            # Open, or half-open with the probe still in flight
+            return False
+
+    def release(self) -> None:
+        """Give back a probe slot that was allowed but never used"""
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self.state != self.CLOSED:
+                logger.info("Circuit closed again")
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.threshold:
+                if self.state != self.OPEN:
+                    logger.warning("Circuit opened after %d failures", self.failures)
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+class Upstream:
+    """Rate limit, retry and circuit breaker around calls to one API.
+
+    ``classify`` maps an exception raised by the client library to an
+    UpstreamError (retryable or not), or returns None for errors that are
+    not the upstream's fault, which propagate unchanged. ``headers``
+    extracts rate-limit headers from a successful result, if the client
+    exposes them.
+    """
+
+    def __init__(self, name: str, config: Dict[str, Any],
+                 classify: Callable[[str, Exception], Optional[UpstreamError]],
+                 headers: Optional[Callable[[Any], Optional[Mapping[str, str]]]] = None):
+        self.name = name
+        self.config = config
+        self.classify = classify
+        self.headers = headers
+        self.bucket = TokenBucket(config['rate'], config['burst'])
+        self.breaker = CircuitBreaker(config['circuit_threshold'], config['circuit_reset'])
+        self.stats = {'calls': 0, 'retries': 0, 'throttled': 0, 'failed': 0, 'rejected': 0}
+        self._lock = threading.Lock()
+
+    def _count(self, name: str) -> None:
+        with self._lock:
+            self.stats[name] += 1
+
+    def backoff(self, attempt: int, error: UpstreamError) -> float:
+        """Full-jitter exponential delay before retry ``attempt``"""
+        delay = random.uniform(0, min(self.config['max_backoff'], self.config['base_backoff'] * 2 ** attempt))
+        return max(delay, error.retry_after or 0.0)
+
+    def _admit(self) -> float:
+        if not self.breaker.allow():
+            self._count('rejected')
+            raise CircuitOpenError(self.name, f"circuit open, retry in {self.breaker.retry_in():.0f}s",
+                                   retry_after=self.breaker.retry_in())
+        wait = self.bucket.reserve(self.config['max_wait'])
+        if wait is None:
+            # This call never reaches the upstream, so it cannot be the probe
+            self.breaker.release()
+            self._count('throttled')
+            raise RateLimitedError(self.name, "local rate limit exceeded", retry_after=self.config['max_wait'])
+        self._count('calls')
+        return wait
+
+    def _succeeded(self, result: Any) -> None:
+        self.breaker.record_success()
+        headers = self.headers(result) if self.headers else None
+        if headers:
+            self.bucket.observe(
+                parse_duration(headers.get('x-ratelimit-remaining-requests')),
+                parse_duration(headers.get('x-ratelimit-reset-requests'))
+            )
+        else:
+            self.bucket.observe(None, None)
+
+    def _failed(self, exc: Exception, attempt: int, idempotent: bool) -> float:
+        """Record a failed attempt and return the delay before retrying it.
+
+        Raises instead when the error is final.
+        """
+        error = self.classify(self.name, exc)
+        if error is None:
+            self.breaker.release()
+            raise exc
+        if isinstance(error, RateLimitedError):
+            # A 429 means the upstream is up; slow down instead of opening the circuit
+            self.bucket.throttle(error.retry_after)
+            self.breaker.record_success()
+        elif error.retryable:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+
+        # Without a response, a non-idempotent request may have been applied
+        unsafe = not idempotent and error.status is None
+        if not error.retryable or unsafe or attempt + 1 >= self.config['max_attempts']:
+            self._count('failed')
+            raise error from exc
+        self._count('retries')
+        delay = self.backoff(attempt, error)
+        logger.warning("%s; retry %d in %.2fs", error, attempt + 1, delay)
+        return delay
+
+    def call(self, func: Callable[..., Any], *args, idempotent: bool = True, **kwargs) -> Any:
+        """Call ``func`` within the rate limit, retrying retryable errors.
+
+        Failures surface as UpstreamError subclasses. Pass
+        ``idempotent=False`` for writes that must not be repeated when the
+        upstream may have applied them (timeouts and dropped connections).
+        """
+        for attempt in range(self.config['max_attempts']):
+            wait = self._admit()
+            if wait:
+                time.sleep(wait)
+            try:
+                result = func(*args, **kwargs)
+            except Exception as exc:
+                time.sleep(self._failed(exc, attempt, idempotent))
+                continue
+            self._succeeded(result)
+            return result
+
+    async def acall(self, func: Callable[..., Any], *args, idempotent: bool = True, **kwargs) -> Any:
+        """``call`` for coroutine functions; waits without holding a thread"""
+        for attempt in range(self.config['max_attempts']):
+            wait = self._admit()
+            if wait:
+                await asyncio.sleep(wait)
+            try:
+                result = await func(*args, **kwargs)
+            except Exception as exc:
+                await asyncio.sleep(self._failed(exc, attempt, idempotent))
+                continue
+            self._succeeded(result)
+            return result
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self.stats)
+        return dict(
+            stats,
+            circuit=self.breaker.state,
+            rate=round(self.bucket.rate, 3),
+        )
+
+def classify_openai(name: str, exc: Exception) -> Optional[UpstreamError]:
+    import openai
+
+    if isinstance(exc, openai.APIStatusError):
+        status = exc.status_code
+        wait = retry_after(exc.response.headers)
+        if status == 429:
+            return RateLimitedError(name, str(exc), status, wait)
+        if status >= 500 or status in (408, 409):
+            return UnavailableError(name, str(exc), status, wait)
+        return UpstreamError(name, str(exc), status)
+    if isinstance(exc, (openai.APIConnectionError, openai.APITimeoutError)):
+        return UnavailableError(name, str(exc))
+    return None
+
+def openai_headers(result: Any) -> Optional[Mapping[str, str]]:
+    # Results of ``with_raw_response`` calls carry the HTTP headers
+    return getattr(result, 'headers', None)
+
+def classify_google(name: str, exc: Exception) -> Optional[UpstreamError]:
+    from googleapiclient.errors import HttpError
+
+    if isinstance(exc, HttpError):
+        status = exc.resp.status
+        wait = retry_after(exc.resp)
+        if status == 429:
+            return RateLimitedError(name, str(exc), status, wait)
+        if status >= 500:
+            return UnavailableError(name, str(exc), status, wait)
+        return UpstreamError(name, str(exc), status)
+    if isinstance(exc, OSError):
+        # Socket timeouts, resets and DNS failures from httplib2
+        return UnavailableError(name, str(exc))
+    return None
+
+UPSTREAM_CLASSIFIERS = {
+    'openai': (classify_openai, openai_headers),
+    'sheets': (classify_google, None),
+}
+
+_lock = threading.Lock()
+_upstreams = {'pid': None, 'items': {}}
+
+def get_upstream(name: str) -> Upstream:
+    """The process-wide Upstream for ``name``, configured from UPSTREAM_LIMITS"""
+    with _lock:
+        # Limiter state is per process; a forked worker starts afresh
+        if _upstreams['pid'] != os.getpid():
+            _upstreams['pid'] = os.getpid()
+            _upstreams['items'] = {}
+        upstream = _upstreams['items'].get(name)
+        if upstream is None:
+            classify, headers = UPSTREAM_CLASSIFIERS[name]
+            upstream = Upstream(name, settings.UPSTREAM_LIMITS[name], classify, headers)
+            _upstreams['items'][name] = upstream
+        return upstream
+
+def reset_upstreams() -> None:
+    """Forget limiter and breaker state, e.g. after changing UPSTREAM_LIMITS"""
+    with _lock:
+        _upstreams['items'] = {}
+
+def upstream_stats() -> Dict[str, Dict[str, Any]]:
+    with _lock:
+        return {name: upstream.snapshot() for name, upstream in _upstreams['items'].items()}
@@ -0,0 +1,232 @@
+import uuid
+import hashlib
+import json
+import logging
+from collections import Counter
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from ..models import SyncState, VisitingCard
+from .contacts import contact_keys, normalize_email
+from .openai_helper import CARD_FIELDS
+from .sheets_helper import CONTACT_COLUMNS, SHEET_COLUMNS, get_card_ids_at, get_rows, row_hash, write_card_ids
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+PULL_STATE = 'sheet_pull'
+
+def _pad(row: List[Any]) -> List[str]:
+    return [str(value) for value in row] + [''] * (len(SHEET_COLUMNS) - len(row))
+
+def _sheet_fields(row: List[str]) -> Dict[str, str]:
+    """Contact fields of a sheet row, cut to the model's column sizes"""
+    fields = {}
+    for name, value in zip(CARD_FIELDS, row[:CONTACT_COLUMNS]):
+        max_length = VisitingCard._meta.get_field(name).max_length
+        fields[name] = value.strip()[:max_length] if max_length else value.strip()
+    fields['email'] = normalize_email(fields['email'])
+    return fields
+
+def _lookup_keys(fields: Dict[str, Any], pk: Optional[int] = None) -> Dict[str, Any]:
+    """contact_keys, dropping a dedup key another contact already owns"""
+    keys = contact_keys(fields)
+    if keys['dedup_key'] and VisitingCard.objects.filter(dedup_key=keys['dedup_key']).exclude(pk=pk).exists():
+        keys['dedup_key'] = None
+    return keys
+
+def _card_id(value: str) -> Optional[uuid.UUID]:
+    try:
+        return uuid.UUID(value.strip())
+    except ValueError:
+        return None
+
+def _parse_created_at(value: str):
+    try:
+        return timezone.make_aware(datetime.strptime(value, '%Y-%m-%d %H:%M:%S'))
+    except ValueError:
+        return timezone.now()
+
+def _card_from_row(number: int, row: List[str], sync_key: Optional[uuid.UUID]) -> VisitingCard:
+    """A contact someone typed into the sheet"""
+    fields = _sheet_fields(row)
+    return VisitingCard(
+        sync_key=sync_key or uuid.uuid4(),
+        created_at=_parse_created_at(row[7]),
+        sheet_status=VisitingCard.SHEET_SYNCED,
+        sheet_synced_at=timezone.now(),
+        sheet_row=number,
+        sheet_values=dict(zip(CARD_FIELDS, row[:CONTACT_COLUMNS])),
+        sheet_hash=row_hash(row),
+        **fields,
+        **_lookup_keys(fields)
+    )
+
+def _apply_sheet_edit(card: VisitingCard, number: int, row: List[str]) -> Dict[str, Any]:
+    """Merge a row edited in the sheet into its card; returns the changed columns.
+
+    A three-way merge against the values last synced: a field the sheet
+    changed takes the sheet's value, any other field keeps the local one.
+    If local changes remain, the card is queued to push them.
+    """
+    sheet = dict(zip(CARD_FIELDS, row[:CONTACT_COLUMNS]))
+    local = {name: getattr(card, name) or '' for name in CARD_FIELDS}
+    # Cards synced before rows were tracked have no common ancestor; treat
+    # every difference as an edit made in the sheet
+    base = card.sheet_values or local
+    edited = _sheet_fields(row)
+
+    merged = {
+        name: edited[name] if sheet[name] != base.get(name, '') else local[name]
+        for name in CARD_FIELDS
+    }
+    update = dict(merged, **_lookup_keys(merged, pk=card.pk))
+    update.update(sheet_row=number, sheet_values=sheet, sheet_hash=row_hash(row))
+
+    if any(merged[name] != sheet[name] for name in CARD_FIELDS):
+        card.requeue_for_sheet()
+        update.update(
+            sheet_status=card.sheet_status,
+            sheet_attempts=card.sheet_attempts,
+            sheet_next_attempt_at=card.sheet_next_attempt_at,
+            sheet_lease=card.sheet_lease
+        )
+    return update
+
+def _page_hash(rows: List[List[Any]]) -> str:
+    return hashlib.sha1(json.dumps(rows).encode('utf-8')).hexdigest()
+
+def _owned_rows(first: int, rows: List[List[str]], card_ids: Dict[int, uuid.UUID],
+                cards: Dict[uuid.UUID, VisitingCard]) -> Dict[int, uuid.UUID]:
+    """The rows of a page that own the Card ID they hold.
+
+    A Card ID copied to other rows stays with the card's recorded row while
+    that row still holds it, even when that row is on another page;
+    otherwise with its first row here. Copies become new contacts.
+    """
+    last = first + len(rows) - 1
+    appears = {}
+    for number, sync_key in card_ids.items():
+        appears.setdefault(sync_key, []).append(number)
+    # Only cards seen away from their recorded row need their old row checked
+    elsewhere = {
+        card.sheet_row for card in cards.values()
+        if card.sheet_row and card.sheet_row not in appears[card.sync_key] and not first <= card.sheet_row <= last
+    }
+    held = {number: _card_id(value) for number, value in get_card_ids_at(sorted(elsewhere)).items()}
+    held.update((first + offset, _card_id(row[8])) for offset, row in enumerate(rows))
+
+    owners = {}
+    for number, sync_key in card_ids.items():
+        card = cards.get(sync_key)
+        if card is not None and card.sheet_row not in (None, number) and held.get(card.sheet_row) == sync_key:
+            continue
+        if sync_key not in owners.values():
+            owners[number] = sync_key
+    return owners
+
+def _apply_page(first: int, rows: List[List[Any]], stats: Counter) -> Dict[int, str]:
+    """Apply one page of rows; returns the Card IDs given to new rows"""
+    rows = [_pad(row) for row in rows]
+    entries = {
+        first + offset: row for offset, row in enumerate(rows)
+        if any(value.strip() for value in row[:CONTACT_COLUMNS])
+    }
+
+    card_ids = {number: _card_id(row[8]) for number, row in entries.items()}
+    card_ids = {number: sync_key for number, sync_key in card_ids.items() if sync_key}
+    cards = {card.sync_key: card for card in VisitingCard.objects.filter(sync_key__in=card_ids.values())}
+    sync_keys = _owned_rows(first, rows, card_ids, cards)
+
+    created, new_ids = [], {}
+    with transaction.atomic():
+        for number, row in entries.items():
+            card = cards.get(sync_keys.get(number))
+            if card is None:
+                card = _card_from_row(number, row, sync_keys.get(number))
+                if card.dedup_key in {other.dedup_key for other in created}:
+                    card.dedup_key = None
+                created.append(card)
+                if number not in sync_keys:
+                    new_ids[number] = str(card.sync_key)
+                continue
+
+            if row_hash(row) == card.sheet_hash:
+                if card.sheet_row != number:
+                    VisitingCard.objects.filter(pk=card.pk).update(sheet_row=number)
+                    stats['moved'] += 1
+                continue
+
+            VisitingCard.objects.filter(pk=card.pk).update(**_apply_sheet_edit(card, number, row))
+            stats['updated'] += 1
+
+        VisitingCard.objects.bulk_create(created)
+        # Give rows typed into the sheet a Card ID so later syncs can track
+        # them. Written before the contacts commit: if the write fails they
+        # are rolled back, and the retry does not create them twice
+        write_card_ids(new_ids)
+
+    stats['created'] += len(created)
+    return new_ids
+
+def _forget_pages(state: SyncState, end: int) -> None:
+    """Drop the hashes of pages from row ``end`` on, past the end of the sheet"""
+    state.hashes = {first: value for first, value in state.hashes.items() if int(first) < end}
+
+def pull_sheet(max_rows: Optional[int] = None, full: bool = False) -> Dict[str, int]:
+    """Apply edits made in the Google Sheet to the local contacts.
+
+    Reads the sheet in pages of SHEETS_PULL_PAGE_ROWS. A page whose content
+    hash matches the last pull is skipped; otherwise each row's hash is
+    compared with the one stored at the last sync, so only edited rows
+    touch the database. Rows typed into the sheet become contacts and get a
+    Card ID.
+
+    A run reads about ``max_rows`` rows (SHEETS_PULL_MAX_ROWS by default,
+    rounded up to whole pages) and the next run continues where it stopped,
+    bounding the cost of each run. ``full`` reads and applies the whole
+    sheet, unchanged pages included.
+
+    Returns counters: rows read, rows skipped as unchanged, and contacts
+    updated, created and moved.
+    """
+    state, _ = SyncState.objects.get_or_create(name=PULL_STATE)
+    page_rows = settings.SHEETS_PULL_PAGE_ROWS
+    if full:
+        max_rows = None
+    elif max_rows is None:
+        max_rows = settings.SHEETS_PULL_MAX_ROWS or None
+    # Pages start at fixed rows so their hashes line up between runs
+    first = 2 if full else 2 + (max(state.cursor, 2) - 2) // page_rows * page_rows
+    stats = Counter(rows=0, skipped=0, updated=0, created=0, moved=0)
+
+    while max_rows is None or stats['rows'] < max_rows:
+        rows = get_rows(first, first + page_rows - 1)
+        if not rows:
+            # Past the last row; the next run starts from the top
+            _forget_pages(state, first)
+            first = 2
+            break
+        page_hash = _page_hash([_pad(row) for row in rows])
+        stats['rows'] += len(rows)
+        if not full and state.hashes.get(str(first)) == page_hash:
+            stats['skipped'] += len(rows)
+        else:
+            new_ids = _apply_page(first, rows, stats)
+            # Hash the page as it reads now that new rows have Card IDs
+            padded = [_pad(row) for row in rows]
+            for number, sync_key in new_ids.items():
+                padded[number - first][8] = sync_key
+            state.hashes[str(first)] = _page_hash(padded)
+        first += page_rows
+        if len(rows) < page_rows:
+            _forget_pages(state, first)
+            first = 2
+            break
+
+    state.cursor = first
+    state.save(update_fields=['cursor', 'hashes', 'updated_at'])
+    logger.info("Pulled sheet edits: %s", dict(stats))
+    return dict(stats)
@@ -1,8 +1,11 @@
-from google.oauth2 import service_account
-from googleapiclient.discovery import build
 from django.conf import settings
+import os
+import re
+import hashlib
 import logging
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Iterable, Optional, Tuple
+from .clients import get_sheets_service
+from .resilience import get_upstream
 
 # Configure logger
 logger = logging.getLogger(__name__)
@@ -16,21 +19,21 @@ SHEET_COLUMNS = [
     'Email',
     'Website',
     'Address',
-    'Created At'
+    'Created At',
+    'Card ID'
 ]
+# Columns a person may edit in the sheet; synced back to VisitingCard
+CONTACT_COLUMNS = 7
+CARD_ID_COLUMN = 'I'
 
-def get_sheets_service():
-    """Initialize and return Google Sheets service"""
-    try:
-        credentials = service_account.Credentials.from_service_account_file(
-            settings.GOOGLE_APPLICATION_CREDENTIALS,
-            scopes=['https://www.googleapis.com/auth/spreadsheets']
-        )
-        service = build('sheets', 'v4', credentials=credentials)
-        return service
-    except Exception as e:
-        logger.error(f"Failed to initialize Sheets service: {str(e)}", exc_info=True)
-        raise
+UPDATED_RANGE_RE = re.compile(r'![A-Z]+(?P<first>\d+)(?::[A-Z]+(?P<last>\d+))?$')
+
+# Process that has checked the header row
+_headers = {'pid': None}
+
+def _execute(request, idempotent: bool = True) -> Dict[str, Any]:
+    """Run a Sheets API request through the shared 'sheets' upstream limiter"""
+    return get_upstream('sheets').call(request.execute, idempotent=idempotent)
 
 def initialize_sheet() -> None:
     """Create header row if sheet is empty"""
@@ -38,65 +41,182 @@ def initialize_sheet() -> None:
         service = get_sheets_service()
         
         # Check if headers exist
-        result = service.spreadsheets().values().get(
+        result = _execute(service.spreadsheets().values().get(
             spreadsheetId=settings.GOOGLE_SHEET_ID,
-            range='A1:H1'
-        ).execute()
+            range='A1:I1'
+        ))
         
-        # If no headers, add them
-        if 'values' not in result:
-            service.spreadsheets().values().update(
+        # If no headers (or headers from an older column layout), add them
+        if result.get('values', [[]])[0] != SHEET_COLUMNS:
+            _execute(service.spreadsheets().values().update(
                 spreadsheetId=settings.GOOGLE_SHEET_ID,
-                range='A1:H1',
+                range='A1:I1',
                 valueInputOption='RAW',
                 body={'values': [SHEET_COLUMNS]}
-            ).execute()
+            ))
             logger.info("Sheet headers initialized")
     except Exception as e:
-        logger.error(f"Failed to initialize sheet: {str(e)}", exc_info=True)
+        logger.error("Failed to initialize sheet: %s", e, exc_info=True)
         raise
 
-def append_to_sheet(card_data: Dict[str, Any]) -> None:
-    """Append business card data to Google Sheet"""
+def ensure_headers() -> None:
+    """Run initialize_sheet once per process, on the first push.
+
+    Kept out of app startup so a cold start makes no Sheets call.
+    """
+    if _headers['pid'] != os.getpid():
+        initialize_sheet()
+        _headers['pid'] = os.getpid()
+
+def card_to_row(card_data: Dict[str, Any]) -> List[Any]:
+    """Format card data according to the sheet columns"""
+    return [
+        card_data.get('name', ''),
+        card_data.get('business_name', ''),
+        card_data.get('job_title', ''),
+        card_data.get('contact_number', ''),
+        card_data.get('email', ''),
+        card_data.get('website', ''),
+        card_data.get('address', ''),
+        card_data.get('created_at', ''),
+        card_data.get('sync_key', '')
+    ]
+
+def append_rows(cards: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Append several business cards to the Google Sheet in one request.
+
+    The rows are written by a single values.append call, so either all of
+    them land in the sheet or none do. An append is only retried when the
+    API rejected it; after a timeout it may have landed, so the outbox
+    checks Card IDs before trying again.
+    """
+    if not cards:
+        return {}
+    
     try:
         service = get_sheets_service()
         
-        # Format data according to columns
-        row_data = [
-            card_data.get('name', ''),
-            card_data.get('business_name', ''),
-            card_data.get('job_title', ''),
-            card_data.get('contact_number', ''),
-            card_data.get('email', ''),
-            card_data.get('website', ''),
-            card_data.get('address', ''),
-            card_data.get('created_at', '')
-        ]
-        
-        # Append the row
-        service.spreadsheets().values().append(
+        result = _execute(service.spreadsheets().values().append(
             spreadsheetId=settings.GOOGLE_SHEET_ID,
             range='A1',
             valueInputOption='RAW',
             insertDataOption='INSERT_ROWS',
-            body={'values': [row_data]}
-        ).execute()
+            body={'values': [card_to_row(card) for card in cards]}
+        ), idempotent=False)
         
-        logger.info(f"Successfully appended data for {card_data.get('name', 'Unknown')}")
+        logger.info("Successfully appended %d rows", len(cards))
+        return result
         
     except Exception as e:
-        logger.error(f"Failed to append to sheet: {str(e)}", exc_info=True)
+        logger.error("Failed to append to sheet: %s", e, exc_info=True)
         raise
 
+def append_to_sheet(card_data: Dict[str, Any]) -> None:
+    """Append business card data to Google Sheet"""
+    append_rows([card_data])
+    logger.info("Successfully appended data for %s", card_data.get('name', 'Unknown'))
+
+def row_hash(row: Iterable[Any]) -> str:
+    """Hash of a row's contact columns, used to detect edits on either side"""
+    values = [str(value) for value in list(row)[:CONTACT_COLUMNS]]
+    values += [''] * (CONTACT_COLUMNS - len(values))
+    return hashlib.sha1('\0'.join(values).encode('utf-8')).hexdigest()
+
+def appended_rows(result: Dict[str, Any]) -> Optional[Tuple[int, int]]:
+    """First and last row number written by a values.append call"""
+    match = UPDATED_RANGE_RE.search(result.get('updates', {}).get('updatedRange', ''))
+    if not match:
+        return None
+    first = int(match.group('first'))
+    return first, int(match.group('last') or first)
+
+def update_rows(rows: Dict[int, List[Any]]) -> None:
+    """Overwrite whole rows in place, keyed by row number, in one request"""
+    if not rows:
+        return
+    
+    try:
+        service = get_sheets_service()
+        _execute(service.spreadsheets().values().batchUpdate(
+            spreadsheetId=settings.GOOGLE_SHEET_ID,
+            body={
+                'valueInputOption': 'RAW',
+                'data': [
+                    {'range': f'A{number}:{CARD_ID_COLUMN}{number}', 'values': [row]}
+                    for number, row in rows.items()
+                ]
+            }
+        ))
+        logger.info("Updated %d rows in place", len(rows))
+    except Exception as e:
+        logger.error("Failed to update sheet rows: %s", e, exc_info=True)
+        raise
+
+def write_card_ids(card_ids: Dict[int, str]) -> None:
+    """Fill in the Card ID cell of the given rows"""
+    if not card_ids:
+        return
+    
+    service = get_sheets_service()
+    _execute(service.spreadsheets().values().batchUpdate(
+        spreadsheetId=settings.GOOGLE_SHEET_ID,
+        body={
+            'valueInputOption': 'RAW',
+            'data': [
+                {'range': f'{CARD_ID_COLUMN}{number}', 'values': [[card_id]]}
+                for number, card_id in card_ids.items()
+            ]
+        }
+    ))
+
+def get_card_ids_at(numbers: Iterable[int]) -> Dict[int, str]:
+    """Read the Card ID cell of specific rows in one batchGet"""
+    numbers = list(numbers)
+    if not numbers:
+        return {}
+    
+    service = get_sheets_service()
+    result = _execute(service.spreadsheets().values().batchGet(
+        spreadsheetId=settings.GOOGLE_SHEET_ID,
+        ranges=[f'{CARD_ID_COLUMN}{number}' for number in numbers]
+    ))
+    card_ids = {}
+    for number, value_range in zip(numbers, result.get('valueRanges', [])):
+        values = value_range.get('values') or [['']]
+        card_ids[number] = values[0][0] if values[0] else ''
+    return card_ids
+
+def get_card_rows() -> Dict[str, int]:
+    """Map every Card ID in the sheet to its row number"""
+    service = get_sheets_service()
+    result = _execute(service.spreadsheets().values().get(
+        spreadsheetId=settings.GOOGLE_SHEET_ID,
+        range=f'{CARD_ID_COLUMN}2:{CARD_ID_COLUMN}'
+    ))
+    return {
+        row[0]: number
+        for number, row in enumerate(result.get('values', []), start=2)
+        if row and row[0]
+    }
+
+def get_rows(first: int, last: int) -> List[List[Any]]:
+    """Read rows ``first``..``last`` (inclusive); trailing empty rows are omitted"""
+    service = get_sheets_service()
+    result = _execute(service.spreadsheets().values().get(
+        spreadsheetId=settings.GOOGLE_SHEET_ID,
+        range=f'A{first}:{CARD_ID_COLUMN}{last}'
+    ))
+    return result.get('values', [])
+
 def get_sheet_data() -> List[Dict[str, Any]]:
     """Retrieve all data from the Google Sheet"""
     try:
         service = get_sheets_service()
         
-        result = service.spreadsheets().values().get(
+        result = _execute(service.spreadsheets().values().get(
             spreadsheetId=settings.GOOGLE_SHEET_ID,
-            range='A:H'
-        ).execute()
+            range='A:I'
+        ))
         
         values = result.get('values', [])
         if not values:
@@ -111,7 +231,7 @@ def get_sheet_data() -> List[Dict[str, Any]]:
         return data
         
     except Exception as e:
-        logger.error(f"Failed to get sheet data: {str(e)}", exc_info=True)
+        logger.error("Failed to get sheet data: %s", e, exc_info=True)
         raise
 
 # Define exports
@@ -0,0 +1,291 @@
+import json
+import time
+import uuid
+import asyncio
+import hashlib
+import threading
+import logging
+from concurrent.futures import Future
+from datetime import timedelta
+from functools import wraps
+from typing import Any, Callable, Dict, Optional, Tuple
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.http import JsonResponse
+from django.utils import timezone
+from ..models import FlightRecord
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+# Single-flight execution: callers with the same key share one run of the
+# work and its result. Within a process they wait on the first caller's
+# future; across processes a FlightRecord row is the lock, and its stored
+# result answers repeats for SINGLE_FLIGHT_RETENTION seconds. Results must
+# be JSON-serializable. A caller may pass a fingerprint of what it asks for;
+# a caller with the same key but another fingerprint is refused.
+
+# How often to check on work another process is running
+POLL_INTERVAL = 0.2
+
+class FingerprintMismatch(Exception):
+    """The key is in use for work with a different fingerprint"""
+
+_lock = threading.Lock()
+_flights: Dict[str, Tuple[Future, str]] = {}
+_stats = {'led': 0, 'joined': 0, 'waited': 0, 'replayed': 0}
+_last_prune = {'at': 0.0}
+
+def _count(name: str) -> None:
+    with _lock:
+        _stats[name] += 1
+
+def stats() -> Dict[str, int]:
+    """Return counters for this process.
+
+    ``led`` runs did the work, ``joined`` ones shared a run in this
+    process, ``waited`` ones shared a run in another process and
+    ``replayed`` ones got a retained result.
+    """
+    with _lock:
+        return dict(_stats)
+
+def make_key(scope: str, value: str) -> str:
+    return hashlib.sha256(f"{scope}\0{value}".encode('utf-8')).hexdigest()
+
+def _join(key: str, fingerprint: str) -> Tuple[Future, bool]:
+    """The flight for ``key`` in this process, and whether the caller leads it"""
+    with _lock:
+        flight = _flights.get(key)
+        if flight is not None:
+            if flight[1] != fingerprint:
+                raise FingerprintMismatch(key)
+            return flight[0], False
+        future = Future()
+        _flights[key] = future, fingerprint
+        return future, True
+
+def _land(key: str) -> None:
+    with _lock:
+        _flights.pop(key, None)
+
+def _prune(now) -> None:
+    """Delete expired records, at most once a minute per process"""
+    if time.monotonic() - _last_prune['at'] < 60:
+        return
+    _last_prune['at'] = time.monotonic()
+    FlightRecord.objects.filter(expires_at__lt=now).delete()
+
+def _claim(key: str, fingerprint: str) -> Tuple[str, Any]:
+    """Try to take the cross-process lock for ``key``.
+
+    Returns ``('lead', lease)`` when the caller should do the work,
+    ``('done', result)`` for a retained result and ``('wait', None)``
+    while another process holds an unexpired lease. Raises
+    FingerprintMismatch if the unexpired record is for other work.
+    """
+    now = timezone.now()
+    lease = uuid.uuid4().hex
+    expires_at = now + timedelta(seconds=settings.SINGLE_FLIGHT_LEASE)
+    record = FlightRecord.objects.filter(key=key).first()
+    if record is None:
+        try:
+            with transaction.atomic():
+                FlightRecord.objects.create(key=key, lease=lease, fingerprint=fingerprint, expires_at=expires_at)
+        except IntegrityError:
+            return 'wait', None
+        _prune(now)
+        return 'lead', lease
+
+    if record.expires_at > now:
+        if record.fingerprint != fingerprint:
+            raise FingerprintMismatch(key)
+        if record.state == FlightRecord.STATE_DONE:
+            return 'done', record.result
+        return 'wait', None
+
+    # A stale lease or an expired result: take over, unless someone else
+    # did first (the conditional update only matches the row as read)
+    taken = FlightRecord.objects.filter(key=key, lease=record.lease, expires_at=record.expires_at).update(
+        state=FlightRecord.STATE_RUNNING, lease=lease, result=None, fingerprint=fingerprint, expires_at=expires_at
+    )
+    return ('lead', lease) if taken else ('wait', None)
+
+def _finish(key: str, lease: str, result: Any, keep: bool) -> None:
+    """Store the result of a run for replay, or give the key up"""
+    records = FlightRecord.objects.filter(key=key, lease=lease)
+    if keep:
+        records.update(
+            state=FlightRecord.STATE_DONE, result=result,
+            expires_at=timezone.now() + timedelta(seconds=settings.SINGLE_FLIGHT_RETENTION)
+        )
+    else:
+        records.delete()
+
+def run(key: str, func: Callable, *args, keep: Optional[Callable[[Any], bool]] = None,
+        fingerprint: str = '', **kwargs) -> Any:
+    """Run ``func(*args, **kwargs)`` once for all concurrent callers of ``key``.
+
+    Callers that arrive while it runs, in any thread or worker process,
+    get the same result or exception; callers within the retention window
+    get the stored result. A result for which ``keep`` returns False is
+    shared with the waiting callers but not retained, and neither are
+    exceptions. A caller whose ``fingerprint`` differs from the one the
+    key is held with gets FingerprintMismatch.
+    """
+    future, leader = _join(key, fingerprint)
+    if not leader:
+        _count('joined')
+        return future.result()
+
+    try:
+        waited = False
+        while True:
+            state, value = _claim(key, fingerprint)
+            if state == 'done':
+                _count('waited' if waited else 'replayed')
+                future.set_result(value)
+                return value
+            if state == 'lead':
+                break
+            waited = True
+            time.sleep(POLL_INTERVAL)
+
+        _count('led')
+        try:
+            result = func(*args, **kwargs)
+        except BaseException:
+            _finish(key, value, None, keep=False)
+            raise
+        _finish(key, value, result, keep=keep is None or keep(result))
+        future.set_result(result)
+        return result
+    except BaseException as e:
+        if not future.done():
+            future.set_exception(e)
+        raise
+    finally:
+        _land(key)
+
+async def arun(key: str, func: Callable, *args, keep: Optional[Callable[[Any], bool]] = None,
+               fingerprint: str = '', **kwargs) -> Any:
+    """Async variant of ``run`` for a coroutine function; waiting holds no thread"""
+    future, leader = _join(key, fingerprint)
+    if not leader:
+        _count('joined')
+        return await asyncio.wrap_future(future)
+
+    try:
+        waited = False
+        while True:
+            state, value = await sync_to_async(_claim)(key, fingerprint)
+            if state == 'done':
+                _count('waited' if waited else 'replayed')
+                future.set_result(value)
+                return value
+            if state == 'lead':
+                break
+            waited = True
+            await asyncio.sleep(POLL_INTERVAL)
+
+        _count('led')
+        try:
+            result = await func(*args, **kwargs)
+        except BaseException:
+            await sync_to_async(_finish)(key, value, None, keep=False)
+            raise
+        await sync_to_async(_finish)(key, value, result, keep=keep is None or keep(result))
+        future.set_result(result)
+        return result
+    except BaseException as e:
+        if not future.done():
+            future.set_exception(e)
+        raise
+    finally:
+        _land(key)
+
+def _client(request) -> str:
+    """Who sent a request: its session, else its address"""
+    session = getattr(request, 'session', None)
+    if session is not None and session.session_key:
+        return f"session:{session.session_key}"
+    return f"addr:{request.META.get('REMOTE_ADDR', '')}"
+
+def _request_key(request) -> Optional[str]:
+    value = request.headers.get('Idempotency-Key')
+    if not value:
+        return None
+    return make_key('request', f"{_client(request)}\0{request.method} {request.path}\0{value}")
+
+def _fingerprint(request) -> str:
+    """Digest of a request's form fields and files, or of its raw body.
+
+    Uploads are digested by content, so a retry that re-encodes the same
+    form under another multipart boundary matches.
+    """
+    if request.content_type not in ('multipart/form-data', 'application/x-www-form-urlencoded'):
+        return hashlib.sha256(request.body).hexdigest()
+    files = {}
+    for name, uploads in request.FILES.lists():
+        files[name] = []
+        for upload in uploads:
+            digest = hashlib.sha256()
+            for chunk in upload.chunks():
+                digest.update(chunk)
+            upload.seek(0)
+            files[name].append(digest.hexdigest())
+    content = json.dumps([sorted(request.POST.lists()), sorted(files.items())])
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+def _key_reused() -> JsonResponse:
+    return JsonResponse({'error': 'Idempotency-Key was already used for a different request'}, status=422)
+
+def _to_result(response) -> Dict[str, Any]:
+    return {'status': response.status_code, 'body': json.loads(response.content)}
+
+def _to_response(result: Dict[str, Any]) -> JsonResponse:
+    return JsonResponse(result['body'], status=result['status'])
+
+def _succeeded(result: Dict[str, Any]) -> bool:
+    return result['status'] < 500
+
+def idempotent(view: Callable) -> Callable:
+    """Coalesce requests to a JSON view that carry the same Idempotency-Key.
+
+    A repeated request (same client, method, path and key) shares the
+    first one's response while it runs, and gets a copy of it for
+    SINGLE_FLIGHT_RETENTION seconds after, unless it was a server error.
+    Keys are scoped to the session, or the client address without one. A
+    key reused with a different body gets a 422. Requests without the
+    header are not affected. Works on sync and async views.
+    """
+    if iscoroutinefunction(view):
+        @wraps(view)
+        async def async_wrapper(request, *args, **kwargs):
+            key = _request_key(request)
+            if key is None:
+                return await view(request, *args, **kwargs)
+
+            async def respond():
+                return _to_result(await view(request, *args, **kwargs))
+            fingerprint = await sync_to_async(_fingerprint)(request)
+            try:
+                return _to_response(await arun(key, respond, keep=_succeeded, fingerprint=fingerprint))
+            except FingerprintMismatch:
+                return _key_reused()
+        return async_wrapper
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        key = _request_key(request)
+        if key is None:
+            return view(request, *args, **kwargs)
+        try:
+            return _to_response(run(
+                key, lambda: _to_result(view(request, *args, **kwargs)),
+                keep=_succeeded, fingerprint=_fingerprint(request)
+            ))
+        except FingerprintMismatch:
+            return _key_reused()
+    return wrapper
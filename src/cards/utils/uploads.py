@@ -0,0 +1,207 @@
+import os
+import re
+import time
+import hashlib
+import logging
+from contextlib import contextmanager
+from typing import Any, Dict, Optional
+from django.conf import settings
+from django.core.files import File
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+# Resumable image uploads, addressed by the SHA-256 of the image bytes. The
+# browser sends each (already shrunk) image in chunks; a partial upload is
+# kept as "<digest>.part", with the size its first chunk declared in
+# "<digest>.total", and renamed to "<digest>" once its hash checks out, so
+# an image that was uploaded before is never sent again. Chunks of one
+# upload are serialized by a flock on its .part file, so UPLOAD_DIR may be
+# shared by every process and instance serving the app. Files are removed
+# UPLOAD_RETENTION seconds after their last use.
+DIGEST_RE = re.compile(r'^[0-9a-f]{64}$')
+CONTENT_RANGE_RE = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+
+_last_prune = {'at': 0.0}
+
+class UploadError(Exception):
+    """A chunk the server cannot accept; ``status`` is the HTTP status to answer with"""
+
+    def __init__(self, message: str, status: int = 400, received: int = 0):
+        super().__init__(message)
+        self.status = status
+        self.received = received
+
+def enabled() -> bool:
+    """Whether resumable uploads are configured (UPLOAD_DIR is set)"""
+    return bool(settings.UPLOAD_DIR) and fcntl is not None
+
+def _path(digest: str, suffix: str = '') -> str:
+    if not enabled():
+        raise UploadError("Resumable uploads are not enabled", status=404)
+    if not DIGEST_RE.match(digest):
+        raise UploadError("Upload id must be a lowercase hex SHA-256 digest")
+    return os.path.join(settings.UPLOAD_DIR, digest + suffix)
+
+def _size(path: str) -> int:
+    try:
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        return 0
+
+def _remove(path: str) -> None:
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+@contextmanager
+def _locked(path: str):
+    """Open ``path`` for appending, holding an exclusive flock on it.
+
+    The holder before us may have renamed or removed the file while we
+    waited, leaving our lock on a stale inode; then the file is opened again.
+    """
+    while True:
+        f = open(path, 'a+b')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            current = os.stat(path) if os.path.exists(path) else None
+        except BaseException:
+            f.close()
+            raise
+        if current is not None and current.st_ino == os.fstat(f.fileno()).st_ino:
+            break
+        f.close()
+    try:
+        yield f
+    finally:
+        # Closing releases the lock
+        f.close()
+
+def _declared_total(path: str) -> Optional[int]:
+    try:
+        with open(path) as f:
+            return int(f.read())
+    except (FileNotFoundError, ValueError):
+        return None
+
+def _sha256(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _prune() -> None:
+    """Delete uploads not used for UPLOAD_RETENTION seconds, at most once a minute"""
+    now = time.time()
+    if now - _last_prune['at'] < 60:
+        return
+    _last_prune['at'] = now
+    cutoff = now - settings.UPLOAD_RETENTION
+    for entry in os.scandir(settings.UPLOAD_DIR):
+        # Removed with their .part file, or below if left behind
+        if entry.name.endswith('.total') and os.path.exists(entry.path[:-len('.total')] + '.part'):
+            continue
+        try:
+            if entry.stat().st_mtime >= cutoff:
+                continue
+            os.remove(entry.path)
+        except FileNotFoundError:
+            continue
+        if entry.name.endswith('.part'):
+            _remove(entry.path[:-len('.part')] + '.total')
+
+def status(digest: str) -> Dict[str, Any]:
+    """How much of an upload the server holds"""
+    path = _path(digest)
+    if os.path.exists(path):
+        return {'digest': digest, 'received': _size(path), 'complete': True}
+    return {'digest': digest, 'received': _size(_path(digest, '.part')), 'complete': False}
+
+def parse_content_range(header: str):
+    """``(start, end, total)`` from ``Content-Range: bytes <start>-<end>/<total>``"""
+    match = CONTENT_RANGE_RE.match(header or '')
+    if not match:
+        raise UploadError("Content-Range must be 'bytes <start>-<end>/<total>'")
+    start, end, total = (int(value) for value in match.groups())
+    if end < start or end >= total:
+        raise UploadError("Content-Range is out of order")
+    if total > settings.UPLOAD_MAX_SIZE:
+        raise UploadError(f"Images are limited to {settings.UPLOAD_MAX_SIZE} bytes", status=413)
+    if end - start + 1 > settings.UPLOAD_CHUNK_SIZE:
+        raise UploadError(f"Chunks are limited to {settings.UPLOAD_CHUNK_SIZE} bytes", status=413)
+    return start, end, total
+
+def write_chunk(digest: str, content_range: str, stream) -> Dict[str, Any]:
+    """Append one chunk read from ``stream`` to an upload.
+
+    A chunk must start where the stored bytes end, and declare the same
+    total size as the upload's first chunk; otherwise an UploadError with
+    status 409 carries the current offset. When the last byte arrives the
+    content is checked against ``digest``; a mismatch discards the upload.
+    """
+    start, end, total = parse_content_range(content_range)
+    path, partial, declared = _path(digest), _path(digest, '.part'), _path(digest, '.total')
+    os.makedirs(settings.UPLOAD_DIR, exist_ok=True)
+    if os.path.exists(path):
+        return status(digest)
+
+    length = end - start + 1
+    with _locked(partial) as f:
+        received = os.fstat(f.fileno()).st_size
+        if os.path.exists(path):
+            # Completed while we waited; drop the .part we opened again
+            if not received:
+                _remove(partial)
+            return status(digest)
+        if received == 0:
+            with open(declared, 'w') as total_file:
+                total_file.write(str(total))
+        elif _declared_total(declared) != total:
+            raise UploadError("Content-Range total differs from the upload's first chunk",
+                              status=409, received=received)
+        if start != received:
+            raise UploadError("Chunk does not start at the stored offset", status=409, received=received)
+
+        remaining = length
+        while remaining:
+            data = stream.read(min(remaining, 64 * 1024))
+            if not data:
+                break
+            f.write(data)
+            remaining -= len(data)
+        f.flush()
+        if remaining:
+            # A short body: drop what was written, so the offset stays valid
+            f.truncate(received)
+            raise UploadError("Request body is shorter than Content-Range", received=received)
+        received += length
+
+        if received == total:
+            _remove(declared)
+            if _sha256(partial) != digest:
+                os.remove(partial)
+                raise UploadError("Upload does not match its SHA-256 digest", status=422)
+            os.replace(partial, path)
+            logger.debug("Upload %s complete (%d bytes)", digest, total)
+
+    _prune()
+    return {'digest': digest, 'received': received, 'complete': received == total}
+
+def open_upload(digest: str, name: str) -> File:
+    """Open a complete upload for analysis; raises UploadError if there is none"""
+    path = _path(digest)
+    try:
+        image = File(open(path, 'rb'), name=name or digest)
+    except FileNotFoundError:
+        raise UploadError(f"Upload {digest} is missing or incomplete", status=404)
+    # Using an upload keeps it from being pruned
+    os.utime(path)
+    return image
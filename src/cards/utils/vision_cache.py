@@ -0,0 +1,61 @@
+import hashlib
+import threading
+import logging
+from typing import Any, Dict, Optional
+from django.core.cache import caches
+
+# Configure logger
+logger = logging.getLogger(__name__)
+
+# Name of the Django cache alias holding vision results (see CACHES in
+# settings). Any Django cache backend works: the in-memory LRU default, a
+# file-based cache or the database cache.
+CACHE_ALIAS = 'vision'
+
+_stats_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0, 'stores': 0, 'errors': 0}
+
+def _count(name: str) -> None:
+    with _stats_lock:
+        _stats[name] += 1
+
+def make_key(image_bytes: bytes, **params: Any) -> str:
+    """Build a cache key from the image content and request parameters.
+
+    ``params`` should include everything that changes the model's answer,
+    e.g. the prompt and model name, so editing either invalidates old
+    entries.
+    """
+    digest = hashlib.sha256(image_bytes)
+    for name in sorted(params):
+        digest.update(f"\0{name}={params[name]}".encode('utf-8'))
+    return f"vision:{digest.hexdigest()}"
+
+def lookup(key: str) -> Optional[Any]:
+    """Return the cached result for ``key`` or None on a miss"""
+    try:
+        value = caches[CACHE_ALIAS].get(key)
+    except Exception as e:
+        # A broken cache must never fail the analysis itself
+        logger.warning("Vision cache lookup failed: %s", e)
+        _count('errors')
+        value = None
+    _count('hits' if value is not None else 'misses')
+    return value
+
+def store(key: str, value: Any) -> None:
+    """Store a result; the TTL comes from the cache alias TIMEOUT"""
+    try:
+        caches[CACHE_ALIAS].set(key, value)
+        _count('stores')
+    except Exception as e:
+        logger.warning("Vision cache store failed: %s", e)
+        _count('errors')
+
+def stats() -> Dict[str, Any]:
+    """Return hit/miss counters for this process"""
+    with _stats_lock:
+        counters = dict(_stats)
+    lookups = counters['hits'] + counters['misses']
+    counters['hit_ratio'] = round(counters['hits'] / lookups, 4) if lookups else 0.0
+    return counters
@@ -1,113 +1,489 @@
+import asyncio
+import hmac
 import logging
 import json
 import base64
 import tempfile
 import os
 import traceback
+from concurrent.futures import ThreadPoolExecutor
+from functools import wraps
+from asgiref.sync import sync_to_async
 from django.shortcuts import render
-from django.http import JsonResponse
+from django.urls import reverse
+from django.core.handlers.asgi import ASGIRequest
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.conf import settings
+from django.db.models import Q
 from django.utils import timezone
-from .utils.openai_helper import analyze_image, extract_card_details
-from .utils.sheets_helper import append_to_google_sheet
+from .models import VisitingCard
+from .utils.contacts import normalize_email, normalize_phone, normalize_text
+from .utils.image_preprocess import image_buffer
+from .utils.openai_helper import analyze_image, analyze_image_async, extract_card_details, image_cache_key, parse_stats
+from .utils.outbox import enqueue_cards
+from .utils.resilience import upstream_stats
+from .utils import jobs, local_ocr, metrics, model_routing, single_flight, uploads, vision_cache
 
 # Enhanced logging
 logger = logging.getLogger(__name__)
 
 def index(request):
     logger.info("Index page accessed")
-    return render(request, 'cards/index.html')
+    # The browser shrinks images to what analyze_image would send anyway
+    return render(request, 'cards/index.html', {
+        'upload_chunk_size': settings.UPLOAD_CHUNK_SIZE,
+        'image_max_edge': settings.VISION_IMAGE_MAX_EDGE,
+        'image_quality': settings.VISION_IMAGE_QUALITY,
+        'analyze_jobs': settings.ANALYZE_JOBS_ENABLED,
+        'resumable_uploads': uploads.enabled(),
+    })
 
 def upload_view(request):
     """Render the upload form"""
     logger.info("Upload form accessed")
     return render(request, 'cards/upload.html')
 
+def async_csrf_exempt(view):
+    """``csrf_exempt`` for async views.
+
+    Django's decorator only wraps async views from 5.0 on: on 4.2 its sync
+    wrapper would hide the coroutine function, so mark the view itself.
+    """
+    view.csrf_exempt = True
+    return view
+
+def internal_api(view):
+    """Let only staff sessions and holders of INTERNAL_API_TOKEN through"""
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if request.user.is_staff:
+            return view(request, *args, **kwargs)
+        token = settings.INTERNAL_API_TOKEN
+        scheme, _, credentials = request.headers.get('Authorization', '').partition(' ')
+        if token and scheme.lower() == 'bearer' and hmac.compare_digest(credentials.strip().encode(), token.encode()):
+            return view(request, *args, **kwargs)
+        response = JsonResponse({'error': 'Authentication required'}, status=401)
+        response['WWW-Authenticate'] = 'Bearer'
+        return response
+    return wrapper
+
+@internal_api
+def cache_stats(request):
+    """Report vision cache hit/miss counters for this process"""
+    return JsonResponse(vision_cache.stats())
+
+@internal_api
+def response_stats(request):
+    """Report vision response parsing, model tier, local OCR, deduplication and upstream limiter counters for this process"""
+    return JsonResponse(dict(
+        parse_stats(), model_tiers=model_routing.stats(), local_ocr=local_ocr.stats(),
+        single_flight=single_flight.stats(), upstreams=upstream_stats()
+    ))
+
+@internal_api
+def metrics_view(request):
+    """Prometheus metrics for this process: stage timings, tokens and counters"""
+    cache = vision_cache.stats()
+    parsing = parse_stats()
+    ocr = local_ocr.stats()
+    families = [
+        ('vision_cache_events_total', 'counter', "Vision cache lookups and writes",
+         [({'event': name}, cache[name]) for name in ('hits', 'misses', 'stores', 'errors')]),
+        ('vision_replies_total', 'counter', "Vision replies by parse outcome",
+         [({'outcome': name}, parsing[name]) for name in ('parsed', 'recovered', 'empty', 'failed')]),
+        ('local_ocr_cards_total', 'counter', "Cards tried with local OCR, by outcome (answered or the escalation reason)",
+         [({'outcome': name}, ocr[name])
+          for name in ('answered', 'no_text', 'missing_fields', 'low_confidence', 'errors')]),
+    ]
+    tiers = model_routing.stats()
+    families += [
+        ('vision_tier_replies_total', 'counter', "Vision replies per model tier, by outcome (accepted or escalated)",
+         [({'tier': tier, 'outcome': name}, counters[name])
+          for tier, counters in tiers.items() for name in ('accepted', 'escalated')]),
+        ('vision_tier_cached_replies_total', 'counter', "Vision replies per model tier served from the cache",
+         [({'tier': tier}, counters['cached']) for tier, counters in tiers.items()]),
+        ('vision_tier_tokens_total', 'counter', "Tokens used per model tier",
+         [({'tier': tier, 'kind': kind}, counters[f'{kind}_tokens'])
+          for tier, counters in tiers.items() for kind in ('prompt', 'completion')]),
+    ]
+    flights = single_flight.stats()
+    families.append(
+        ('single_flight_total', 'counter', "Deduplicated work by outcome: led, joined or waited on a run, or replayed",
+         [({'outcome': name}, count) for name, count in flights.items()])
+    )
+    limiters = upstream_stats()
+    families += [
+        ('upstream_events_total', 'counter', "Upstream limiter calls, retries and failures",
+         [({'upstream': upstream, 'event': name}, stats[name])
+          for upstream, stats in limiters.items()
+          for name in ('calls', 'retries', 'throttled', 'failed', 'rejected')]),
+        ('upstream_circuit_open', 'gauge', "1 while the upstream's circuit breaker is not closed",
+         [({'upstream': upstream}, int(stats['circuit'] != 'closed')) for upstream, stats in limiters.items()]),
+        ('upstream_rate_limit', 'gauge', "Current request rate allowed by the limiter, per second",
+         [({'upstream': upstream}, stats['rate']) for upstream, stats in limiters.items()]),
+    ]
+    return HttpResponse(metrics.render(families), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+def _page_size(request):
+    try:
+        size = int(request.GET.get('page_size') or settings.CONTACTS_PAGE_SIZE)
+    except ValueError:
+        size = settings.CONTACTS_PAGE_SIZE
+    return max(1, min(size, settings.CONTACTS_MAX_PAGE_SIZE))
+
+@internal_api
+def contact_list(request):
+    """Search stored contacts, newest first.
+
+    Filters: ``q`` (prefix of the name or business name), ``email`` and
+    ``phone``, all matched through indexed normalized columns. Pages are
+    keyset-based: pass ``next_cursor`` back as ``cursor`` for the next
+    page, which costs the same at any depth.
+    """
+    cards = VisitingCard.objects.order_by('-pk')
+    
+    query = normalize_text(request.GET.get('q'))
+    if query:
+        # A range on the normalized column is a prefix match any index can serve
+        end = query + '\U0010ffff'
+        cards = cards.filter(
+            Q(name_key__gte=query, name_key__lt=end) | Q(business_key__gte=query, business_key__lt=end)
+        )
+    if request.GET.get('email'):
+        cards = cards.filter(email=normalize_email(request.GET['email']))
+    if request.GET.get('phone'):
+        cards = cards.filter(normalized_phone=normalize_phone(request.GET['phone']))
+    if request.GET.get('cursor'):
+        try:
+            cards = cards.filter(pk__lt=int(request.GET['cursor']))
+        except ValueError:
+            return JsonResponse({'error': 'Invalid cursor'}, status=400)
+    
+    page_size = _page_size(request)
+    page = list(cards[:page_size + 1])
+    has_more = len(page) > page_size
+    page = page[:page_size]
+    return JsonResponse({
+        'results': [
+            dict(to_display_data(card.to_card_data()), id=card.pk, scan_count=card.scan_count)
+            for card in page
+        ],
+        'next_cursor': page[-1].pk if has_more else None,
+    })
+
+def process_image(img_file):
+    """Analyze one uploaded image and extract its contacts.
+
+    Photos of several cards are split into one crop per card, and the crops
+    are analyzed in parallel. Returns a list of card dicts in reading order.
+    """
+    crops = []
+    if settings.CARD_DETECTION_ENABLED:
+        # Imported on first use: it pulls in numpy, which slows cold starts
+        from .utils.card_detection import split_cards
+        try:
+            with metrics.span('detect'):
+                crops = split_cards(img_file)
+        except Exception as detection_error:
+            logger.warning("Card detection failed for %s: %s", img_file.name, detection_error)
+    
+    if not crops:
+        return extract_contacts(img_file)
+    
+    logger.info("Analyzing %d detected cards from %s", len(crops), img_file.name)
+    with ThreadPoolExecutor(max_workers=min(len(crops), settings.ANALYZE_MAX_WORKERS)) as executor:
+        results = []
+        for crop_results in executor.map(metrics.in_context(extract_contacts), crops):
+            results.extend(crop_results)
+    return results
+
+def extract_contacts(img_file):
+    """Analyze a single image and extract its contacts.
+
+    Returns a list of card dicts. Errors are caught and reported as an
+    ``error`` entry so one bad image never fails the batch.
+    """
+    logger.debug("Processing image: %s (%s bytes)", img_file.name, img_file.size)
+    
+    try:
+        # Clean printed cards can be read locally, without a vision call
+        raw_analysis = local_ocr.local_analysis(img_file)
+        if raw_analysis is None:
+            logger.debug("Calling analyze_image function")
+            raw_analysis = analyze_image(img_file)
+        return contacts_from_analysis(raw_analysis, img_file)
+    except Exception as process_error:
+        return [image_error(img_file, process_error)]
+
+def contacts_from_analysis(raw_analysis, img_file):
+    """Turn a vision reply into card dicts, or an error entry if it has none"""
+    logger.debug("Raw analysis received, now extracting card details")
+    
+    # Extract structured data from the raw response
+    with metrics.span('parse'):
+        cards = extract_card_details(raw_analysis)
+    metrics.CARDS_TOTAL.inc(len(cards))
+    logger.debug("Extracted %d contacts from the image", len(cards))
+    
+    # Add timestamp
+    created_at = timezone.now().strftime('%Y-%m-%d %H:%M:%S')
+    for card in cards:
+        card['created_at'] = created_at
+    
+    if not cards:
+        logger.warning("No card data extracted")
+        return [{
+            'error': 'No contact data could be extracted',
+            'image': img_file.name
+        }]
+    return cards
+
+def image_error(img_file, process_error):
+    logger.error("Error processing image: %s", str(process_error), exc_info=True)
+    return {
+        'error': f'Error processing image: {str(process_error)}',
+        'image': img_file.name
+    }
+
+async def process_image_async(img_file):
+    """Async variant of ``process_image``; crops are analyzed concurrently"""
+    crops = []
+    if settings.CARD_DETECTION_ENABLED:
+        from .utils.card_detection import split_cards
+        try:
+            with metrics.span('detect'):
+                crops = await sync_to_async(split_cards, thread_sensitive=False)(img_file)
+        except Exception as detection_error:
+            logger.warning("Card detection failed for %s: %s", img_file.name, detection_error)
+    
+    if not crops:
+        return await extract_contacts_async(img_file)
+    
+    logger.info("Analyzing %d detected cards from %s", len(crops), img_file.name)
+    crop_results = await asyncio.gather(*(extract_contacts_async(crop) for crop in crops))
+    return [entry for entries in crop_results for entry in entries]
+
+async def extract_contacts_async(img_file):
+    """Async variant of ``extract_contacts``"""
+    logger.debug("Processing image: %s (%s bytes)", img_file.name, img_file.size)
+    
+    try:
+        raw_analysis = None
+        if settings.LOCAL_OCR_ENABLED:
+            raw_analysis = await sync_to_async(local_ocr.local_analysis, thread_sensitive=False)(img_file)
+        if raw_analysis is None:
+            raw_analysis = await analyze_image_async(img_file)
+        return contacts_from_analysis(raw_analysis, img_file)
+    except Exception as process_error:
+        return [image_error(img_file, process_error)]
+
+def store_cards(cards):
+    """Save extracted cards to the local outbox.
+
+    The outbox worker pushes them to the Google Sheet in the background, so
+    the response only waits for the local write. Sets ``sheet_status`` on
+    every card.
+    """
+    if not cards:
+        return
+    
+    try:
+        logger.debug("Queueing %d contacts for the Google Sheet", len(cards))
+        with metrics.span('store'):
+            enqueue_cards(cards)
+    except Exception as store_error:
+        logger.error("Failed to queue %d contacts: %s", len(cards), store_error, exc_info=True)
+        for card in cards:
+            card['sheet_status'] = 'failed'
+
+def to_display_data(card):
+    """Convert field names for frontend display"""
+    return {
+        'name': card.get('name', ''),
+        'company': card.get('business_name', ''),
+        'position': card.get('job_title', ''),
+        'phone': card.get('contact_number', ''),
+        'email': card.get('email', ''),
+        'website': card.get('website', ''),
+        'address': card.get('address', ''),
+        'sheet_status': card.get('sheet_status', '')
+    }
+
+def analyze_upload(img_file):
+    """Process and store one image and return its display entries"""
+    entries = process_image(img_file)
+    store_cards([entry for entry in entries if 'error' not in entry])
+    return [
+        entry if 'error' in entry else to_display_data(entry)
+        for entry in entries
+    ]
+
+async def analyze_upload_async(img_file):
+    """Async variant of ``analyze_upload``"""
+    entries = await process_image_async(img_file)
+    await sync_to_async(store_cards)([entry for entry in entries if 'error' not in entry])
+    return [
+        entry if 'error' in entry else to_display_data(entry)
+        for entry in entries
+    ]
+
+def image_flight_key(img_file):
+    """Single-flight key of an upload: its content and the analysis settings"""
+    tier = settings.VISION_MODEL_TIERS[0]
+    with image_buffer(img_file) as data:
+        key = image_cache_key(data, tier['model'], tier['detail'], tier['max_tokens'])
+    return single_flight.make_key(
+        'image', f"{key}\0{model_routing.signature()}\0{settings.CARD_DETECTION_ENABLED}"
+    )
+
+def _no_errors(entries):
+    # Failed images are not retained, so a retry analyzes them again
+    return not any('error' in entry for entry in entries)
+
+def analyze_once(img_file):
+    """``analyze_upload``, shared by every upload of the same image.
+
+    Concurrent uploads of an image (double submits, client retries) wait
+    for one analysis instead of paying for their own and storing the
+    contacts twice; uploads within SINGLE_FLIGHT_RETENTION seconds get
+    its entries straight away.
+    """
+    return single_flight.run(image_flight_key(img_file), analyze_upload, img_file, keep=_no_errors)
+
+async def analyze_once_async(img_file):
+    """Async variant of ``analyze_once``"""
+    key = await sync_to_async(image_flight_key, thread_sensitive=False)(img_file)
+    return await single_flight.arun(key, analyze_upload_async, img_file, keep=_no_errors)
+
+@csrf_exempt
+@single_flight.idempotent
+def create_job(request):
+    """Start analyzing the uploaded images in the background.
+
+    Responds immediately with the job id; results are read from the
+    job's stream or status URL as each image finishes.
+    """
+    if not settings.ANALYZE_JOBS_ENABLED:
+        return JsonResponse({'error': 'Background jobs are disabled; use analyze/'}, status=404)
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Only POST requests are allowed'}, status=405)
+
+    if request.content_type == 'application/json':
+        # Images sent ahead through uploads/<sha256>/
+        images = []
+        try:
+            for entry in json.loads(request.body).get('uploads') or []:
+                images.append(uploads.open_upload(entry['digest'], entry.get('name')))
+        except (uploads.UploadError, ValueError, AttributeError, TypeError, KeyError) as e:
+            for image in images:
+                image.close()
+            if isinstance(e, uploads.UploadError):
+                return JsonResponse({'error': str(e)}, status=e.status)
+            return JsonResponse({'error': 'Expected {"uploads": [{"digest": ..., "name": ...}]}'}, status=400)
+    else:
+        with metrics.span('upload'):
+            images = [jobs.detach_upload(image) for image in request.FILES.getlist('images')]
+    if not images:
+        logger.error("No images received")
+        return JsonResponse({'error': 'No images provided'}, status=400)
+
+    job = jobs.start_job(images, analyze_once)
+    return JsonResponse({
+        'job_id': job.id,
+        'total': job.total,
+        'status_url': reverse('job_status', args=[job.id]),
+        'stream_url': reverse('job_stream', args=[job.id]),
+    }, status=202)
+
+@csrf_exempt
+def upload_image(request, digest):
+    """Resumable upload of one image, addressed by the SHA-256 of its bytes.
+
+    GET reports how many bytes the server holds. PUT appends the request
+    body at ``Content-Range: bytes <start>-<end>/<total>``; a chunk that
+    does not start at the stored offset gets a 409 with the offset to
+    resume from. Completed uploads are passed to analyze/jobs/ by digest.
+    """
+    try:
+        if request.method == 'GET':
+            return JsonResponse(uploads.status(digest))
+        if request.method != 'PUT':
+            return JsonResponse({'error': 'Only GET and PUT requests are allowed'}, status=405)
+        with metrics.span('upload'):
+            return JsonResponse(uploads.write_chunk(digest, request.headers.get('Content-Range'), request))
+    except uploads.UploadError as e:
+        return JsonResponse({'error': str(e), 'received': e.received}, status=e.status)
+
+def _get_job(job_id):
+    job = jobs.get_job(job_id)
+    if job is None:
+        raise Http404("Unknown or expired job")
+    return job
+
+def _cursor(request):
+    try:
+        return max(0, int(request.GET.get('after', 0)))
+    except ValueError:
+        return 0
+
+def job_status(request, job_id):
+    """Return a job's progress and the events after ``?after=<seq>``"""
+    return JsonResponse(_get_job(job_id).to_dict(_cursor(request)))
+
+def job_stream(request, job_id):
+    """Stream a job's events as NDJSON, one line per card or progress step.
+
+    ``?after=<seq>`` resumes after the last event seen. Under ASGI the
+    stream is an async generator, so waiting for results holds no thread.
+    """
+    job = _get_job(job_id)
+    cursor = _cursor(request)
+    if isinstance(request, ASGIRequest):
+        events = jobs.aiter_ndjson(job, cursor)
+    else:
+        events = jobs.iter_ndjson(job, cursor)
+
+    response = StreamingHttpResponse(events, content_type='application/x-ndjson')
+    response['Cache-Control'] = 'no-cache'
+    # Ask nginx-style proxies not to buffer the stream
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
 @csrf_exempt
+@single_flight.idempotent
 def analyze_card(request):
     """Handle image upload and analysis"""
-    logger.info("Card analysis endpoint accessed")
+    logger.debug("Card analysis endpoint accessed")
     
     if request.method != 'POST':
         logger.error("Invalid request method: %s", request.method)
         return JsonResponse({'error': 'Only POST requests are allowed'}, status=405)
     
-    # Log request details
-    logger.info("Request POST data keys: %s", list(request.POST.keys()))
-    logger.info("Request FILES keys: %s", list(request.FILES.keys()))
+    with metrics.span('upload'):
+        # Log request details; reading POST parses the multipart body
+        logger.debug("Request POST data keys: %s", list(request.POST.keys()))
+        images = request.FILES.getlist('images')
+    logger.debug("Request FILES keys: %s", list(request.FILES.keys()))
     
-    images = request.FILES.getlist('images')
     if not images:
         logger.error("No image files received in the 'images' field")
         return JsonResponse({'error': 'No images provided'}, status=400)
     
     logger.info("Received %d images for analysis", len(images))
     
+    max_workers = max(1, min(len(images), settings.ANALYZE_MAX_WORKERS))
+    logger.debug("Processing images with up to %d in flight", max_workers)
+    
     try:
-        results = []
-        
-        for i, img_file in enumerate(images):
-            logger.info("Processing image %d: %s (%s bytes)", 
-                       i+1, img_file.name, img_file.size)
-            
-            try:
-                # Use the OpenAI helper to analyze the image
-                logger.info("Calling analyze_image function")
-                raw_analysis = analyze_image(img_file)
-                logger.info("Raw analysis received, now extracting card details")
-                
-                # Extract structured data from the raw response
-                cards = extract_card_details(raw_analysis)
-                logger.info(f"Extracted {len(cards)} contacts from the image")
-                
-                # Process each extracted card
-                for j, card in enumerate(cards):
-                    logger.info(f"Processing contact {j+1}/{len(cards)}")
-                    
-                    # Add timestamp
-                    card['created_at'] = timezone.now().strftime('%Y-%m-%d %H:%M:%S')
-                    
-                    # Store in Google Sheet
-                    try:
-                        logger.info(f"Attempting to store contact {j+1} in Google Sheet")
-                        append_to_google_sheet(card)
-                        card['sheet_status'] = 'saved'
-                        logger.info("Successfully saved data to Google Sheet")
-                    except Exception as sheet_error:
-                        logger.error(f"Failed to save contact {j+1} to Google Sheet: {str(sheet_error)}", exc_info=True)
-                        card['sheet_status'] = 'failed'
-                    
-                    # Convert field names for frontend display
-                    display_data = {
-                        'name': card.get('name', ''),
-                        'company': card.get('business_name', ''),
-                        'position': card.get('job_title', ''),
-                        'phone': card.get('contact_number', ''),
-                        'email': card.get('email', ''),
-                        'website': card.get('website', ''),
-                        'address': card.get('address', ''),
-                        'sheet_status': card.get('sheet_status', '')
-                    }
-                    
-                    results.append(display_data)
-                
-                if not cards:
-                    logger.warning("No card data extracted")
-                    results.append({
-                        'error': 'No contact data could be extracted',
-                        'image': img_file.name
-                    })
-                
-            except Exception as process_error:
-                logger.error("Error processing image: %s", str(process_error), exc_info=True)
-                results.append({
-                    'error': f'Error processing image: {str(process_error)}',
-                    'image': img_file.name
-                })
+        # Fan out one task per image; map() yields in upload order
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            results = []
+            for image_results in executor.map(metrics.in_context(analyze_once), images):
+                results.extend(image_results)
         
         # Return all results, don't special-case just one result
-        logger.info(f"Returning {len(results)} contacts in total")
+        logger.info("Returning %d contacts in total", len(results))
         return JsonResponse({'results': results})
             
     except Exception as e:
@@ -116,4 +492,43 @@ def analyze_card(request):
         return JsonResponse({
             'error': f'An unexpected error occurred: {str(e)}',
             'contact': 'Please check server logs for details'
-        }, status=500)
\ No newline at end of file
+        }, status=500)
+
+@async_csrf_exempt
+@single_flight.idempotent
+async def analyze_card_async(request):
+    """Async variant of ``analyze_card`` for ASGI deployments.
+
+    The same pipeline and response, but the OpenAI calls are awaited on a
+    shared AsyncOpenAI client and CPU-bound steps run on worker threads, so
+    a waiting upload costs a coroutine instead of a worker thread. Sheets
+    writes already happen off the request path through the outbox.
+    """
+    if request.method != 'POST':
+        return JsonResponse({'error': 'Only POST requests are allowed'}, status=405)
+    
+    with metrics.span('upload'):
+        images = request.FILES.getlist('images')
+    if not images:
+        logger.error("No image files received in the 'images' field")
+        return JsonResponse({'error': 'No images provided'}, status=400)
+    
+    logger.info("Received %d images for async analysis", len(images))
+    slots = asyncio.Semaphore(max(1, settings.ANALYZE_MAX_WORKERS))
+    
+    async def run(img_file):
+        async with slots:
+            return await analyze_once_async(img_file)
+    
+    try:
+        results = [entry for image_results in await asyncio.gather(*(run(image) for image in images))
+                   for entry in image_results]
+        logger.info("Returning %d contacts in total", len(results))
+        return JsonResponse({'results': results})
+    
+    except Exception as e:
+        logger.critical("Unexpected error in analyze_card_async view: %s", str(e), exc_info=True)
+        return JsonResponse({
+            'error': f'An unexpected error occurred: {str(e)}',
+            'contact': 'Please check server logs for details'
+        }, status=500)
@@ -20,6 +20,30 @@ document.addEventListener('DOMContentLoaded', function() {
     
     const debugLog = document.getElementById('debug-log');
     let lastContactData = null;
+    
+    // Upload settings rendered by the server. Images are shrunk to what the
+    // vision API is sent anyway, then uploaded in chunks that can resume.
+    // The server only gives an upload URL when it has storage shared by
+    // all its instances; otherwise images go in the analysis request.
+    const uploadSettings = uploadForm ? uploadForm.dataset : {};
+    const uploadConfig = {
+        uploadUrl: uploadSettings.uploadUrl,
+        workerUrl: uploadSettings.workerUrl,
+        chunkSize: Number(uploadSettings.chunkSize) || 1048576,
+        maxEdge: Number(uploadSettings.maxEdge || 1536),
+        quality: Number(uploadSettings.quality) || 85,
+        parallel: 3,
+        // Background jobs live in one server process's memory, so they are
+        // only used where the server enables them; otherwise analyze/ answers
+        jobs: uploadSettings.analyzeJobs === 'true'
+    };
+    // Prepared images by File and finished uploads by digest, so a retry
+    // neither re-encodes nor resends an image
+    const preparedImages = new WeakMap();
+    const uploadedDigests = new Set();
+    let imageWorker = null;
+    const workerRequests = new Map();
+    let nextWorkerRequest = 1;
 
     // Helper function to add debug messages
     function addDebug(message) {
@@ -275,42 +299,158 @@ document.addEventListener('DOMContentLoaded', function() {
                 resultsContainer.classList.add('d-none');
             }
             
+            await submitFormWithFiles(this.formData);
+        });
+    }
+
+    // Chunked uploads need hashing (crypto.subtle), which browsers only
+    // offer on HTTPS and localhost; elsewhere the images go in one POST
+    function canUploadInChunks() {
+        return Boolean(uploadConfig.uploadUrl && window.crypto && crypto.subtle && window.createImageBitmap && uploadForm);
+    }
+
+    async function sha256(blob) {
+        const hash = await crypto.subtle.digest('SHA-256', await blob.arrayBuffer());
+        return Array.from(new Uint8Array(hash), byte => byte.toString(16).padStart(2, '0')).join('');
+    }
+
+    // A worker that fails to load or crashes fails every pending request,
+    // and the next image starts a new one
+    function failWorker(message) {
+        const requests = Array.from(workerRequests.values());
+        workerRequests.clear();
+        if (imageWorker) imageWorker.terminate();
+        imageWorker = null;
+        requests.forEach(request => request.reject(new Error(message)));
+    }
+
+    function prepareInWorker(file) {
+        if (!imageWorker) {
+            imageWorker = new Worker(uploadConfig.workerUrl);
+            imageWorker.onmessage = function(e) {
+                const request = workerRequests.get(e.data.id);
+                workerRequests.delete(e.data.id);
+                if (e.data.error) {
+                    request.reject(new Error(e.data.error));
+                } else {
+                    request.resolve(e.data);
+                }
+            };
+            imageWorker.onerror = function(e) {
+                e.preventDefault();
+                failWorker(e.message || 'image worker failed');
+            };
+            imageWorker.onmessageerror = function() {
+                failWorker('image worker sent an unreadable message');
+            };
+        }
+        return new Promise((resolve, reject) => {
+            const id = nextWorkerRequest++;
+            workerRequests.set(id, { resolve, reject });
+            imageWorker.postMessage({ id, file, maxEdge: uploadConfig.maxEdge, quality: uploadConfig.quality });
+        });
+    }
+
+    // Same as image-worker.js, for browsers without OffscreenCanvas
+    async function prepareOnMainThread(file) {
+        const bitmap = await createImageBitmap(file, { imageOrientation: 'from-image' });
+        const maxEdge = uploadConfig.maxEdge;
+        const scale = maxEdge ? Math.min(1, maxEdge / Math.max(bitmap.width, bitmap.height)) : 1;
+        const canvas = document.createElement('canvas');
+        canvas.width = Math.round(bitmap.width * scale);
+        canvas.height = Math.round(bitmap.height * scale);
+        const context = canvas.getContext('2d');
+        context.fillStyle = '#fff';
+        context.fillRect(0, 0, canvas.width, canvas.height);
+        context.drawImage(bitmap, 0, 0, canvas.width, canvas.height);
+        bitmap.close();
+        
+        const blob = await new Promise(resolve => canvas.toBlob(resolve, 'image/jpeg', uploadConfig.quality / 100));
+        return { blob, digest: await sha256(blob), width: canvas.width, height: canvas.height };
+    }
+
+    // Shrink and hash an image once; later calls reuse the result
+    function prepareImage(file) {
+        if (!preparedImages.has(file)) {
+            const pending = Promise.resolve()
+                .then(() => prepareInWorker(file))
+                .catch(error => {
+                    addDebug("Worker could not prepare " + file.name + " (" + error.message + "), using the page");
+                    return prepareOnMainThread(file);
+                })
+                .then(prepared => {
+                    addDebug(`Prepared ${file.name}: ${file.size} -> ${prepared.blob.size} bytes`);
+                    return { name: file.name, blob: prepared.blob, digest: prepared.digest };
+                });
+            pending.catch(() => preparedImages.delete(file));
+            preparedImages.set(file, pending);
+        }
+        return preparedImages.get(file);
+    }
+
+    // Send one prepared image in chunks, resuming from the server's offset
+    // after a failure. Images the server already has are not sent again.
+    async function uploadImage(image, csrftoken) {
+        const url = uploadConfig.uploadUrl + image.digest + '/';
+        for (let attempt = 1; ; attempt++) {
             try {
-                addDebug("Sending " + this.formData.getAll('images').length + " images to server");
+                if (uploadedDigests.has(image.digest)) return;
                 
-                const csrftoken = document.querySelector('[name=csrfmiddlewaretoken]').value;
-                addDebug("CSRF token: " + (csrftoken ? "Found" : "Not found"));
+                const statusResponse = await fetch(url);
+                if (!statusResponse.ok) {
+                    throw new Error('Server returned ' + statusResponse.status + ': ' + statusResponse.statusText);
+                }
+                let state = await statusResponse.json();
                 
-                addDebug("Sending POST request to /analyze/");
-                const response = await fetch('/analyze/', {
-                    method: 'POST',
-                    body: this.formData,
-                    headers: {
-                        'X-CSRFToken': csrftoken
+                while (!state.complete) {
+                    const start = state.received;
+                    const end = Math.min(start + uploadConfig.chunkSize, image.blob.size);
+                    const response = await fetch(url, {
+                        method: 'PUT',
+                        body: image.blob.slice(start, end),
+                        headers: {
+                            'Content-Range': `bytes ${start}-${end - 1}/${image.blob.size}`,
+                            'X-CSRFToken': csrftoken
+                        }
+                    });
+                    const body = await response.json();
+                    if (response.status === 409 && body.received !== start) {
+                        // Another request moved the offset; continue from there
+                        state = { received: body.received, complete: false };
+                        continue;
                     }
-                });
-                
-                addDebug("Response status: " + response.status);
-                
-                if (!response.ok) {
-                    throw new Error('Server returned ' + response.status + ': ' + response.statusText);
+                    if (!response.ok) {
+                        throw new Error(body.error || ('Server returned ' + response.status));
+                    }
+                    state = body;
                 }
-                
-                const data = await response.json();
-                addDebug("Response data: " + JSON.stringify(data).substring(0, 100) + "...");
-                
-                displayResults(data);
-                lastContactData = data;
+                uploadedDigests.add(image.digest);
+                return;
             } catch (error) {
-                addDebug("Error: " + error.message);
-                console.error('Error:', error);
-                alert('There was an error processing your card: ' + error.message);
-            } finally {
-                if (loadingIndicator) {
-                    loadingIndicator.classList.add('d-none');
-                }
+                if (attempt >= 4) throw error;
+                addDebug(`Upload of ${image.name} interrupted (${error.message}), resuming`);
+                await new Promise(resolve => setTimeout(resolve, 1000 * attempt));
             }
-        });
+        }
+    }
+
+    // Prepare and upload images, a few at a time; returns what the job
+    // endpoint needs to find them
+    async function uploadImages(files, csrftoken) {
+        const uploads = new Array(files.length);
+        let next = 0;
+        
+        async function uploadNext() {
+            while (next < files.length) {
+                const index = next++;
+                const image = await prepareImage(files[index]);
+                await uploadImage(image, csrftoken);
+                uploads[index] = { digest: image.digest, name: image.name };
+            }
+        }
+        
+        await Promise.all(Array.from({ length: Math.min(uploadConfig.parallel, files.length) }, uploadNext));
+        return uploads;
     }
 
     // New function to handle form submission directly
@@ -330,29 +470,17 @@ document.addEventListener('DOMContentLoaded', function() {
             const csrftoken = document.querySelector('[name=csrfmiddlewaretoken]').value;
             addDebug("CSRF token: " + (csrftoken ? "Found" : "Not found"));
             
-            // Make sure we're sending to the correct URL
-            const url = '/analyze/';
-            addDebug("Sending POST request to: " + url);
-            
-            const response = await fetch(url, {
-                method: 'POST',
-                body: formData,
-                headers: {
-                    'X-CSRFToken': csrftoken
-                }
-            });
-            
-            addDebug("Response status: " + response.status + " " + response.statusText);
+            // One key per submission: if the POST is sent again after a
+            // dropped connection, the server returns the same result
+            const idempotencyKey = (window.crypto && crypto.randomUUID)
+                ? crypto.randomUUID()
+                : Date.now().toString(36) + Math.random().toString(36).slice(2);
             
-            if (!response.ok) {
-                throw new Error('Server returned ' + response.status + ': ' + response.statusText);
+            if (uploadConfig.jobs) {
+                await analyzeInJob(formData, csrftoken, idempotencyKey);
+            } else {
+                await analyzeNow(formData, csrftoken, idempotencyKey);
             }
-            
-            const data = await response.json();
-            addDebug("Response received: " + JSON.stringify(data).substring(0, 100) + "...");
-            
-            displayResults(data);
-            lastContactData = data;
         } catch (error) {
             addDebug("Error during submission: " + error.message);
             console.error('Error:', error);
@@ -364,18 +492,142 @@ document.addEventListener('DOMContentLoaded', function() {
         }
     }
 
-    // Replace your displayResults function with this improved version
-    function displayResults(data) {
-        addDebug("Displaying results");
+    // POST with one retry after a dropped connection; the Idempotency-Key
+    // makes the server answer the retry from the first attempt
+    async function postWithRetry(url, request) {
+        addDebug("Sending POST request to: " + url);
+        let response;
+        try {
+            response = await fetch(url, request);
+        } catch (error) {
+            addDebug("Request failed (" + error.message + "), retrying");
+            response = await fetch(url, request);
+        }
+        
+        addDebug("Response status: " + response.status + " " + response.statusText);
+        if (!response.ok) {
+            throw new Error('Server returned ' + response.status + ': ' + response.statusText);
+        }
+        return response.json();
+    }
+
+    // Analyze the images in the request itself and render all results
+    async function analyzeNow(formData, csrftoken, idempotencyKey) {
+        const data = await postWithRetry('/analyze/', {
+            method: 'POST',
+            body: formData,
+            headers: {
+                'X-CSRFToken': csrftoken,
+                'Idempotency-Key': idempotencyKey
+            }
+        });
+        
+        const view = createResultsView();
+        lastContactData = { results: view.results };
+        (data.results || []).forEach(contact => view.addContact(contact));
+        view.setProgress(null);
+    }
+
+    // Start a background job, then stream its results as they arrive
+    async function analyzeInJob(formData, csrftoken, idempotencyKey) {
+        let request;
+        if (canUploadInChunks()) {
+            const uploads = await uploadImages(formData.getAll('images'), csrftoken);
+            addDebug("Uploaded " + uploads.length + " images");
+            request = {
+                method: 'POST',
+                body: JSON.stringify({ uploads }),
+                headers: {
+                    'Content-Type': 'application/json',
+                    'X-CSRFToken': csrftoken,
+                    'Idempotency-Key': idempotencyKey
+                }
+            };
+        } else {
+            request = {
+                method: 'POST',
+                body: formData,
+                headers: {
+                    'X-CSRFToken': csrftoken,
+                    'Idempotency-Key': idempotencyKey
+                }
+            };
+        }
         
+        // The response only carries the job's id and URLs
+        const job = await postWithRetry('/analyze/jobs/', request);
+        addDebug("Job started: " + job.job_id + " (" + job.total + " images)");
+        
+        const view = createResultsView();
+        view.setProgress(0, job.total);
+        lastContactData = { results: view.results };
+        await streamJob(job, view);
+    }
+
+    // Read a job's NDJSON stream and render each card as it arrives.
+    // A dropped connection resumes after the last event received.
+    async function streamJob(job, view) {
+        let lastSeq = 0;
+        let retries = 0;
+        
+        while (true) {
+            let finished = false;
+            try {
+                const response = await fetch(job.stream_url + '?after=' + lastSeq);
+                if (!response.ok) {
+                    throw new Error('Server returned ' + response.status + ': ' + response.statusText);
+                }
+                
+                const reader = response.body.getReader();
+                const decoder = new TextDecoder();
+                let buffered = '';
+                
+                while (true) {
+                    const { value, done } = await reader.read();
+                    if (done) break;
+                    buffered += decoder.decode(value, { stream: true });
+                    
+                    const lines = buffered.split('\n');
+                    buffered = lines.pop();
+                    lines.forEach(line => {
+                        if (!line.trim()) return;
+                        const event = JSON.parse(line);
+                        if (event.seq) lastSeq = event.seq;
+                        
+                        if (event.type === 'card') {
+                            view.addContact(event.card);
+                        } else if (event.type === 'error') {
+                            addDebug(`Error for ${event.image}: ${event.error}`);
+                        } else if (event.type === 'progress') {
+                            view.setProgress(event.completed, event.total);
+                        } else if (event.type === 'done') {
+                            finished = true;
+                        }
+                    });
+                }
+            } catch (error) {
+                addDebug("Stream interrupted: " + error.message);
+                if (++retries > 3) throw error;
+            }
+            
+            if (finished) {
+                addDebug("Job finished");
+                view.setProgress(null);
+                return;
+            }
+            await new Promise(resolve => setTimeout(resolve, 1000));
+        }
+    }
+
+    // Build an empty results table; contacts are added one at a time as
+    // they arrive from the server
+    function createResultsView() {
         // Clear previous results
         if (contactDetails) {
             contactDetails.innerHTML = '';
         }
         
-        // Get the results array - handle both cases
-        const resultsArray = data.results ? data.results : [data];
-        addDebug(`Displaying ${resultsArray.length} contacts`);
+        const resultsArray = [];
         
         // Create a responsive wrapper for the table
         const tableWrapper = document.createElement('div');
@@ -428,7 +680,16 @@ document.addEventListener('DOMContentLoaded', function() {
         // Store valid contacts for batch download
         const validContacts = [];
         
-        resultsArray.forEach((contact, index) => {
+        // Heading with count and progress line, filled in as results arrive
+        const heading = document.createElement('h3');
+        heading.className = 'mb-3';
+        const progress = document.createElement('p');
+        progress.className = 'text-muted';
+        
+        function addContact(contact) {
+            const index = resultsArray.length;
+            resultsArray.push(contact);
+            
             // Skip if this is an error entry
             if (contact.error) {
                 addDebug(`Skipping error entry: ${contact.error}`);
@@ -436,6 +697,7 @@ document.addEventListener('DOMContentLoaded', function() {
             }
             
             validContacts.push(contact);
+            heading.textContent = `${validContacts.length} Contacts Found`;
             
             const row = document.createElement('tr');
             
@@ -500,17 +762,25 @@ document.addEventListener('DOMContentLoaded', function() {
             
             row.appendChild(actionsTd);
             tableBody.appendChild(row);
-        });
+        }
+        
+        function setProgress(completed, total) {
+            if (completed === null) {
+                progress.classList.add('d-none');
+            } else {
+                progress.textContent = `Processed ${completed} of ${total} images...`;
+            }
+        }
+        
+        heading.textContent = '0 Contacts Found';
         
         contactsTable.appendChild(tableBody);
         tableWrapper.appendChild(contactsTable);
         
         if (contactDetails) {
             // Add a heading with count
-            const heading = document.createElement('h3');
-            heading.textContent = `${validContacts.length} Contacts Found`;
-            heading.className = 'mb-3';
             contactDetails.appendChild(heading);
+            contactDetails.appendChild(progress);
             
             // Add bulk download button
             const bulkDownloadContainer = document.createElement('div');
@@ -571,6 +841,8 @@ document.addEventListener('DOMContentLoaded', function() {
         if (resultsContainer) {
             resultsContainer.classList.remove('d-none');
         }
+        
+        return { results: resultsArray, addContact: addContact, setProgress: setProgress };
     }
 
     // Helper function to generate and download a vCard
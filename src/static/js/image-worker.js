@@ -0,0 +1,36 @@
+// Shrinks a photo off the main thread before upload: decode, downscale so the
+// longest edge is at most maxEdge, re-encode as JPEG and hash the result.
+// The server sends images in this shape to the vision API unchanged.
+self.onmessage = async function(e) {
+    const { id, file, maxEdge, quality } = e.data;
+    try {
+        const prepared = await prepareImage(file, maxEdge, quality);
+        self.postMessage({ id, ...prepared });
+    } catch (error) {
+        self.postMessage({ id, error: error.message });
+    }
+};
+
+async function prepareImage(file, maxEdge, quality) {
+    const bitmap = await createImageBitmap(file, { imageOrientation: 'from-image' });
+    const scale = maxEdge ? Math.min(1, maxEdge / Math.max(bitmap.width, bitmap.height)) : 1;
+    const width = Math.round(bitmap.width * scale);
+    const height = Math.round(bitmap.height * scale);
+
+    const canvas = new OffscreenCanvas(width, height);
+    const context = canvas.getContext('2d');
+    // JPEG has no alpha channel; flatten transparency onto white
+    context.fillStyle = '#fff';
+    context.fillRect(0, 0, width, height);
+    context.drawImage(bitmap, 0, 0, width, height);
+    bitmap.close();
+
+    const blob = await canvas.convertToBlob({ type: 'image/jpeg', quality: quality / 100 });
+    const digest = await sha256(blob);
+    return { blob, digest, width, height };
+}
+
+async function sha256(blob) {
+    const hash = await crypto.subtle.digest('SHA-256', await blob.arrayBuffer());
+    return Array.from(new Uint8Array(hash), byte => byte.toString(16).padStart(2, '0')).join('');
+}